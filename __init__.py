@@ -5,8 +5,20 @@ import urllib.parse
 import hashlib
 import base64
 import json
+import os
+import time
+import jinja2
+import markupsafe
 
 from . import common
+from . import metrics
+from . import services
+from . import render
+from . import flask_utils
+from . import drafts
+from . import assets
+from . import jobs
+from . import fragments
 from .auth import authapp
 from .notes import notesapp
 
@@ -16,6 +28,14 @@ app = flask.Flask(__name__)
 app.register_blueprint(authapp)
 app.register_blueprint(notesapp)
 
+# compiled templates are kept on disk, so a new worker process doesn't compile them again
+# (default: a directory in the system temp directory, "none" - don't keep them)
+TEMPLATE_CACHE_DIR = os.environ.get("TAGGED_TEMPLATE_CACHE_DIR", "")
+if TEMPLATE_CACHE_DIR != "none":
+    if TEMPLATE_CACHE_DIR:
+        os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+    app.jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache(TEMPLATE_CACHE_DIR or None)
+
 # template filter "escapeurl"
 # it is used for encoding generated urls in templates
 @app.template_filter("escapeurl")
@@ -27,7 +47,135 @@ def escapeurl_filter(s):
 # such as "<" -> "&lt;"; "\n" -> "<br>", etc
 @app.template_filter("raw2html")
 def raw2html_filter(s):
-    s = html.escape(s)
-    s = s.replace("\n", "<br>")
-    return s
+    return render.plain_to_html(s)
+
+# template function "asset_url"
+# URL of a built static bundle (see assets.py)
+app.add_template_global(assets.asset_url, "asset_url")
+
+# built static bundles: the name changes with the contents, so they are cached forever
+# a precompressed copy is sent if the client accepts it
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+
+@app.route(assets.URL_PREFIX + "<filename>")
+def asset(filename):
+    found = assets.resolve(filename, flask.request.accept_encodings)
+    if found is None:
+        flask.abort(404)
+    path, encoding, mimetype = found
+    resp = flask.send_file(path, mimetype=mimetype, max_age=ASSET_MAX_AGE)
+    resp.cache_control.public = True
+    resp.cache_control.immutable = True
+    if encoding is not None:
+        resp.headers["Content-Encoding"] = encoding
+    resp.vary.add("Accept-Encoding")
+    return resp
+
+# rendered notes in lists (see fragments.py)
+fragment_cache = fragments.FragmentCache(flask_utils.templates_stamp)
+
+def _short_note_key(note):
+    return ("short_note", note["id"], note["modified_ts"], note["title"], note["tags"])
+
+# template function "short_notes"
+# the same as macros.short_note for every note, a note is rendered once until it's changed
+@app.template_global("short_notes")
+def short_notes_global(notes):
+    macro = app.jinja_env.get_template("macros.html").module.short_note
+    return markupsafe.Markup("".join(fragment_cache.render_all(notes, _short_note_key, macro)))
+
+# template filter "timestamp"
+# unix timestamp (as in *_ts columns) -> date in the format of date_* columns
+@app.template_filter("timestamp")
+def timestamp_filter(ts):
+    return time.strftime(common.DATE_FORMAT, time.gmtime(ts))
+
+# template function "page_url"
+# url of the current page with another pagination cursor
+@app.template_global("page_url")
+def page_url_global(**cursor):
+    args = flask.request.args.to_dict()
+    args.pop("after", None)
+    args.pop("before", None)
+    args.update(cursor)
+    return flask.url_for(flask.request.endpoint, **flask.request.view_args, **args)
+
+
+# statistics of the site are not shown to everyone, see metrics.access_allowed()
+def check_stats_access():
+    if not metrics.access_allowed(flask.request.remote_addr, flask.request.headers.get("Authorization")):
+        flask.abort(404)
+
+# statistics of in-process caches
+@app.route("/stats/cache")
+def cache_stats():
+    check_stats_access()
+    return flask.jsonify({
+        "sessions": services.session_cache.stats(),
+        "fragments": fragment_cache.stats(),
+    })
+
+# instrumentation: request latency, SQL statements, template render time
+@app.before_request
+def start_request_metrics():
+    metrics.start_request()
+
+# deletion of expired sessions, started in every worker process
+@app.before_request
+def start_session_sweeper():
+    services.session_sweeper.ensure_started()
+
+# pool of background jobs, started in every worker process
+@app.before_request
+def start_job_runner():
+    jobs.runner.ensure_started()
+
+@app.after_request
+def add_server_timing(resp):
+    if metrics.SERVER_TIMING:
+        resp.headers["Server-Timing"] = metrics.server_timing()
+    return resp
+
+@app.teardown_request
+def end_request_metrics(exc):
+    rule = flask.request.url_rule
+    metrics.end_request(rule.rule if rule is not None else "unmatched")
+
+# return the connection to the user's shard to its pool
+@app.teardown_request
+def release_user_con(exc):
+    flask_utils.release_user_con()
+
+@flask.before_render_template.connect_via(app)
+def start_render_metrics(sender, template, context, **extra):
+    metrics.start_render()
+
+@flask.template_rendered.connect_via(app)
+def end_render_metrics(sender, template, context, **extra):
+    metrics.end_render(template.name)
 
+# metrics in Prometheus text format
+@app.route("/metrics")
+def metrics_page():
+    check_stats_access()
+    cache = services.session_cache.stats()
+    draft_stats = drafts.writer.stats()
+    job_stats = jobs.runner.stats()
+    fragment_stats = fragment_cache.stats()
+    text = metrics.export([
+        ("tagged_session_cache_hits_total", "counter", "Session cache hits.", cache["hits"]),
+        ("tagged_session_cache_misses_total", "counter", "Session cache misses.", cache["misses"]),
+        ("tagged_session_cache_evictions_total", "counter", "Session cache evictions.", cache["evictions"]),
+        ("tagged_session_cache_size", "gauge", "Number of cached sessions.", cache["size"]),
+        ("tagged_draft_saves_total", "counter", "Draft autosaves received.", draft_stats["saves"]),
+        ("tagged_draft_flushes_total", "counter", "Group commits of the draft writer.", draft_stats["flushes"]),
+        ("tagged_draft_written_total", "counter", "Drafts written to database after coalescing.", draft_stats["written"]),
+        ("tagged_draft_pending", "gauge", "Drafts waiting to be written.", draft_stats["pending"]),
+        ("tagged_fragment_cache_hits_total", "counter", "Note fragments found in memory.", fragment_stats["hits"]),
+        ("tagged_fragment_cache_disk_hits_total", "counter", "Note fragments found on disk.", fragment_stats["disk_hits"]),
+        ("tagged_fragment_cache_rendered_total", "counter", "Note fragments rendered.", fragment_stats["rendered"]),
+        ("tagged_jobs_submitted_total", "counter", "Background jobs submitted by this process.", job_stats["submitted"]),
+        ("tagged_jobs_done_total", "counter", "Background jobs finished successfully.", job_stats["done"]),
+        ("tagged_jobs_failed_total", "counter", "Background jobs failed.", job_stats["failed"]),
+    ])
+    return flask.Response(text, mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,173 @@
+# Static assets: bundling, fingerprinting and precompression.
+# Independent from flask.
+#
+#     python -m tagged.assets build
+#
+# Every bundle (see BUNDLES) is made of files from static/ and written to static/dist/
+# with a hash of its contents in the name, e.g. "editor.3f2a9c1e0b7d.js",
+# together with ".gz" and ".br" (if the "brotli" package is installed) compressed copies.
+# static/dist/manifest.json maps bundle names to file names, templates get URLs from asset_url().
+# A changed file gets a new name, so the files can be cached by browsers forever.
+#
+# The build is made at deploy time, or by the master process of tagged.serve before it starts workers.
+# A process which finds no build makes it itself; if static/dist/ can't be written (a read-only
+# installation), the build is made in FALLBACK_DIR in the system temp directory.
+
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import sys
+import tempfile
+import threading
+
+# brotli is optional: without it only ".gz" files are made
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+STATIC_DIR = os.path.join(os.path.dirname(__file__), "static")
+DIST_DIR = os.path.join(STATIC_DIR, "dist")
+FALLBACK_DIR = os.path.join(tempfile.gettempdir(),
+    "tagged-assets-" + hashlib.sha256(os.path.abspath(STATIC_DIR).encode("UTF-8")).hexdigest()[:12])
+MANIFEST_NAME = "manifest.json"
+
+# URL prefix of built files
+URL_PREFIX = "/assets/"
+
+# bundle name -> files from static/, concatenated in this order
+BUNDLES = {
+    "site.css": ("styles.css",),
+    "site.js": ("autocomplete.js",),
+    "site_dark.css": ("styles_dark.css",),
+    "editor.css": ("simplemde.min.css",),
+    "editor.js": ("simplemde.min.js", "autosave.js"),
+    "favicon.ico": ("images/favicon.ico",),
+}
+
+# length of the hash in file names
+HASH_LENGTH = 12
+
+# files which don't become smaller are not compressed
+MIN_COMPRESSED_RATIO = 0.9
+
+# Accept-Encoding value -> suffix of precompressed file, preferred first
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+def _concat(name, sources):
+    parts = []
+    for source in sources:
+        with open(os.path.join(STATIC_DIR, source), "rb") as f:
+            parts.append(f.read())
+    if len(parts) == 1:
+        return parts[0]
+    # ";" ends a statement left open by a minified script
+    sep = b"\n;\n" if name.endswith(".js") else b"\n"
+    return sep.join(parts)
+
+# processes building at the same time write their own temporary files,
+# and the complete file replaces the old one at once
+def _write(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
+# builds all bundles into "dist_dir", returns the manifest
+def build(dist_dir=DIST_DIR):
+    os.makedirs(dist_dir, exist_ok=True)
+    manifest = {}
+    for name, sources in BUNDLES.items():
+        data = _concat(name, sources)
+        root, ext = os.path.splitext(name)
+        filename = "{}.{}{}".format(root, hashlib.sha256(data).hexdigest()[:HASH_LENGTH], ext)
+        path = os.path.join(dist_dir, filename)
+        _write(path, data)
+        compressed = {".gz": gzip.compress(data, 9, mtime=0)}
+        if brotli is not None:
+            compressed[".br"] = brotli.compress(data)
+        for suffix, cdata in compressed.items():
+            if len(cdata) <= len(data) * MIN_COMPRESSED_RATIO:
+                _write(path + suffix, cdata)
+        manifest[name] = filename
+    _write(os.path.join(dist_dir, MANIFEST_NAME), json.dumps(manifest, indent=4, sort_keys=True).encode("UTF-8"))
+    # files of previous builds are kept: pages rendered before the build may still refer to them
+    return manifest
+
+_manifest = None
+# directory of the build in use
+_dist_dir = None
+_manifest_lock = threading.Lock()
+
+# manifest of the build in "dist_dir", or None if there is no build of all BUNDLES
+def _read_manifest(dist_dir):
+    try:
+        with open(os.path.join(dist_dir, MANIFEST_NAME), encoding="UTF-8") as f:
+            manifest = json.load(f)
+    except OSError:
+        return None
+    # BUNDLES were changed since the build
+    if set(manifest) != set(BUNDLES):
+        return None
+    return manifest
+
+# the manifest is read once per process; assets are built if there is no build of all BUNDLES
+def get_manifest():
+    global _manifest, _dist_dir
+    if _manifest is None:
+        with _manifest_lock:
+            if _manifest is None:
+                dist_dir = DIST_DIR
+                manifest = _read_manifest(dist_dir)
+                if manifest is None:
+                    logger.warning("%s is missing or outdated, building assets", os.path.join(dist_dir, MANIFEST_NAME))
+                    try:
+                        manifest = build(dist_dir)
+                    except OSError as e:
+                        logger.warning("can't write to %s (%s), using a build in %s", dist_dir, e, FALLBACK_DIR)
+                        dist_dir = FALLBACK_DIR
+                        manifest = _read_manifest(dist_dir) or build(dist_dir)
+                _dist_dir = dist_dir
+                _manifest = manifest
+    return _manifest
+
+# URL of the bundle, e.g. asset_url("editor.js") -> "/assets/editor.3f2a9c1e0b7d.js"
+def asset_url(name):
+    return URL_PREFIX + get_manifest()[name]
+
+# chooses a file to send for a built file name and the accepted encodings (werkzeug's Accept)
+# returns (path, content encoding or None, mimetype), or None if there is no such file
+def resolve(filename, accept_encodings):
+    # only names from the manifest, so that nothing else can be read through this
+    if filename not in get_manifest().values():
+        return None
+    path = os.path.join(_dist_dir, filename)
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    for encoding, suffix in ENCODINGS:
+        # "gzip;q=0" refuses gzip
+        if accept_encodings[encoding] > 0 and os.path.exists(path + suffix):
+            return path + suffix, encoding, mimetype
+    return path, None, mimetype
+
+def main():
+    if sys.argv[1:] != ["build"]:
+        print("usage: python -m tagged.assets build")
+        sys.exit(2)
+    manifest = build()
+    for name, filename in sorted(manifest.items()):
+        print(name, "->", filename)
+    if brotli is None:
+        print("brotli is not installed, only .gz files were made")
+
+if __name__ == "__main__":
+    main()
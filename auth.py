@@ -6,6 +6,7 @@ import base64
 
 from . import common
 from . import flask_utils
+from . import sharding
 from .services import UserService, UserSearchException
 
 authapp = flask.Blueprint("authapp", __name__, template_folder="templates")
@@ -87,6 +88,7 @@ def signup_page():
         userdata = us.get_by_name(username)
         if userdata is not None:
             return flask.render_template("unauthorizedmessage.html", message="Это имя пользователя занято")
-        us.create_user(username, password1)
+        userid = us.create_user(username, password1)
+        sharding.assign_shard(con, userid)
         return flask.render_template("unauthorizedmessage.html", message="Пользователь зарегистрирован, теперь вы можете авторизоваться")
 
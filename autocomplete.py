@@ -0,0 +1,124 @@
+# Autocomplete of tags and note titles.
+# Independent from flask.
+#
+# Every user gets an in-memory index of their tags and titles (sorted arrays, searched with bisect),
+# built on the first request and kept in an LRU cache shared by all users.
+# The index remembers the user's data version (see NoteService.get_data_version):
+# writes of this process update it in place (apply_changes), a write made elsewhere
+# changes the version and the index is built again.
+
+import bisect
+import heapq
+import os
+import threading
+
+from .cache import LRUCache
+
+# number of users whose indexes are kept in memory
+CACHE_SIZE = int(os.environ.get("TAGGED_AUTOCOMPLETE_USERS", "1000"))
+
+# suggestions of a prefix with more matches than this are remembered until a text
+# starting with the prefix changes, so that short prefixes don't rank all texts on every request
+MAX_SCAN = 1000
+
+SUGGESTIONS = 10
+
+# greater than any character, ends the range of texts starting with a prefix
+_LAST_CHAR = "\U0010ffff"
+
+# sorted array of (lowercase text, text) with a count for every text
+class PrefixIndex:
+
+    def __init__(self, counts):
+        self.counts = dict(counts)
+        self.keys = sorted((text.lower(), text) for text in self.counts)
+        # prefix -> SUGGESTIONS best texts, for prefixes with more than MAX_SCAN matches
+        self._top = {}
+
+    def add(self, text, delta):
+        count = self.counts.get(text, 0) + delta
+        key = (text.lower(), text)
+        if count > 0:
+            if text not in self.counts:
+                bisect.insort(self.keys, key)
+            self.counts[text] = count
+        elif text in self.counts:
+            del self.counts[text]
+            i = bisect.bisect_left(self.keys, key)
+            del self.keys[i]
+        if self._top:
+            for i in range(1, len(key[0]) + 1):
+                self._top.pop(key[0][:i], None)
+
+    # more frequent texts first, equal ones in alphabetical order
+    def _rank(self, key):
+        return (-self.counts[key[1]], key)
+
+    # texts starting with the prefix (case-insensitive), most frequent first
+    def suggest(self, prefix, limit=SUGGESTIONS):
+        prefix = prefix.lower()
+        if limit <= SUGGESTIONS and prefix in self._top:
+            return self._top[prefix][:limit]
+        i = bisect.bisect_left(self.keys, (prefix,))
+        j = bisect.bisect_left(self.keys, (prefix + _LAST_CHAR,), i)
+        if j - i <= MAX_SCAN:
+            return [text for lower, text in sorted(self.keys[i:j], key=self._rank)[:limit]]
+        best = [text for lower, text in heapq.nsmallest(max(limit, SUGGESTIONS), self.keys[i:j], key=self._rank)]
+        self._top[prefix] = best[:SUGGESTIONS]
+        return best[:limit]
+
+class UserIndex:
+
+    def __init__(self, version, tag_counts, title_counts):
+        self.version = version
+        self.tags = PrefixIndex(tag_counts)
+        self.titles = PrefixIndex(title_counts)
+        self.lock = threading.Lock()
+
+    def suggest(self, prefix, limit=SUGGESTIONS):
+        with self.lock:
+            return {
+                "tags": self.tags.suggest(prefix, limit),
+                "titles": self.titles.suggest(prefix, limit),
+            }
+
+indexes = LRUCache(CACHE_SIZE)
+
+# index of the user, up to date with "version" (the user's data version read by the request) or newer
+# "ns" is a NoteService connected to the user's shard
+# a new index gets the version read in the same transaction as its rows:
+# a write committed after "version" was read may already be in them
+def get_index(ns, userid, version):
+    index = indexes.get(userid)
+    if index is None or index.version < version:
+        with ns.snapshot():
+            version = ns.get_data_version(userid)[0]
+            index = UserIndex(version, ns.find_tag_counts(userid), ns.find_title_counts(userid))
+        indexes.set(userid, index)
+    return index
+
+# called after a write of the user's notes is committed
+# "version" is the data version after the write, changes are mappings text -> difference of its count
+def apply_changes(userid, version, tag_changes, title_changes):
+    index = indexes.get(userid)
+    if index is None:
+        return
+    with index.lock:
+        # already built after the write
+        if index.version >= version:
+            return
+        # the index has missed another write, it will be built again
+        if index.version != version - 1:
+            indexes.pop(userid)
+            return
+        for tag, delta in tag_changes.items():
+            index.tags.add(tag, delta)
+        for title, delta in title_changes.items():
+            index.titles.add(title, delta)
+        index.version = version
+
+def invalidate(userid=None):
+    if userid is None:
+        indexes.clear()
+    else:
+        indexes.pop(userid)
@@ -0,0 +1,198 @@
+# streaming export (backup) of notes and incremental import of such backups
+# Independent from flask.
+
+import codecs
+import json
+import os
+import zlib
+
+from . import common
+from . import sharding
+from .services import NoteService
+
+# how many notes are fetched from database and serialized at once
+EXPORT_CHUNK_SIZE = 500
+
+FORMATS = ("json", "ndjson")
+
+# how many notes are inserted with one executemany() on import
+IMPORT_BATCH_SIZE = int(os.environ.get("TAGGED_IMPORT_BATCH_SIZE", "1000"))
+
+# how many bytes of uploaded file are read at once
+READ_SIZE = 64 * 1024
+
+# fields of a note in backup file
+NOTE_FIELDS = ("title", "contents", "date_created", "tags", "date_modified")
+
+class BackupFormatException(Exception):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+# yields export of all user's notes as text chunks
+# "json" is a JSON array of notes (the format accepted by upload),
+# "ndjson" is one JSON object per line
+# the response is generated after the request handler returns and may be read by a slow client for long,
+# so the notes are read through a connection of its own rather than one of the pool
+# "progress" is called with the number of exported notes after every chunk
+def export_notes(userid, fmt="json", chunk_size=EXPORT_CHUNK_SIZE, progress=None):
+    with common.get_con() as con:
+        shard = sharding.get_shard(con, userid)
+    sharding.prepare_shard(shard)
+    ucon = common.get_connection(sharding.shard_path(shard))
+    try:
+        ns = NoteService(ucon)
+        if fmt == "json":
+            yield "["
+        sep = ""
+        chunk = []
+        count = 0
+        for note in ns.iter_notes(userid, chunk_size):
+            if fmt == "json":
+                chunk.append(sep)
+                sep = ","
+            chunk.append(json.dumps(note))
+            if fmt == "ndjson":
+                chunk.append("\n")
+            count += 1
+            if len(chunk) >= chunk_size:
+                yield "".join(chunk)
+                chunk = []
+                if progress is not None:
+                    progress(count)
+        if chunk:
+            yield "".join(chunk)
+        if progress is not None:
+            progress(count)
+        if fmt == "json":
+            yield "]"
+    finally:
+        ucon.close()
+
+# compresses text chunks into a gzip stream on the fly
+def gzip_chunks(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("UTF-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+# yields records of a backup read from binary stream piece by piece
+# both JSON array and NDJSON are accepted, the format is detected by the first character
+# a record which is not valid JSON (in NDJSON) is yielded as None
+def iter_records(stream):
+    decoder = codecs.getincrementaldecoder("UTF-8")()
+    buf = ""
+    eof = False
+    while not buf.lstrip() and not eof:
+        data = stream.read(READ_SIZE)
+        eof = not data
+        buf += decoder.decode(data, final=eof)
+    buf = buf.lstrip()
+    if buf.startswith("\ufeff"):
+        buf = buf[1:]
+    if not buf:
+        return
+    if buf[0] == "[":
+        yield from _iter_array(stream, decoder, buf[1:], eof)
+    else:
+        yield from _iter_lines(stream, decoder, buf, eof)
+
+# the longest piece of valid JSON which gives an error when the buffer ends inside it, "\ud83d\ude00"
+MAX_CUT_LENGTH = 12
+
+# whether a decode error may be caused by the buffer ending inside a value, rather than by invalid JSON:
+# then more data must be read, otherwise the file is rejected without reading the rest of it
+def _cut_off(e, buf):
+    return e.msg.startswith("Unterminated string") or len(buf) - e.pos <= MAX_CUT_LENGTH
+
+def _iter_array(stream, decoder, buf, eof):
+    json_decoder = json.JSONDecoder()
+    pos = 0
+    expect_value = True
+    read_size = READ_SIZE
+    while True:
+        # skip whitespace and separators
+        while pos < len(buf) and buf[pos] in " \t\r\n":
+            pos += 1
+        if pos < len(buf):
+            c = buf[pos]
+            if c == "]":
+                return
+            if not expect_value:
+                if c != ",":
+                    raise BackupFormatException("',' expected")
+                pos += 1
+                expect_value = True
+                continue
+            try:
+                record, end = json_decoder.raw_decode(buf, pos)
+                # a value which ends with the buffer may be incomplete: a number may go on
+                # with more digits, a fraction or an exponent
+                if eof or buf[end:].lstrip("0123456789.eE+-"):
+                    yield record
+                    pos = end
+                    expect_value = False
+                    continue
+            except json.JSONDecodeError as e:
+                if eof or not _cut_off(e, buf):
+                    raise BackupFormatException("invalid JSON")
+        elif eof:
+            raise BackupFormatException("unexpected end of file")
+        # need more data: drop what was parsed, read the next piece
+        buf = buf[pos:]
+        pos = 0
+        data = stream.read(read_size)
+        eof = not data
+        buf += decoder.decode(data, final=eof)
+        # a huge record is parsed again after each read, so read more each time
+        read_size = min(read_size * 2, 64 * READ_SIZE)
+
+def _iter_lines(stream, decoder, buf, eof):
+    while True:
+        lines = buf.split("\n")
+        buf = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield _parse_line(line)
+        if eof:
+            break
+        data = stream.read(READ_SIZE)
+        eof = not data
+        buf += decoder.decode(data, final=eof)
+    if buf.strip():
+        yield _parse_line(buf)
+
+def _parse_line(line):
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError:
+        return None
+
+# a valid record is a dict with string fields NOTE_FIELDS and valid tags
+def validate_record(record):
+    if not isinstance(record, dict):
+        return False
+    for field in NOTE_FIELDS:
+        if not isinstance(record.get(field), str):
+            return False
+    return all(map(common.validate_tag, record["tags"].split()))
+
+# imports a backup from binary stream into user's notes
+# "con" is a connection to the user's shard
+# the notes are imported in one transaction: after an error in the file none of them are
+# returns (number of imported notes, number of rejected records)
+def import_notes(con, userid, stream, batch_size=IMPORT_BATCH_SIZE):
+    rejected = 0
+
+    def valid_records():
+        nonlocal rejected
+        for record in iter_records(stream):
+            if validate_record(record):
+                yield record
+            else:
+                rejected += 1
+
+    ns = NoteService(con)
+    imported = ns.upload(userid, valid_records(), batch_size)
+    return imported, rejected
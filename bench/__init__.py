@@ -0,0 +1,3 @@
+# Benchmarks of the site:
+# corpus.py generates a database with synthetic users and notes,
+# driver.py measures latency of site pages on such database and compares it with a baseline.
@@ -0,0 +1,83 @@
+# Deterministic generator of a synthetic database:
+# N users, M notes per user, K distinct tags.
+# The same arguments always give the same database.
+#
+# usage: python -m tagged.bench.corpus bench.db --users 2 --notes 1000 --tags 50
+
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+
+from .. import migrations
+from ..services import UserService, NoteService
+
+WORDS = ("note", "tag", "python", "sqlite", "flask", "server", "index", "cache", "query", "page",
+    "list", "search", "export", "import", "markdown", "draft", "version", "session", "user", "title",
+    "заметка", "метка", "поиск", "список", "текст", "база", "данные", "страница", "запрос", "файл")
+
+# password of every generated user
+PASSWORD = "password"
+
+def username(i):
+    return "user{}".format(i)
+
+def _text(rnd, nwords):
+    return " ".join(rnd.choice(WORDS) for _ in range(nwords))
+
+def _contents(rnd, paragraphs):
+    parts = []
+    for i in range(paragraphs):
+        if i % 3 == 0:
+            parts.append("## " + _text(rnd, 3))
+        parts.append(_text(rnd, rnd.randint(20, 80)))
+    return "\n\n".join(parts)
+
+# yields notes of one user in the format accepted by NoteService.upload
+def _notes(rnd, nnotes, tags, base_date):
+    for i in range(nnotes):
+        created = base_date + datetime.timedelta(minutes=rnd.randint(0, 60 * 24 * 365))
+        modified = created + datetime.timedelta(minutes=rnd.randint(0, 60 * 24 * 30))
+        # a few tags are popular, most are rare
+        ntags = rnd.randint(0, 5)
+        note_tags = []
+        for _ in range(ntags):
+            tag = tags[min(int(rnd.paretovariate(1.2)) - 1, len(tags) - 1)]
+            if tag not in note_tags:
+                note_tags.append(tag)
+        yield {
+            "title": _text(rnd, rnd.randint(1, 6)),
+            "contents": _contents(rnd, rnd.randint(1, 8)),
+            "date_created": created.strftime("%Y-%m-%d %H:%M:%S"),
+            "tags": " ".join(note_tags),
+            "date_modified": modified.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+def generate(path, users, notes, tags, seed=0):
+    rnd = random.Random(seed)
+    tag_names = ["tag{}".format(i) for i in range(tags)]
+    base_date = datetime.datetime(2020, 1, 1)
+    if os.path.exists(path):
+        raise FileExistsError(path)
+    con = sqlite3.connect(path)
+    try:
+        migrations.upgrade(con)
+        us = UserService(con)
+        ns = NoteService(con)
+        for i in range(users):
+            us.create_user(username(i), PASSWORD)
+            userid = us.get_by_name(username(i))["id"]
+            ns.upload(userid, _notes(rnd, notes, tag_names, base_date))
+    finally:
+        con.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic database")
+    parser.add_argument("path")
+    parser.add_argument("--users", type=int, default=2)
+    parser.add_argument("--notes", type=int, default=1000, help="notes per user")
+    parser.add_argument("--tags", type=int, default=50, help="number of distinct tags")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    generate(args.path, args.users, args.notes, args.tags, args.seed)
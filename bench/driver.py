@@ -0,0 +1,205 @@
+# Benchmark driver: runs site pages through Flask test client
+# and reports p50/p95/p99 latency and throughput of every route and peak RSS of the process.
+# Results can be saved as a baseline and compared with it later.
+#
+# usage: python -m tagged.bench.driver --baseline tagged/bench/baseline.json
+#        python -m tagged.bench.driver --save-baseline tagged/bench/baseline.json
+
+import argparse
+import io
+import json
+import math
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from . import corpus
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# a route is (name, method, url, form data); urls may contain {noteid} and {keyword}/{tag}
+ROUTES = (
+    ("index", "GET", "/", None),
+    ("all", "GET", "/all", None),
+    ("search_keywords", "GET", "/search/results?keywords={keyword}", None),
+    ("search_tags", "GET", "/search/results?tags={tag}", None),
+    ("note", "GET", "/note/{noteid}", None),
+    ("new_form", "GET", "/new", None),
+    ("new", "POST", "/new", {"title": "bench note", "contents": "bench *contents*", "tags": "bench tag0"}),
+    ("edit_form", "GET", "/edit/{noteid}", None),
+    ("edit", "POST", "/edit/{noteid}", {"title": "bench edit", "contents": "edited *contents*", "tags": "bench tag1"}),
+    ("export_download", "GET", "/export/download", None),
+    ("export_upload", "POST", "/export/upload", None),
+)
+
+# size of the file uploaded by "export_upload"
+UPLOAD_NOTES = 20
+
+# "export_upload" is measured until its import job is finished, its status is checked this often (seconds)
+JOB_POLL_INTERVAL = 0.002
+
+# nearest-rank percentile: the smallest value which at least p% of values are not greater than
+def percentile(values, p):
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+# peak RSS of this process; the corpus is generated by another process, so it's not counted
+def peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    if sys.platform == "darwin":
+        rss //= 1024
+    return rss
+
+def _upload_file():
+    notes = [{
+        "title": "uploaded {}".format(i),
+        "contents": "uploaded contents",
+        "date_created": "2020-01-01 00:00:00",
+        "tags": "uploaded",
+        "date_modified": "2020-01-01 00:00:00",
+    } for i in range(UPLOAD_NOTES)]
+    return json.dumps(notes).encode("UTF-8")
+
+def run(db_path, iterations, routes=None):
+    from .. import common
+    from .. import sharding
+    from ..services import UserService
+    common.configure(path=db_path)
+    from .. import app
+
+    client = app.test_client()
+    resp = client.post("/login", data={"username": corpus.username(0), "password": corpus.PASSWORD})
+    if resp.status_code != 302:
+        raise RuntimeError("login failed")
+    from .. import jobs
+    with common.get_con() as con:
+        userid = UserService(con).get_by_name(corpus.username(0))["id"]
+        with sharding.get_user_con(con, userid) as ucon:
+            cur = ucon.cursor()
+            cur.execute("""SELECT id FROM notes WHERE userid = ? ORDER BY id LIMIT 1""", (userid,))
+            noteid = cur.fetchone()[0]
+    params = {"noteid": noteid, "keyword": corpus.WORDS[0], "tag": "tag0"}
+    upload = _upload_file()
+
+    results = {}
+    try:
+        for name, method, url, data in ROUTES:
+            if routes and name not in routes:
+                continue
+            url = url.format(**params)
+            timings = []
+            started = time.perf_counter()
+            for _ in range(iterations):
+                t = time.perf_counter()
+                if name == "export_upload":
+                    resp = client.post(url, data={"file": (io.BytesIO(upload), "notes.json")})
+                elif method == "POST":
+                    resp = client.post(url, data=data)
+                else:
+                    resp = client.get(url)
+                # read streamed responses to the end
+                resp.get_data()
+                if resp.status_code >= 400:
+                    raise RuntimeError("{} {} returned {}".format(method, url, resp.status_code))
+                if name == "export_upload":
+                    _wait_for_job(client, resp)
+                timings.append(time.perf_counter() - t)
+            total = time.perf_counter() - started
+            results[name] = {
+                "n": iterations,
+                "p50_ms": round(percentile(timings, 50) * 1000, 3),
+                "p95_ms": round(percentile(timings, 95) * 1000, 3),
+                "p99_ms": round(percentile(timings, 99) * 1000, 3),
+                "rps": round(iterations / total, 1),
+            }
+    finally:
+        # the database and the job files are deleted after the run
+        jobs.runner.stop()
+    return {"routes": results, "peak_rss_kb": peak_rss_kb()}
+
+# waits until the job an upload was redirected to is finished
+def _wait_for_job(client, resp):
+    from .. import jobs
+    jobid = resp.headers["Location"].rstrip("/").rsplit("/", 1)[-1]
+    while True:
+        job = client.get("/api/jobs/" + jobid).get_json()
+        if job["status"] == jobs.DONE:
+            return
+        if job["status"] == jobs.FAILED:
+            raise RuntimeError("import job {} failed: {}".format(jobid, job["error"]))
+        time.sleep(JOB_POLL_INTERVAL)
+
+# returns a list of regressions: strings describing metrics which are worse than in baseline
+# by more than "threshold" (0.2 = 20%)
+def compare(results, baseline, threshold=0.2, rss_threshold=0.2):
+    regressions = []
+    for name, base in baseline["routes"].items():
+        cur = results["routes"].get(name)
+        if cur is None:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms"):
+            if cur[metric] > base[metric] * (1 + threshold):
+                regressions.append("{} {}: {:.2f} > {:.2f}".format(name, metric, cur[metric], base[metric]))
+    if results["peak_rss_kb"] > baseline["peak_rss_kb"] * (1 + rss_threshold):
+        regressions.append("peak_rss_kb: {} > {}".format(results["peak_rss_kb"], baseline["peak_rss_kb"]))
+    return regressions
+
+def print_results(results):
+    print("{:<18} {:>10} {:>10} {:>10} {:>10}".format("route", "p50 ms", "p95 ms", "p99 ms", "req/s"))
+    for name, r in results["routes"].items():
+        print("{:<18} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.1f}".format(name, r["p50_ms"], r["p95_ms"], r["p99_ms"], r["rps"]))
+    print("peak RSS: {} KB".format(results["peak_rss_kb"]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark site pages")
+    parser.add_argument("--db", help="existing database made by bench.corpus (a copy is used); generated if not given")
+    parser.add_argument("--users", type=int, default=2)
+    parser.add_argument("--notes", type=int, default=2000, help="notes per user")
+    parser.add_argument("--tags", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--iterations", type=int, default=50, help="requests per route")
+    parser.add_argument("--route", action="append", help="run only this route (can be repeated)")
+    parser.add_argument("--out", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare results with this JSON file")
+    parser.add_argument("--save-baseline", help="write results as a new baseline to this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed latency regression (0.2 = 20%%)")
+    parser.add_argument("--rss-threshold", type=float, default=0.2, help="allowed peak RSS regression")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="tagged-bench-")
+    try:
+        db_path = os.path.join(tmpdir, "bench.db")
+        if args.db:
+            shutil.copy(args.db, db_path)
+        else:
+            subprocess.run([sys.executable, "-m", corpus.__name__, db_path, "--users", str(args.users),
+                "--notes", str(args.notes), "--tags", str(args.tags), "--seed", str(args.seed)], check=True)
+        results = run(db_path, args.iterations, args.route)
+    finally:
+        shutil.rmtree(tmpdir)
+    results["params"] = {
+        "users": args.users, "notes": args.notes, "tags": args.tags,
+        "seed": args.seed, "iterations": args.iterations,
+    }
+
+    print_results(results)
+    for path in (args.out, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=4)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.rss_threshold)
+        for r in regressions:
+            print("REGRESSION:", r)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+# In-process caches used by services.
+# Independent from flask.
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# a bounded mapping with least-recently-used eviction
+# entries also expire "ttl" seconds after they were set (if ttl is given)
+#
+# "generation" changes on every pop() and clear(): a value read from its source must be cached with
+# set_unless_invalidated() and the generation read before the source, so that a value read before
+# an invalidation isn't cached after it
+class LRUCache:
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._set(key, value)
+
+    # returns False if the value was not set
+    def set_unless_invalidated(self, key, value, generation):
+        with self._lock:
+            if self.generation != generation:
+                return False
+            self._set(key, value)
+            return True
+
+    def _set(self, key, value):
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            self.generation += 1
+            entry = self._data.pop(key, None)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+# invalidation messages shared between processes through an append-only file
+# publish() appends a key, poll() returns keys appended since the last poll
+# (it costs one stat() call when nothing has changed)
+class FileInvalidationChannel:
+
+    # the file is replaced with an empty one when it grows larger than this
+    MAX_SIZE = 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._inode = None
+        self._offset = 0
+        # skip messages published before this process started
+        try:
+            st = os.stat(path)
+            self._inode = st.st_ino
+            self._offset = st.st_size
+        except FileNotFoundError:
+            pass
+
+    def publish(self, key):
+        # a single short write with O_APPEND is atomic
+        with open(self.path, "a", encoding="UTF-8") as f:
+            f.write(key + "\n")
+            if f.tell() > self.MAX_SIZE:
+                tmp = self.path + ".tmp"
+                open(tmp, "w").close()
+                os.replace(tmp, self.path)
+
+    # returns a list of published keys,
+    # or None when the file was replaced and everything must be invalidated
+    def poll(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return []
+        with self._lock:
+            if st.st_ino != self._inode:
+                rotated = self._inode is not None
+                self._inode = st.st_ino
+                self._offset = 0
+                if rotated:
+                    return None
+            if st.st_size <= self._offset:
+                return []
+            with open(self.path, "rb") as f:
+                f.seek(self._offset)
+                data = f.read(st.st_size - self._offset)
+            # keep an unfinished line for the next poll
+            end = data.rfind(b"\n") + 1
+            self._offset += end
+            return data[:end].decode("UTF-8").split()
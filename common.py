@@ -4,22 +4,143 @@ import flask
 import sqlite3
 import random
 import json
+import os
+import calendar
+import time
+import queue
+import threading
 from contextlib import contextmanager
 
+from . import metrics
+from . import compression
+
+# path to the database file
+DB_PATH = os.environ.get("TAGGED_DB", "tagged.db")
+
+# max number of open connections per database file
+POOL_SIZE = int(os.environ.get("TAGGED_POOL_SIZE", "8"))
+
+# how long (in seconds) to wait for a free connection when the pool is exhausted
+POOL_TIMEOUT = 30
+
+# number of prepared statements cached by each connection
+STATEMENT_CACHE_SIZE = 256
+
+# PRAGMAs applied to every new connection:
+# WAL lets readers work alongside a writer,
+# synchronous=NORMAL is durable enough in WAL mode and avoids fsync on every commit
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA busy_timeout=5000",
+)
+
+class PoolTimeout(Exception):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
 # make a new connection to database
-def get_connection():
-    return sqlite3.connect("tagged.db")
+def get_connection(path=None):
+    con = sqlite3.connect(path or DB_PATH, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE,
+        factory=metrics.TimedConnection)
+    con.set_trace_callback(metrics.trace)
+    compression.register_functions(con)
+    for pragma in CONNECTION_PRAGMAS:
+        con.execute(pragma)
+    return con
+
+# a bounded pool of connections to one database file
+# connections are kept open between requests,
+# so their statement caches and page caches stay warm
+class ConnectionPool:
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def acquire(self, timeout=POOL_TIMEOUT):
+        if not self._slots.acquire(timeout=timeout):
+            raise PoolTimeout("no free connection to {}".format(self.path))
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return get_connection(self.path)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, con):
+        try:
+            # never hand out a connection with an unfinished transaction
+            if con.in_transaction:
+                con.rollback()
+            self._idle.put(con)
+        except sqlite3.Error:
+            con.close()
+        finally:
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(path=None):
+    path = path or DB_PATH
+    with _pools_lock:
+        pool = _pools.get(path)
+        if pool is None:
+            pool = _pools[path] = ConnectionPool(path, POOL_SIZE)
+        return pool
+
+# change database path and/or pool size, closing idle connections of old pools
+def configure(path=None, pool_size=None):
+    global DB_PATH, POOL_SIZE
+    if path is not None:
+        DB_PATH = path
+    if pool_size is not None:
+        POOL_SIZE = pool_size
+    close_pools()
+
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
 
 # a context manager (with-block) for database connection
+# the connection is taken from the pool and returned there afterwards
 @contextmanager
-def get_con():
-    con = None
+def get_con(path=None):
+    pool = get_pool(path)
+    con = pool.acquire()
     try:
-        con = get_connection()
         yield con
     finally:
-        if con is not None:
-            con.close()
+        pool.release(con)
+
+# format of date_created/date_modified of notes
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# date string (local time) to integer timestamp used for ordering notes
+# the date is treated as UTC, the same way as sqlite's strftime('%s', ...) does
+# returns 0 for malformed dates
+def date_to_ts(s):
+    try:
+        return calendar.timegm(time.strptime(s, DATE_FORMAT))
+    except ValueError:
+        return 0
 
 # fetches one row from MySQL cursor object
 # makes a dict from it
@@ -38,6 +159,12 @@ def fetchall_as_dict(cur):
         rows.append(row)
     return rows
 
+# fetches all rows from cursor object
+# makes a list of records of class "cls" (see records.py) from it
+def fetchall_as(cur, cls):
+    colnames = [descr[0] for descr in cur.description]
+    return cls.from_rows(colnames, cur.fetchall())
+
 # generate a session token
 # a token is a string of 20 alphanumeric chars
 # TODO: replace random.choice() with more cryptographically safe algorithm
@@ -0,0 +1,137 @@
+# Transparent compression of large note bodies in the database.
+# Independent from flask.
+#
+# Texts shorter than MIN_SIZE bytes are stored as TEXT as before.
+# Longer ones are stored as BLOBs: a 4-byte marker of the format followed by compressed UTF-8.
+# pack() makes the value to store, unpack() turns any stored value back into text.
+# In SQL, contents_text(column) does the same as unpack() (see register_functions).
+
+import os
+import sqlite3
+import zlib
+
+# zstandard is optional: without it zlib is used
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZLIB_MARKER = b"\x00zl1"
+ZSTD_MARKER = b"\x00zs1"
+MARKER_SIZE = 4
+
+MIN_SIZE = int(os.environ.get("TAGGED_COMPRESS_MIN_SIZE", "4096"))
+LEVEL = int(os.environ.get("TAGGED_COMPRESS_LEVEL", "6"))
+
+CODECS = ("zlib", "zstd")
+CODEC = os.environ.get("TAGGED_COMPRESS_CODEC", "zlib")
+if CODEC not in CODECS:
+    raise ValueError("TAGGED_COMPRESS_CODEC must be one of: " + ", ".join(CODECS))
+if CODEC == "zstd" and zstandard is None:
+    raise ValueError("TAGGED_COMPRESS_CODEC=zstd needs the zstandard package")
+
+# compressed copies which don't save at least this share are not used
+MIN_SAVING = 0.1
+
+def is_packed(value):
+    return isinstance(value, bytes)
+
+def pack(text):
+    data = text.encode("UTF-8")
+    if len(data) < MIN_SIZE:
+        return text
+    if CODEC == "zstd":
+        packed = ZSTD_MARKER + zstandard.ZstdCompressor(level=LEVEL).compress(data)
+    else:
+        packed = ZLIB_MARKER + zlib.compress(data, LEVEL)
+    if len(packed) > len(data) * (1 - MIN_SAVING):
+        return text
+    return packed
+
+def unpack(value):
+    if not isinstance(value, bytes):
+        return value
+    marker = value[:MARKER_SIZE]
+    if marker == ZLIB_MARKER:
+        data = zlib.decompress(value[MARKER_SIZE:])
+    elif marker == ZSTD_MARKER:
+        if zstandard is None:
+            raise ValueError("note is compressed with zstd, the zstandard package is needed")
+        data = zstandard.ZstdDecompressor().decompress(value[MARKER_SIZE:])
+    else:
+        # not ours, a BLOB written by someone else
+        data = value
+    return data.decode("UTF-8")
+
+# makes contents_text() available in SQL of the connection,
+# e.g. for "contents_text(notes.contents) LIKE ?"
+def register_functions(con):
+    con.create_function("contents_text", 1, unpack, deterministic=True)
+
+# compresses stored notes which are large enough and are not compressed yet
+# doesn't commit; returns the number of updated notes
+def compress_notes(con, batch_size=500):
+    cur = con.cursor()
+    cur.execute("""SELECT id FROM notes
+        WHERE (typeof(contents) = 'text' AND length(CAST(contents AS BLOB)) >= ?)
+        OR (typeof(contents_html) = 'text' AND length(CAST(contents_html AS BLOB)) >= ?)""", (MIN_SIZE, MIN_SIZE))
+    noteids = [row[0] for row in cur.fetchall()]
+    updated = 0
+    for i in range(0, len(noteids), batch_size):
+        batch = noteids[i:i + batch_size]
+        cur.execute("SELECT id, contents, contents_html FROM notes WHERE id IN (" + ",".join(["?"] * len(batch)) + ")", batch)
+        changes = []
+        for noteid, contents, contents_html in cur.fetchall():
+            new_contents, new_html = _repack(contents), _repack(contents_html)
+            # texts which don't compress well stay as they are
+            if new_contents is not contents or new_html is not contents_html:
+                changes.append((new_contents, new_html, noteid))
+        cur.executemany("""UPDATE notes SET contents=?, contents_html=? WHERE id=?""", changes)
+        updated += len(changes)
+    cur.close()
+    return updated
+
+def _repack(value):
+    if value is None or is_packed(value):
+        return value
+    return pack(value)
+
+# space used by note bodies: dict with numbers of notes, compressed notes,
+# stored bytes and bytes the bodies would take uncompressed,
+# bytes of the full-text index (None if this sqlite build has no "dbstat" table) and of the whole database
+def compression_stats(con):
+    cur = con.cursor()
+    cur.execute("""SELECT count(*),
+        coalesce(sum(typeof(contents) = 'blob'), 0),
+        coalesce(sum(length(CAST(contents AS BLOB)) + length(CAST(contents_html AS BLOB))), 0)
+        FROM notes""")
+    notes, compressed, stored = cur.fetchone()
+    cur.execute("""SELECT contents, contents_html FROM notes WHERE typeof(contents) = 'blob' OR typeof(contents_html) = 'blob'""")
+    saved = 0
+    while True:
+        rows = cur.fetchmany(500)
+        if not rows:
+            break
+        for row in rows:
+            for value in row:
+                if is_packed(value):
+                    saved += len(unpack(value).encode("UTF-8")) - len(value)
+    try:
+        # notes_fts and its shadow tables
+        cur.execute("""SELECT coalesce(sum(pgsize), 0) FROM dbstat WHERE name = 'notes_fts' OR name GLOB 'notes_fts_*'""")
+        fts = cur.fetchone()[0]
+    except sqlite3.OperationalError:
+        fts = None
+    cur.execute("PRAGMA page_count")
+    page_count = cur.fetchone()[0]
+    cur.execute("PRAGMA page_size")
+    page_size = cur.fetchone()[0]
+    cur.close()
+    return {
+        "notes": notes,
+        "compressed": compressed,
+        "stored_bytes": stored,
+        "uncompressed_bytes": stored + saved,
+        "fts_bytes": fts,
+        "database_bytes": page_count * page_size,
+    }
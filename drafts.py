@@ -0,0 +1,190 @@
+# Autosave of drafts through a write-behind queue.
+# Independent from flask.
+#
+# The editor saves a draft every few seconds while the user types.
+# Saves are put into a queue instead of being written at once; repeated saves of the same draft
+# replace each other in the queue, and a background thread writes everything queued
+# in one transaction per shard (group commit): every FLUSH_INTERVAL seconds, or earlier
+# when FLUSH_SIZE drafts are queued. So many users produce one commit per interval
+# instead of one commit per save.
+#
+# DURABILITY sets what save() guarantees when it returns:
+#     "async"  - the draft is queued; it's lost if the process dies before the next flush
+#     "commit" - the draft is committed (waits for the flush, at most FLUSH_INTERVAL)
+#     "fsync"  - like "commit", and the commit is synced to disk (PRAGMA synchronous=FULL),
+#                so it survives a power loss too
+
+import atexit
+import datetime
+import logging
+import os
+import threading
+import time
+
+from . import common
+from . import sharding
+from .services import NoteService
+
+logger = logging.getLogger(__name__)
+
+DURABILITY_LEVELS = ("async", "commit", "fsync")
+
+DURABILITY = os.environ.get("TAGGED_DRAFT_DURABILITY", "async")
+if DURABILITY not in DURABILITY_LEVELS:
+    raise ValueError("TAGGED_DRAFT_DURABILITY must be one of: " + ", ".join(DURABILITY_LEVELS))
+
+FLUSH_INTERVAL = float(os.environ.get("TAGGED_DRAFT_FLUSH_INTERVAL", "0.2"))
+FLUSH_SIZE = int(os.environ.get("TAGGED_DRAFT_FLUSH_SIZE", "500"))
+
+# how long save() waits for the flush with "commit"/"fsync" durability
+SAVE_TIMEOUT = 30
+
+class DraftSaveException(Exception):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+# drafts written by one flush; savers wait for it to be done
+class _Batch:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+class DraftWriter:
+
+    def __init__(self, interval=FLUSH_INTERVAL, size=FLUSH_SIZE, durability=DURABILITY):
+        self.interval = interval
+        self.size = size
+        self.durability = durability
+        # (userid, noteid) -> (userid, noteid, title, contents, tags, saved_ts)
+        self._pending = {}
+        self._batch = _Batch()
+        self._cond = threading.Condition()
+        # held while a flush writes to database
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+        self.saves = 0
+        self.flushes = 0
+        self.written = 0
+
+    def save(self, userid, noteid, title, contents, tags):
+        # same clock as notes.modified_ts, so that the draft can be compared with the note
+        now = datetime.datetime.strftime(datetime.datetime.now(), common.DATE_FORMAT)
+        draft = (userid, noteid, title, contents, tags, common.date_to_ts(now))
+        with self._cond:
+            self._start()
+            self._pending[(userid, noteid)] = draft
+            self.saves += 1
+            batch = self._batch
+            # wakes up the writer waiting for the first draft or for a full queue
+            self._cond.notify()
+        if self.durability == "async":
+            return
+        if not batch.done.wait(SAVE_TIMEOUT):
+            raise DraftSaveException("draft was not written in {} seconds".format(SAVE_TIMEOUT))
+        if batch.error is not None:
+            raise DraftSaveException("draft was not written") from batch.error
+
+    # forgets a queued draft; when it returns, the draft won't be written by a later flush
+    # called before the note is saved (saving the note deletes the draft from database)
+    def discard(self, userid, noteid):
+        with self._flush_lock:
+            with self._cond:
+                self._pending.pop((userid, noteid), None)
+
+    # the thread is started on first use
+    def _start(self):
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="draft-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    self._cond.wait()
+                if self._stopping and not self._pending:
+                    return
+                # collect more saves until the interval ends or the queue is large enough
+                deadline = time.monotonic() + self.interval
+                while len(self._pending) < self.size and not self._stopping:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            self.flush()
+
+    # writes all queued drafts, one transaction per shard
+    def flush(self):
+        with self._flush_lock:
+            with self._cond:
+                drafts = list(self._pending.values())
+                batch = self._batch
+                self._pending = {}
+                self._batch = _Batch()
+            try:
+                if drafts:
+                    self._write(drafts)
+                    self.flushes += 1
+                    self.written += len(drafts)
+            except Exception as e:
+                logger.exception("failed to write %d drafts", len(drafts))
+                batch.error = e
+            finally:
+                batch.done.set()
+
+    def _write(self, drafts):
+        by_shard = {}
+        with common.get_con() as con:
+            shards = {}
+            for draft in drafts:
+                userid = draft[0]
+                if userid not in shards:
+                    shards[userid] = sharding.get_shard(con, userid)
+                by_shard.setdefault(shards[userid], []).append(draft)
+        for shard, shard_drafts in by_shard.items():
+            sharding.prepare_shard(shard)
+            with common.get_con(sharding.shard_path(shard)) as con:
+                if self.durability == "fsync":
+                    con.execute("PRAGMA synchronous=FULL")
+                try:
+                    NoteService(con).save_drafts(shard_drafts)
+                finally:
+                    if self.durability == "fsync":
+                        con.execute("PRAGMA synchronous=NORMAL")
+
+    # writes queued drafts and stops the thread
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+        self._thread = None
+        self.flush()
+
+    # a child process after fork has no writer thread; the queue copied from the parent
+    # is the parent's to write
+    def _after_fork(self):
+        self._pending = {}
+        self._batch = _Batch()
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def stats(self):
+        return {
+            "pending": len(self._pending),
+            "saves": self.saves,
+            "flushes": self.flushes,
+            "written": self.written,
+            "durability": self.durability,
+        }
+
+writer = DraftWriter()
+atexit.register(writer.stop)
+os.register_at_fork(after_in_child=writer._after_fork)
@@ -2,8 +2,15 @@
 # Some utility functions/classes, related to flask
 
 import flask
-from .services import SessionService
+import datetime
+import hashlib
+import json
+import os
+from contextlib import ExitStack
+from .services import SessionService, NoteService
 from . import common
+from . import sharding
+from . import assets
 
 class NotAuthorized(Exception):
     def __init__(self, *args, **kwargs):
@@ -46,3 +53,72 @@ def get_logined_user_id(con):
         raise NotAuthorized()
     return userid
 
+# connection to the user's shard (see sharding), "con" is a connection to the main database
+# the connection is kept until the end of the request (see release_user_con)
+def get_user_con(con, userid):
+    ucon = flask.g.get("user_con")
+    if ucon is None:
+        stack = flask.g.user_con_stack = ExitStack()
+        ucon = flask.g.user_con = stack.enter_context(sharding.get_user_con(con, userid))
+    return ucon
+
+def get_note_service(con, userid):
+    return NoteService(get_user_con(con, userid))
+
+# called when the request is finished
+def release_user_con():
+    stack = flask.g.pop("user_con_stack", None)
+    flask.g.pop("user_con", None)
+    if stack is not None:
+        stack.close()
+
+# conditional GET
+# pages of a user depend only on user's data and templates,
+# so ETag/Last-Modified are built from user's data version (see NoteService.get_data_version)
+# only the ETag is checked: Last-Modified has a resolution of a second, and several writes may be made within one
+
+# changes when templates or static assets are changed
+# it's computed when the first page is made rather than on import, since the manifest may need a build of assets
+def templates_stamp():
+    global _templates_stamp
+    if _templates_stamp is None:
+        _templates_stamp = _make_templates_stamp()
+    return _templates_stamp
+
+_templates_stamp = None
+
+def _make_templates_stamp():
+    h = hashlib.md5()
+    folder = os.path.join(os.path.dirname(__file__), "templates")
+    for name in sorted(os.listdir(folder)):
+        st = os.stat(os.path.join(folder, name))
+        h.update("{}:{}:{};".format(name, st.st_mtime_ns, st.st_size).encode("UTF-8"))
+    # pages refer to built assets by names which change with their contents
+    h.update(json.dumps(assets.get_manifest(), sort_keys=True).encode("UTF-8"))
+    return h.hexdigest()[:8]
+
+# "variant" tells apart different bodies of the same URL, e.g. "gzip" for a body sent gzipped
+def make_etag(userid, version, variant=None):
+    etag = "{}-{}-{}".format(templates_stamp(), userid, version[0])
+    if variant is not None:
+        etag += "-" + variant
+    return etag
+
+# checks If-None-Match of the request,
+# returns a "304 Not Modified" response if the client's copy is up to date, otherwise None
+def not_modified(userid, version, variant=None):
+    if not flask.request.if_none_match.contains_weak(make_etag(userid, version, variant)):
+        return None
+    return set_validators(flask.make_response("", 304), userid, version, variant)
+
+# adds ETag/Last-Modified to the response
+def set_validators(resp, userid, version, variant=None):
+    resp = flask.make_response(resp)
+    resp.set_etag(make_etag(userid, version, variant))
+    if version[1] is not None:
+        resp.last_modified = datetime.datetime.fromtimestamp(version[1], datetime.timezone.utc)
+    # the page depends on the session cookie and must be revalidated every time
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+    resp.vary.add("Cookie")
+    return resp
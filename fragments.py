@@ -0,0 +1,130 @@
+# Cache of rendered HTML fragments of notes (e.g. a note in lists).
+# Independent from flask.
+#
+# A fragment is keyed by every field of the note it shows, so an entry never becomes stale:
+# a changed note gets a new key and the old entry is evicted by the LRU.
+# The memory tier keeps CACHE_SIZE fragments in every process. The optional disk tier
+# (TAGGED_FRAGMENT_CACHE_DB) is a SQLite file shared by processes and kept across restarts;
+# its keys also contain the templates stamp, so changed templates don't use old fragments.
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from . import common
+from .cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+CACHE_SIZE = int(os.environ.get("TAGGED_FRAGMENT_CACHE_SIZE", "20000"))
+
+# path of the disk tier, empty - no disk tier
+DISK_PATH = os.environ.get("TAGGED_FRAGMENT_CACHE_DB", "")
+DISK_SIZE = int(os.environ.get("TAGGED_FRAGMENT_CACHE_DISK_SIZE", "200000"))
+
+# the disk tier is trimmed to DISK_SIZE fragments after this many writes
+TRIM_EVERY = 1000
+
+# max number of keys in a single "IN (...)" query
+DISK_BATCH_SIZE = 500
+
+# "stamp()" returns the templates stamp
+class FragmentCache:
+
+    def __init__(self, stamp, size=CACHE_SIZE, disk_path=DISK_PATH, disk_size=DISK_SIZE):
+        self.stamp = stamp
+        self.memory = LRUCache(size)
+        self.disk_path = disk_path or None
+        self.disk_size = disk_size
+        self.disk_hits = 0
+        self.rendered = 0
+        self._writes = 0
+        self._disk_ready = False
+        self._lock = threading.Lock()
+
+    # fragments of items, in the same order
+    # "key(item)" is a tuple of everything the fragment depends on,
+    # "render(item)" makes the fragment of an item which is not in the cache
+    def render_all(self, items, key, render):
+        items = list(items)
+        keys = [key(item) for item in items]
+        fragments = [self.memory.get(k) for k in keys]
+        missing = [i for i, fragment in enumerate(fragments) if fragment is None]
+        if missing and self.disk_path:
+            found = self._disk_get([keys[i] for i in missing])
+            for i in missing:
+                fragment = found.get(keys[i])
+                if fragment is not None:
+                    fragments[i] = fragment
+                    self.memory.set(keys[i], fragment)
+                    self.disk_hits += 1
+        new = {}
+        for i in missing:
+            if fragments[i] is None:
+                fragments[i] = str(render(items[i]))
+                self.memory.set(keys[i], fragments[i])
+                new[keys[i]] = fragments[i]
+        self.rendered += len(new)
+        if new and self.disk_path:
+            self._disk_set(new)
+        return fragments
+
+    def _disk_key(self, key):
+        return hashlib.sha1(repr((self.stamp(),) + key).encode("UTF-8")).hexdigest()
+
+    def _prepare_disk(self, con):
+        if self._disk_ready:
+            return
+        con.execute("""CREATE TABLE IF NOT EXISTS fragments (
+            key TEXT PRIMARY KEY,
+            html TEXT NOT NULL,
+            stored_ts INTEGER NOT NULL)""")
+        con.execute("""CREATE INDEX IF NOT EXISTS fragments_stored ON fragments (stored_ts)""")
+        con.commit()
+        self._disk_ready = True
+
+    # returns key -> fragment for keys found on disk
+    # the disk tier is only a cache: its errors (e.g. a locked database) are logged and ignored
+    def _disk_get(self, keys):
+        disk_keys = {self._disk_key(k): k for k in keys}
+        found = {}
+        try:
+            with common.get_con(self.disk_path) as con:
+                self._prepare_disk(con)
+                names = list(disk_keys)
+                for i in range(0, len(names), DISK_BATCH_SIZE):
+                    batch = names[i:i + DISK_BATCH_SIZE]
+                    cur = con.execute("SELECT key, html FROM fragments WHERE key IN (" + ",".join(["?"] * len(batch)) + ")", batch)
+                    for disk_key, html in cur.fetchall():
+                        found[disk_keys[disk_key]] = html
+        except sqlite3.Error:
+            logger.warning("fragment cache read failed", exc_info=True)
+        return found
+
+    def _disk_set(self, fragments):
+        now = int(time.time())
+        try:
+            with common.get_con(self.disk_path) as con:
+                self._prepare_disk(con)
+                con.executemany("""INSERT OR REPLACE INTO fragments (key, html, stored_ts) VALUES (?, ?, ?)""",
+                    [(self._disk_key(k), html, now) for k, html in fragments.items()])
+                with self._lock:
+                    self._writes += len(fragments)
+                    trim = self._writes >= TRIM_EVERY
+                    if trim:
+                        self._writes = 0
+                if trim:
+                    con.execute("""DELETE FROM fragments WHERE key IN
+                        (SELECT key FROM fragments ORDER BY stored_ts DESC LIMIT -1 OFFSET ?)""", (self.disk_size,))
+                con.commit()
+        except sqlite3.Error:
+            logger.warning("fragment cache write failed", exc_info=True)
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats["disk_hits"] = self.disk_hits
+        stats["rendered"] = self.rendered
+        return stats
@@ -0,0 +1,499 @@
+# Background jobs: imports, exports to a file and maintenance of a user's notes.
+# Independent from flask.
+#
+# A job is a row of the "jobs" table in the main database; a request only saves the input
+# of the job and queues it. Every process with a started JobRunner (every worker of tagged.serve)
+# takes queued jobs from the table, whichever process has queued them, and runs them in its threads.
+# WORKERS limits how many jobs run at once in all processes together: a job is taken by
+# a transaction which does nothing while WORKERS jobs are running, then it's tried again later.
+# MAX_ACTIVE_PER_USER limits how many jobs one user may have queued or running.
+#
+# A job is never lost with its process. A stopping process (e.g. a worker being restarted)
+# interrupts its jobs at their next progress report and queues them again, without waiting for
+# them to finish; jobs of a process which died are queued again by the other processes.
+# A job is failed as interrupted after it was started MAX_ATTEMPTS times.
+# Job functions must allow that: an import is one transaction, an export writes its file anew.
+# Status is kept in the table, so any process can show it. Progress of a running job is kept in
+# a file in JOB_DIR, because an import holds the write lock of the database until it's done;
+# result files are kept in JOB_DIR too and are deleted with the job after KEEP_DAYS days.
+
+import concurrent.futures
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from . import backup
+from . import common
+from . import sharding
+from .services import NoteService, UserMovedException
+
+logger = logging.getLogger(__name__)
+
+WORKERS = int(os.environ.get("TAGGED_JOB_WORKERS", "2"))
+
+# default: "jobs" directory next to the database
+JOB_DIR = os.environ.get("TAGGED_JOB_DIR", "")
+
+KEEP_DAYS = float(os.environ.get("TAGGED_JOB_KEEP_DAYS", "7"))
+
+MAX_ACTIVE_PER_USER = 3
+
+# progress is saved at most once in this many seconds
+PROGRESS_INTERVAL = 1.0
+
+# queued jobs are looked for every this many seconds (and at once when this process queues one)
+CLAIM_INTERVAL = 0.5
+
+# a job interrupted by deaths of processes is started at most this many times
+MAX_ATTEMPTS = 3
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# "error" of a failed job
+ERROR_FORMAT = "format"
+ERROR_MOVED = "moved"
+ERROR_INTERRUPTED = "interrupted"
+ERROR_INTERNAL = "internal"
+
+EXPORT_FORMATS = backup.FORMATS
+
+class JobException(Exception):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+# the user has MAX_ACTIVE_PER_USER unfinished jobs
+class JobLimitException(Exception):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+# raised by Job.progress() when the process is stopping, the job is queued again
+class JobInterrupted(Exception):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+def job_dir():
+    return JOB_DIR or os.path.join(os.path.dirname(os.path.abspath(common.DB_PATH)), "jobs")
+
+# a running job, passed to the function of its kind
+class Job:
+
+    # "stopping" is an Event set when the job must be interrupted
+    def __init__(self, jobid, userid, kind, params, stopping=None):
+        self.id = jobid
+        self.userid = userid
+        self.kind = kind
+        self.params = params
+        self.stopping = stopping
+        self.done = 0
+        self.total = None
+        self._reported = 0
+
+    # path of a file of this job in job_dir()
+    def path(self, suffix):
+        return os.path.join(job_dir(), "{}{}".format(self.id, suffix))
+
+    # saves progress: "done" out of "total" (bytes, notes...)
+    # the file is replaced at once, so a reader never sees a half-written one
+    # raises JobInterrupted if the process is stopping
+    def progress(self, done, total=None, force=False):
+        if self.stopping is not None and self.stopping.is_set():
+            raise JobInterrupted()
+        self.done = done
+        if total is not None:
+            self.total = total
+        now = time.monotonic()
+        if not force and now - self._reported < PROGRESS_INTERVAL:
+            return
+        self._reported = now
+        path = self.path(".progress")
+        fd, tmp = tempfile.mkstemp(dir=job_dir(), prefix=os.path.basename(path) + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump([self.done, self.total], f)
+            os.replace(tmp, path)
+        except:
+            os.remove(tmp)
+            raise
+
+# reports bytes read from the file as progress
+class _ProgressReader:
+
+    def __init__(self, f, job, size):
+        self.f = f
+        self.job = job
+        self.size = size
+        self.done = 0
+        job.progress(0, size, force=True)
+
+    def read(self, n=-1):
+        data = self.f.read(n)
+        self.done += len(data)
+        self.job.progress(self.done, self.size)
+        return data
+
+# job functions return (result: dict, name of the result file in job_dir() or None)
+
+# input: the uploaded backup, saved as "<id>.upload" by save_upload(), deleted when the job is finished
+def _run_import(job):
+    with open(job.path(".upload"), "rb") as f, common.get_con() as con, sharding.get_user_con(con, job.userid) as ucon:
+        stream = _ProgressReader(f, job, os.fstat(f.fileno()).st_size)
+        imported, rejected = backup.import_notes(ucon, job.userid, stream)
+    return {"imported": imported, "rejected": rejected}, None
+
+# the result is a gzipped backup file
+def _run_export(job):
+    fmt = job.params.get("format", "json")
+    if fmt not in EXPORT_FORMATS:
+        raise JobException("unknown export format")
+    with common.get_con() as con, sharding.get_user_con(con, job.userid) as ucon:
+        total = NoteService(ucon).count_notes(job.userid)
+    job.progress(0, total, force=True)
+    filename = "{}.{}.gz".format(job.id, fmt)
+    path = os.path.join(job_dir(), filename)
+    try:
+        with open(path + ".tmp", "wb") as f:
+            for data in backup.gzip_chunks(backup.export_notes(job.userid, fmt, progress=job.progress)):
+                f.write(data)
+    except:
+        _remove(path + ".tmp")
+        raise
+    os.replace(path + ".tmp", path)
+    return {"notes": total}, filename
+
+def _run_rebuild_tag_counts(job):
+    with common.get_con() as con, sharding.get_user_con(con, job.userid) as ucon:
+        NoteService(ucon).rebuild_tag_counts(job.userid)
+    return {}, None
+
+KINDS = {
+    "import": _run_import,
+    "export": _run_export,
+    "rebuild-tag-counts": _run_rebuild_tag_counts,
+}
+
+# kinds a user may start from the import/export page
+MAINTENANCE_KINDS = ("rebuild-tag-counts",)
+
+def _error_code(e):
+    if isinstance(e, backup.BackupFormatException):
+        return ERROR_FORMAT
+    if isinstance(e, UserMovedException):
+        return ERROR_MOVED
+    return ERROR_INTERNAL
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class JobRunner:
+
+    def __init__(self, workers=WORKERS):
+        self.workers = workers
+        self._executor = None
+        self._dispatcher = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # set by stop(): no more jobs are taken, running ones are interrupted
+        self._stopping = threading.Event()
+        # set when a job is queued or finished by this process
+        self._wakeup = threading.Event()
+        # ids of jobs running in this process
+        self._running = set()
+        self.submitted = 0
+        self.done = 0
+        self.failed = 0
+        self.requeued = 0
+
+    # starts taking queued jobs if this process doesn't yet (e.g. in a child after fork)
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            os.makedirs(job_dir(), exist_ok=True)
+            try:
+                recover_orphans()
+                delete_old()
+            except Exception:
+                logger.exception("cleanup of jobs failed")
+            self._executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="job")
+            self._stopping = threading.Event()
+            self._wakeup = threading.Event()
+            self._running = set()
+            self._dispatcher = threading.Thread(target=self._dispatch, name="job-dispatcher", daemon=True)
+            self._dispatcher.start()
+            self._pid = os.getpid()
+
+    # queues a job, returns its id
+    # "prepare(path)" writes the input of the job (e.g. an uploaded file) to "path";
+    # it's done before the job is queued, so the job can't be started without its input
+    def submit(self, userid, kind, params=None, prepare=None):
+        if kind not in KINDS:
+            raise JobException("unknown job kind: " + kind)
+        self.ensure_started()
+        params = params or {}
+        with common.get_con() as con:
+            # checked before the input is saved too, so that a large upload is not saved for nothing
+            _check_limit(con.cursor(), userid)
+        tmp = None
+        if prepare is not None:
+            fd, tmp = tempfile.mkstemp(dir=job_dir(), suffix=".tmp")
+            os.close(fd)
+            try:
+                prepare(tmp)
+            except:
+                _remove(tmp)
+                raise
+        with common.get_con() as con:
+            cur = con.cursor()
+            try:
+                cur.execute("BEGIN IMMEDIATE")
+                _check_limit(cur, userid)
+                cur.execute("""INSERT INTO jobs (userid, kind, status, params, created_ts) VALUES (?, ?, ?, ?, ?)""",
+                    (userid, kind, QUEUED, json.dumps(params), int(time.time())))
+                jobid = cur.lastrowid
+                # nobody can take the job before the commit
+                if tmp is not None:
+                    os.replace(tmp, os.path.join(job_dir(), "{}.upload".format(jobid)))
+                    tmp = os.path.join(job_dir(), "{}.upload".format(jobid))
+                con.commit()
+            except:
+                con.rollback()
+                if tmp is not None:
+                    _remove(tmp)
+                raise
+            finally:
+                cur.close()
+        self.submitted += 1
+        self._wakeup.set()
+        return jobid
+
+    # takes queued jobs while this process has free threads
+    def _dispatch(self):
+        while not self._stopping.is_set():
+            job = None
+            if len(self._running) < self.workers:
+                try:
+                    # running jobs of processes which died would keep their places forever
+                    recover_orphans()
+                    job = self._claim()
+                except sqlite3.OperationalError as e:
+                    # e.g. the database is locked by a long import, it's tried again later
+                    logger.warning("can't take a job: %s", e)
+            if job is not None:
+                self._running.add(job.id)
+                self._executor.submit(self._run, job)
+                continue
+            self._wakeup.wait(CLAIM_INTERVAL)
+            self._wakeup.clear()
+
+    # marks the oldest queued job as running in this process if fewer than "workers" jobs
+    # are running in all processes, returns it as Job or None
+    def _claim(self):
+        with common.get_con() as con:
+            cur = con.cursor()
+            try:
+                # most of the time there is nothing to do: no write lock for that
+                cur.execute("""SELECT 1 FROM jobs WHERE status=? LIMIT 1""", (QUEUED,))
+                if cur.fetchone() is None:
+                    return None
+                cur.execute("BEGIN IMMEDIATE")
+                cur.execute("""SELECT count(*) FROM jobs WHERE status=?""", (RUNNING,))
+                if cur.fetchone()[0] >= self.workers:
+                    con.rollback()
+                    return None
+                cur.execute("""SELECT id, userid, kind, params FROM jobs WHERE status=? ORDER BY id LIMIT 1""", (QUEUED,))
+                row = cur.fetchone()
+                if row is None:
+                    con.rollback()
+                    return None
+                cur.execute("""UPDATE jobs SET status=?, pid=?, started_ts=?, attempts=attempts+1 WHERE id=?""",
+                    (RUNNING, os.getpid(), int(time.time()), row[0]))
+                con.commit()
+            except:
+                con.rollback()
+                raise
+            finally:
+                cur.close()
+        jobid, userid, kind, params = row
+        return Job(jobid, userid, kind, json.loads(params), self._stopping)
+
+    def _run(self, job):
+        try:
+            result, filename = KINDS[job.kind](job)
+        except JobInterrupted:
+            self._requeue(job)
+        except Exception as e:
+            if _error_code(e) == ERROR_INTERNAL:
+                logger.exception("job %s (%s) failed", job.id, job.kind)
+            self._finish(job, FAILED, error=_error_code(e))
+        else:
+            self._finish(job, DONE, result=result, filename=filename)
+        finally:
+            self._running.discard(job.id)
+            self._wakeup.set()
+
+    def _finish(self, job, status, result=None, filename=None, error=None):
+        if status == DONE:
+            self.done += 1
+        else:
+            self.failed += 1
+        total = job.total
+        progress = total if status == DONE and total is not None else job.done
+        # progress is read from the table from now on
+        _remove(job.path(".progress"))
+        with common.get_con() as con:
+            con.execute("""UPDATE jobs SET status=?, result=?, result_file=?, error=?, finished_ts=?, progress=?, total=? WHERE id=?""",
+                (status, json.dumps(result) if result is not None else None, filename, error, int(time.time()),
+                progress, total, job.id))
+            con.commit()
+        _remove(job.path(".upload"))
+
+    # an interrupted job is queued again for any process; it doesn't count as an attempt
+    def _requeue(self, job):
+        self.requeued += 1
+        with common.get_con() as con:
+            con.execute("""UPDATE jobs SET status=?, pid=NULL, started_ts=NULL, progress=0, total=NULL, attempts=attempts-1
+                WHERE id=? AND status=?""", (QUEUED, job.id, RUNNING))
+            con.commit()
+        _remove(job.path(".progress"))
+
+    # stops taking jobs; running jobs are interrupted at their next progress report and queued again,
+    # waits only for that
+    def stop(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._stopping.set()
+            self._wakeup.set()
+            self._dispatcher.join()
+            self._executor.shutdown(wait=True)
+            self._pid = None
+
+    def stats(self):
+        return {
+            "submitted": self.submitted,
+            "done": self.done,
+            "failed": self.failed,
+            "requeued": self.requeued,
+        }
+
+def _check_limit(cur, userid):
+    cur.execute("""SELECT count(*) FROM jobs WHERE userid=? AND status IN (?, ?)""", (userid, QUEUED, RUNNING))
+    if cur.fetchone()[0] >= MAX_ACTIVE_PER_USER:
+        raise JobLimitException()
+
+runner = JobRunner()
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def _job_dict(row, colnames):
+    job = dict(zip(colnames, row))
+    job["params"] = json.loads(job["params"])
+    job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+    if job["status"] == RUNNING:
+        try:
+            with open(os.path.join(job_dir(), "{}.progress".format(job["id"]))) as f:
+                job["progress"], job["total"] = json.load(f)
+        except (OSError, ValueError):
+            pass
+    return job
+
+JOB_COLUMNS = "id,userid,kind,status,params,progress,total,result,result_file,error,created_ts,started_ts,finished_ts"
+
+# job of the user as a dict, or None
+def get_job(con, userid, jobid):
+    cur = con.cursor()
+    cur.execute("SELECT " + JOB_COLUMNS + " FROM jobs WHERE id=? AND userid=?", (jobid, userid))
+    row = cur.fetchone()
+    colnames = [descr[0] for descr in cur.description]
+    cur.close()
+    return _job_dict(row, colnames) if row is not None else None
+
+# latest jobs of the user, newest first
+def list_jobs(con, userid, limit=20):
+    cur = con.cursor()
+    cur.execute("SELECT " + JOB_COLUMNS + " FROM jobs WHERE userid=? ORDER BY id DESC LIMIT ?", (userid, limit))
+    colnames = [descr[0] for descr in cur.description]
+    jobs = [_job_dict(row, colnames) for row in cur.fetchall()]
+    cur.close()
+    return jobs
+
+# path of the result file of a finished job, or None
+def result_path(job):
+    if job["status"] != DONE or not job["result_file"]:
+        return None
+    path = os.path.join(job_dir(), job["result_file"])
+    return path if os.path.exists(path) else None
+
+# writes an uploaded backup from binary stream to the input file of an import job
+def save_upload(stream):
+    def prepare(path):
+        with open(path, "wb") as f:
+            while True:
+                data = stream.read(backup.READ_SIZE)
+                if not data:
+                    break
+                f.write(data)
+    return prepare
+
+def _remove_inputs(jobid):
+    for suffix in (".upload", ".progress"):
+        _remove(os.path.join(job_dir(), "{}{}".format(jobid, suffix)))
+
+# running jobs of processes which are not running anymore will never finish:
+# they are queued again, or failed as interrupted after MAX_ATTEMPTS attempts
+# returns the number of such jobs
+def recover_orphans():
+    with common.get_con() as con:
+        cur = con.cursor()
+        cur.execute("""SELECT id, pid, attempts FROM jobs WHERE status=?""", (RUNNING,))
+        orphans = [(jobid, attempts) for jobid, pid, attempts in cur.fetchall() if pid is None or not _pid_alive(pid)]
+        if orphans:
+            now = int(time.time())
+            cur.executemany("""UPDATE jobs SET status=?, pid=NULL, started_ts=NULL, progress=0, total=NULL WHERE id=? AND status=?""",
+                [(QUEUED, jobid, RUNNING) for jobid, attempts in orphans if attempts < MAX_ATTEMPTS])
+            cur.executemany("""UPDATE jobs SET status=?, error=?, finished_ts=? WHERE id=? AND status=?""",
+                [(FAILED, ERROR_INTERRUPTED, now, jobid, RUNNING) for jobid, attempts in orphans if attempts >= MAX_ATTEMPTS])
+            con.commit()
+        cur.close()
+    for jobid, attempts in orphans:
+        if attempts >= MAX_ATTEMPTS:
+            _remove_inputs(jobid)
+        else:
+            _remove(os.path.join(job_dir(), "{}.progress".format(jobid)))
+    return len(orphans)
+
+# deletes jobs finished more than "keep_days" days ago and their result files
+# returns the number of deleted jobs
+def delete_old(keep_days=KEEP_DAYS):
+    cutoff = int(time.time() - keep_days * 24 * 60 * 60)
+    with common.get_con() as con:
+        cur = con.cursor()
+        cur.execute("""SELECT id, result_file FROM jobs WHERE finished_ts < ?""", (cutoff,))
+        old = cur.fetchall()
+        for jobid, filename in old:
+            if filename:
+                try:
+                    os.remove(os.path.join(job_dir(), filename))
+                except FileNotFoundError:
+                    pass
+        cur.executemany("""DELETE FROM jobs WHERE id=?""", [(jobid,) for jobid, filename in old])
+        con.commit()
+        cur.close()
+    return len(old)
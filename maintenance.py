@@ -0,0 +1,130 @@
+# Maintenance commands, run them from the directory containing the project:
+#     python -m tagged.maintenance migrate
+#     python -m tagged.maintenance analyze
+#     python -m tagged.maintenance rebuild-tag-counts [--user USERID]
+#     python -m tagged.maintenance compress
+#     python -m tagged.maintenance compression-stats
+#     python -m tagged.maintenance prune-revisions
+#     python -m tagged.maintenance sweep-sessions
+#     python -m tagged.maintenance clean-jobs
+
+import argparse
+
+from . import common
+from . import compression
+from . import jobs
+from . import migrations
+from . import sharding
+from .services import NoteService, SessionSweeper
+
+# all shards are upgraded, the main database first
+def migrate(args):
+    with common.get_con() as con:
+        applied = migrations.upgrade(con)
+        shards = sharding.all_shards(con)
+    print("applied migrations:", applied or "none")
+    for shard in shards[1:]:
+        path = sharding.shard_path(shard)
+        with common.get_con(path) as con:
+            applied = migrations.upgrade(con)
+        print("applied migrations ({}):".format(path), applied or "none")
+
+# yields (path, connection) for every shard
+def each_shard():
+    with common.get_con() as con:
+        shards = sharding.all_shards(con)
+    for shard in shards:
+        sharding.prepare_shard(shard)
+        path = sharding.shard_path(shard)
+        with common.get_con(path) as con:
+            yield path, con
+
+# refresh statistics of the query planner
+def analyze(args):
+    for path, con in each_shard():
+        con.execute("ANALYZE")
+        con.commit()
+
+def rebuild_tag_counts(args):
+    with common.get_con() as con:
+        if args.user is not None:
+            with sharding.get_user_con(con, args.user) as ucon:
+                NoteService(ucon).rebuild_tag_counts(args.user)
+            return
+    for path, con in each_shard():
+        NoteService(con).rebuild_tag_counts()
+
+# compresses notes stored before compression was enabled or the threshold was lowered
+def compress(args):
+    for path, con in each_shard():
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            n = compression.compress_notes(con)
+            con.commit()
+        except:
+            con.rollback()
+            raise
+        print("{}: compressed {} notes".format(path, n))
+
+def compression_stats(args):
+    for path, con in each_shard():
+        stats = compression.compression_stats(con)
+        saved = stats["uncompressed_bytes"] - stats["stored_bytes"]
+        print("{}: {} of {} notes compressed, {} bytes stored, {} bytes saved ({:.1f}%), full-text index {} bytes, database {} bytes".format(
+            path, stats["compressed"], stats["notes"], stats["stored_bytes"], saved,
+            100.0 * saved / stats["uncompressed_bytes"] if stats["uncompressed_bytes"] else 0.0,
+            stats["fts_bytes"] if stats["fts_bytes"] is not None else "?", stats["database_bytes"]))
+
+# applies the retention policy of revisions (TAGGED_REVISIONS_KEEP, TAGGED_REVISIONS_MAX_AGE_DAYS)
+# to all notes; notes which are edited get it applied on every save anyway
+def prune_revisions(args):
+    for path, con in each_shard():
+        n = NoteService(con).prune_all_revisions()
+        print("{}: pruned revisions of {} notes".format(path, n))
+
+# deletes expired sessions now, like the background sweeper of the site does
+def sweep_sessions(args):
+    print("deleted sessions:", SessionSweeper().sweep())
+
+# queues again jobs of processes which died and deletes old jobs, like the site does
+def clean_jobs(args):
+    print("recovered jobs:", jobs.recover_orphans())
+    print("deleted jobs:", jobs.delete_old())
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintenance of tagged database")
+    parser.add_argument("--db", help="database file (default: TAGGED_DB or tagged.db)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("migrate", help="upgrade database to the latest schema version")
+    p.set_defaults(func=migrate)
+
+    p = commands.add_parser("analyze", help="update statistics used by the query planner")
+    p.set_defaults(func=analyze)
+
+    p = commands.add_parser("rebuild-tag-counts", help="recalculate numbers of notes with every tag")
+    p.add_argument("--user", type=int, help="only for this user id")
+    p.set_defaults(func=rebuild_tag_counts)
+
+    p = commands.add_parser("compress", help="compress stored note bodies larger than TAGGED_COMPRESS_MIN_SIZE")
+    p.set_defaults(func=compress)
+
+    p = commands.add_parser("compression-stats", help="show space saved by compression of note bodies")
+    p.set_defaults(func=compression_stats)
+
+    p = commands.add_parser("prune-revisions", help="remove old revisions of notes according to the retention policy")
+    p.set_defaults(func=prune_revisions)
+
+    p = commands.add_parser("sweep-sessions", help="delete expired sessions")
+    p.set_defaults(func=sweep_sessions)
+
+    p = commands.add_parser("clean-jobs", help="delete background jobs older than TAGGED_JOB_KEEP_DAYS and their files")
+    p.set_defaults(func=clean_jobs)
+
+    args = parser.parse_args()
+    if args.db:
+        common.configure(path=args.db)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+# Instrumentation: SQL statement counts/timings, request latency and template render time.
+# Collected data is exported in Prometheus text format.
+# Independent from flask: the app calls start_request()/end_request() and template hooks.
+
+import hmac
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# statements slower than this (in milliseconds) are logged
+SLOW_QUERY_MS = float(os.environ.get("TAGGED_SLOW_QUERY_MS", "100"))
+
+# add "Server-Timing" header to responses
+SERVER_TIMING = os.environ.get("TAGGED_SERVER_TIMING", "") == "1"
+
+# statistics pages are served only to requests with this token ("Authorization: Bearer <token>")
+# or from these client addresses (comma-separated); with neither of them set they are not served at all
+ACCESS_TOKEN = os.environ.get("TAGGED_METRICS_TOKEN", "")
+ALLOWED_ADDRESSES = frozenset(addr.strip() for addr in os.environ.get("TAGGED_METRICS_ALLOW", "").split(",") if addr.strip())
+
+# histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# max number of distinct statements tracked, the rest is counted as "other"
+MAX_STATEMENTS = 500
+
+# statistics of the current request (of this thread)
+class RequestStats:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.query_time = 0.0
+        self.render_time = 0.0
+        self.duration = None
+        self._render_started = None
+
+_local = threading.local()
+
+def current():
+    return getattr(_local, "stats", None)
+
+class Histogram:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+_lock = threading.Lock()
+_route_latency = {}
+_route_queries = {}
+_template_time = {}
+# normalized statement -> [count, total time]
+_statements = {}
+
+# statement text normalization:
+# literals -> "?", lists of placeholders -> "?, ...", whitespace collapsed
+_normalized = {}
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_LIST_RE = re.compile(r"\?(?:\s*,\s*\?)+")
+_SPACE_RE = re.compile(r"\s+")
+
+def normalize(sql):
+    norm = _normalized.get(sql)
+    if norm is None:
+        norm = _STRING_RE.sub("?", sql)
+        norm = _NUMBER_RE.sub("?", norm)
+        norm = _LIST_RE.sub("?, ...", norm)
+        norm = _SPACE_RE.sub(" ", norm).strip()
+        # statements built from user input vary in length, don't let the cache grow forever
+        if len(_normalized) < 10 * MAX_STATEMENTS:
+            _normalized[sql] = norm
+    return norm
+
+def record_query(sql, duration):
+    norm = normalize(sql)
+    stats = current()
+    if stats is not None:
+        stats.query_time += duration
+    with _lock:
+        entry = _statements.get(norm)
+        if entry is None:
+            if len(_statements) >= MAX_STATEMENTS:
+                norm = "other"
+            entry = _statements.setdefault(norm, [0, 0.0])
+        entry[0] += 1
+        entry[1] += duration
+    if duration * 1000 >= SLOW_QUERY_MS:
+        logger.warning("slow query (%.1f ms): %s", duration * 1000, norm)
+
+# sqlite3 trace callback: counts every executed statement,
+# including the ones issued implicitly (BEGIN, COMMIT)
+def trace(sql):
+    stats = current()
+    if stats is not None:
+        stats.statements += 1
+
+# cursor which measures time spent in execute/fetch calls
+class TimedCursor(sqlite3.Cursor):
+
+    _sql = None
+
+    def execute(self, sql, parameters=()):
+        self._sql = sql
+        t = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(sql, time.perf_counter() - t)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._sql = sql
+        t = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_query(sql, time.perf_counter() - t)
+
+    # fetching rows runs the rest of the statement: add it to the statement time
+    def _timed_fetch(self, fetch, *args):
+        t = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            duration = time.perf_counter() - t
+            stats = current()
+            if stats is not None:
+                stats.query_time += duration
+            if self._sql is not None:
+                with _lock:
+                    entry = _statements.get(normalize(self._sql))
+                    if entry is not None:
+                        entry[1] += duration
+
+    def fetchone(self):
+        return self._timed_fetch(super().fetchone)
+
+    def fetchmany(self, *args):
+        return self._timed_fetch(super().fetchmany, *args)
+
+    def fetchall(self):
+        return self._timed_fetch(super().fetchall)
+
+# connection which makes TimedCursors and measures commit time
+class TimedConnection(sqlite3.Connection):
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or TimedCursor)
+
+    def commit(self):
+        t = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            record_query("COMMIT", time.perf_counter() - t)
+
+def start_request():
+    _local.stats = RequestStats()
+
+# records request latency; returns statistics of the request
+def end_request(route):
+    stats = current()
+    _local.stats = None
+    if stats is None:
+        return None
+    duration = time.perf_counter() - stats.started
+    with _lock:
+        if route not in _route_latency:
+            _route_latency[route] = Histogram()
+            _route_queries[route] = 0
+        _route_latency[route].observe(duration)
+        _route_queries[route] += stats.statements
+    stats.duration = duration
+    return stats
+
+def start_render():
+    stats = current()
+    if stats is not None:
+        stats._render_started = time.perf_counter()
+
+def end_render(template):
+    stats = current()
+    if stats is None or stats._render_started is None:
+        return
+    duration = time.perf_counter() - stats._render_started
+    stats._render_started = None
+    stats.render_time += duration
+    with _lock:
+        if template not in _template_time:
+            _template_time[template] = Histogram()
+        _template_time[template].observe(duration)
+
+# value of "Server-Timing" header for the current request
+def server_timing():
+    stats = current()
+    if stats is None:
+        return None
+    total = time.perf_counter() - stats.started
+    return 'db;dur={:.2f};desc="{} statements", tpl;dur={:.2f}, total;dur={:.2f}'.format(
+        stats.query_time * 1000, stats.statements, stats.render_time * 1000, total * 1000)
+
+# whether statistics may be shown to a client with address "addr",
+# "authorization" is the value of the request's Authorization header or None
+def access_allowed(addr, authorization):
+    if addr in ALLOWED_ADDRESSES:
+        return True
+    if not ACCESS_TOKEN or not authorization:
+        return False
+    scheme, _, token = authorization.partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(token.strip().encode("UTF-8"), ACCESS_TOKEN.encode("UTF-8"))
+
+def _label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _histogram_lines(name, label, histograms):
+    lines = []
+    for key, h in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(h.buckets, h.counts):
+            cumulative += count
+            lines.append('{}_bucket{{{}="{}",le="{}"}} {}'.format(name, label, _label(key), bound, cumulative))
+        lines.append('{}_bucket{{{}="{}",le="+Inf"}} {}'.format(name, label, _label(key), h.count))
+        lines.append('{}_sum{{{}="{}"}} {:.6f}'.format(name, label, _label(key), h.sum))
+        lines.append('{}_count{{{}="{}"}} {}'.format(name, label, _label(key), h.count))
+    return lines
+
+# all collected metrics in Prometheus text format
+# "extra" is a list of (name, type, help, value) added as is
+def export(extra=()):
+    lines = []
+    with _lock:
+        lines.append("# HELP tagged_request_duration_seconds Request latency by route.")
+        lines.append("# TYPE tagged_request_duration_seconds histogram")
+        lines += _histogram_lines("tagged_request_duration_seconds", "route", _route_latency)
+        lines.append("# HELP tagged_request_db_statements_total SQL statements executed by requests, by route.")
+        lines.append("# TYPE tagged_request_db_statements_total counter")
+        for route, n in sorted(_route_queries.items()):
+            lines.append('tagged_request_db_statements_total{{route="{}"}} {}'.format(_label(route), n))
+        lines.append("# HELP tagged_template_render_seconds Template render time.")
+        lines.append("# TYPE tagged_template_render_seconds histogram")
+        lines += _histogram_lines("tagged_template_render_seconds", "template", _template_time)
+        lines.append("# HELP tagged_db_queries_total Executed SQL statements by normalized text.")
+        lines.append("# TYPE tagged_db_queries_total counter")
+        for sql, (count, total) in sorted(_statements.items()):
+            lines.append('tagged_db_queries_total{{statement="{}"}} {}'.format(_label(sql), count))
+        lines.append("# HELP tagged_db_query_seconds_total Time spent in SQL statements by normalized text.")
+        lines.append("# TYPE tagged_db_query_seconds_total counter")
+        for sql, (count, total) in sorted(_statements.items()):
+            lines.append('tagged_db_query_seconds_total{{statement="{}"}} {:.6f}'.format(_label(sql), total))
+    for name, type_, help_, value in extra:
+        lines.append("# HELP {} {}".format(name, help_))
+        lines.append("# TYPE {} {}".format(name, type_))
+        lines.append("{} {}".format(name, value))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,286 @@
+# Versioned database migrations.
+# The schema version is kept in "PRAGMA user_version", every migration is applied once,
+# in its own transaction, so upgrade() can be run any number of times on any tagged.db.
+#
+# This module only depends on sqlite3 and compression.py: it's also used by _create_db.py, which is run as a script.
+
+import sqlite3
+import time
+
+try:
+    from . import compression
+except ImportError:
+    # run as a script
+    import compression
+
+# add a column to an existing table if it's not there yet
+def add_column(con, table, column, decl):
+    cur = con.cursor()
+    cur.execute("PRAGMA table_info({})".format(table))
+    if column not in [row[1] for row in cur.fetchall()]:
+        cur.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table, column, decl))
+
+# create full-text index for notes
+# the index is contentless: it doesn't keep a copy of notes, rowid of a row is the id of its note
+# returns False if sqlite was built without FTS5 (search falls back to LIKE then)
+def create_fts(con):
+    cur = con.cursor()
+    try:
+        try:
+            cur.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(title, contents, content='', contentless_delete=1)""")
+        except sqlite3.OperationalError:
+            # sqlite before 3.43: rows are deleted with the 'delete' command and the values they were indexed with
+            cur.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(title, contents, content='')""")
+    except sqlite3.OperationalError:
+        return False
+    # fill the index from notes which are not indexed yet
+    compression.register_functions(con)
+    cur.execute("""INSERT INTO notes_fts(rowid, title, contents)
+        SELECT id, title, contents_text(contents) FROM notes WHERE id NOT IN (SELECT rowid FROM notes_fts)""")
+    return True
+
+# create normalized tags table: one row per (note, tag)
+# and fill it from notes.tags for notes which have no rows there yet
+def create_note_tags(con):
+    cur = con.cursor()
+    cur.execute("""CREATE TABLE IF NOT EXISTS note_tags (
+        noteid INTEGER NOT NULL,
+        userid INTEGER NOT NULL,
+        tag VARCHAR(100) NOT NULL,
+        pos INTEGER NOT NULL,
+        PRIMARY KEY (noteid, tag),
+        FOREIGN KEY (noteid) REFERENCES notes(id),
+        FOREIGN KEY (userid) REFERENCES users(id)) WITHOUT ROWID""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS note_tags_userid_tag ON note_tags (userid, tag, noteid)""")
+    cur.execute("""SELECT id, userid, tags FROM notes WHERE id NOT IN (SELECT noteid FROM note_tags)""")
+    rows = []
+    for noteid, userid, tags in cur.fetchall():
+        for pos, tag in enumerate(tags.split()):
+            rows.append((noteid, userid, tag, pos))
+    cur.executemany("""INSERT OR IGNORE INTO note_tags (noteid, userid, tag, pos) VALUES (?, ?, ?, ?)""", rows)
+
+# create table with number of notes for every user's tag
+# it's always filled again from note_tags, so running this also repairs the counts
+def create_tag_counts(con):
+    cur = con.cursor()
+    cur.execute("""CREATE TABLE IF NOT EXISTS tag_counts (
+        userid INTEGER NOT NULL,
+        tag VARCHAR(100) NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (userid, tag),
+        FOREIGN KEY (userid) REFERENCES users(id)) WITHOUT ROWID""")
+    cur.execute("""DELETE FROM tag_counts""")
+    cur.execute("""INSERT INTO tag_counts (userid, tag, count)
+        SELECT userid, tag, count(*) FROM note_tags GROUP BY userid, tag""")
+
+# 1: all tables
+# databases created before versioning may already have some of them, so everything is "IF NOT EXISTS"
+def create_tables(con):
+    cur = con.cursor()
+    cur.execute("""CREATE TABLE IF NOT EXISTS users (
+        id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+        username VARCHAR(30) NOT NULL UNIQUE,
+        passhash VARCHAR(32) NOT NULL)""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS sessions (
+        id VARCHAR(32) NOT NULL PRIMARY KEY,
+        userid INTEGER NOT NULL,
+        active INTEGER(1) NOT NULL,
+        FOREIGN KEY (userid) REFERENCES users(id))""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS notes (
+        id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+        title VARCHAR(100) NOT NULL,
+        contents TEXT NOT NULL,
+        date_created VARCHAR(50) NOT NULL,
+        tags VARCHAR(500) NOT NULL,
+        date_modified VARCHAR(50) NOT NULL,
+        userid INTEGER NOT NULL,
+        FOREIGN KEY (userid) REFERENCES users(id))""")
+    # incremented on every change of user's notes, used for HTTP caching
+    cur.execute("""CREATE TABLE IF NOT EXISTS user_versions (
+        userid INTEGER NOT NULL PRIMARY KEY,
+        version INTEGER NOT NULL,
+        modified_ts INTEGER NOT NULL,
+        FOREIGN KEY (userid) REFERENCES users(id))""")
+    # rendered contents and date_modified of the note it was rendered for
+    # old notes are rendered when they are viewed for the first time
+    add_column(con, "notes", "contents_html", "TEXT")
+    add_column(con, "notes", "html_date_modified", "VARCHAR(50)")
+    create_fts(con)
+    create_note_tags(con)
+    create_tag_counts(con)
+
+# 2: dates as integer unix timestamps, for compact indexes and cheap comparisons
+# date_created/date_modified strings are kept for display and export
+# strings are local time without timezone, they are converted as if they were UTC:
+# timestamps are only used for ordering, see common.date_to_ts()
+def add_timestamps(con):
+    add_column(con, "notes", "created_ts", "INTEGER NOT NULL DEFAULT 0")
+    add_column(con, "notes", "modified_ts", "INTEGER NOT NULL DEFAULT 0")
+    cur = con.cursor()
+    cur.execute("""UPDATE notes SET
+        created_ts = coalesce(CAST(strftime('%s', date_created) AS INTEGER), 0),
+        modified_ts = coalesce(CAST(strftime('%s', date_modified) AS INTEGER), 0)""")
+
+# 3: secondary indexes
+def add_indexes(con):
+    cur = con.cursor()
+    # note lists of a user, newest first (list_notes)
+    # not covering: the index gives the order and the start of a page,
+    # then only the rows of the page (up to "limit" of them) are read from the table
+    cur.execute("""CREATE INDEX IF NOT EXISTS notes_userid_modified ON notes (userid, modified_ts DESC, id DESC)""")
+    # session check by token, covering: the table itself is not read
+    cur.execute("""CREATE INDEX IF NOT EXISTS sessions_id_active ON sessions (id, active, userid)""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS sessions_userid ON sessions (userid, active)""")
+
+# 4: statistics for the query planner
+def analyze(con):
+    con.cursor().execute("ANALYZE")
+
+# 5: sharding
+# user_shards is the directory of the main database: userid -> shard number (no row means shard 0);
+# moved_users lists users whose notes were moved from this database to another shard
+def add_shard_tables(con):
+    cur = con.cursor()
+    cur.execute("""CREATE TABLE IF NOT EXISTS user_shards (
+        userid INTEGER NOT NULL PRIMARY KEY,
+        shard INTEGER NOT NULL,
+        FOREIGN KEY (userid) REFERENCES users(id))""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS moved_users (
+        userid INTEGER NOT NULL PRIMARY KEY)""")
+
+# 6: autosaved drafts of notes being edited (noteid 0 is a new note)
+def add_drafts(con):
+    cur = con.cursor()
+    cur.execute("""CREATE TABLE IF NOT EXISTS drafts (
+        userid INTEGER NOT NULL,
+        noteid INTEGER NOT NULL,
+        title TEXT NOT NULL,
+        contents TEXT NOT NULL,
+        tags TEXT NOT NULL,
+        saved_ts INTEGER NOT NULL,
+        PRIMARY KEY (userid, noteid))""")
+
+# 7: large note bodies are stored compressed (see compression.py)
+def compress_contents(con):
+    compression.compress_notes(con)
+
+# 8: revision history of notes (see revisions.py)
+def add_revisions(con):
+    cur = con.cursor()
+    cur.execute("""CREATE TABLE IF NOT EXISTS note_revisions (
+        noteid INTEGER NOT NULL,
+        revno INTEGER NOT NULL,
+        userid INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        data NOT NULL,
+        title TEXT NOT NULL,
+        tags TEXT NOT NULL,
+        date_modified TEXT NOT NULL,
+        modified_ts INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        PRIMARY KEY (noteid, revno))""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS note_revisions_userid ON note_revisions (userid)""")
+
+# 9: session expiry
+# sessions which existed before get the current time, they expire as if they were created now;
+# logged out sessions are deleted instead of being marked inactive
+def add_session_times(con):
+    add_column(con, "sessions", "created_ts", "INTEGER NOT NULL DEFAULT 0")
+    add_column(con, "sessions", "last_seen_ts", "INTEGER NOT NULL DEFAULT 0")
+    cur = con.cursor()
+    now = int(time.time())
+    cur.execute("""UPDATE sessions SET created_ts = ?, last_seen_ts = ?""", (now, now))
+    cur.execute("""DELETE FROM sessions WHERE active = FALSE""")
+    # session check by token, covering
+    cur.execute("""DROP INDEX IF EXISTS sessions_id_active""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS sessions_token ON sessions (id, active, userid, created_ts, last_seen_ts)""")
+    # expired sessions for the sweeper
+    cur.execute("""CREATE INDEX IF NOT EXISTS sessions_last_seen ON sessions (last_seen_ts)""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS sessions_created ON sessions (created_ts)""")
+
+# 10: background jobs (see jobs.py)
+def add_jobs(con):
+    cur = con.cursor()
+    cur.execute("""CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        userid INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        status TEXT NOT NULL,
+        params TEXT NOT NULL,
+        progress INTEGER NOT NULL DEFAULT 0,
+        total INTEGER,
+        result TEXT,
+        result_file TEXT,
+        error TEXT,
+        pid INTEGER,
+        created_ts INTEGER NOT NULL,
+        started_ts INTEGER,
+        finished_ts INTEGER)""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS jobs_userid ON jobs (userid, id)""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished_ts)""")
+
+# 11: the full-text index was a second, uncompressed copy of all notes; it's made contentless
+def contentless_fts(con):
+    try:
+        con.execute("""DROP TABLE IF EXISTS notes_fts""")
+    except sqlite3.OperationalError:
+        # no FTS5: the table can't be there
+        return
+    create_fts(con)
+
+# 12: jobs of processes which died are started again (see jobs.recover_orphans), a limited number of times
+def add_job_attempts(con):
+    add_column(con, "jobs", "attempts", "INTEGER NOT NULL DEFAULT 0")
+
+# (version, function), versions go in order starting from 1
+MIGRATIONS = (
+    (1, create_tables),
+    (2, add_timestamps),
+    (3, add_indexes),
+    (4, analyze),
+    (5, add_shard_tables),
+    (6, add_drafts),
+    (7, compress_contents),
+    (8, add_revisions),
+    (9, add_session_times),
+    (10, add_jobs),
+    (11, contentless_fts),
+    (12, add_job_attempts),
+)
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def get_version(con):
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+# applies all migrations newer than the database version
+# returns list of applied versions
+def upgrade(con, target=LATEST_VERSION):
+    applied = []
+    for version, migration in MIGRATIONS:
+        if version > target:
+            break
+        if version <= get_version(con):
+            continue
+        if con.in_transaction:
+            con.commit()
+        # another process may be upgrading the same database: check the version again under the lock
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            if get_version(con) < version:
+                migration(con)
+                # PRAGMA doesn't accept parameters
+                con.execute("PRAGMA user_version = {}".format(int(version)))
+                applied.append(version)
+            con.commit()
+        except:
+            con.rollback()
+            raise
+    return applied
+
+if __name__ == "__main__":
+    import os
+    con = sqlite3.connect(os.environ.get("TAGGED_DB", "tagged.db"))
+    print("applied migrations:", upgrade(con) or "none")
+    con.close()
@@ -4,21 +4,42 @@ import flask
 
 from . import common
 from . import flask_utils 
-from .services import NoteService, NoteSearchException
-import json
+from . import backup
+from . import drafts
+from . import autocomplete
+from . import jobs
+from . import related
+from .services import NoteSearchException, UserMovedException
 
 notesapp = flask.Blueprint("notesapp", __name__, template_folder="templates")
 
+# number of notes on the main page and on one page of note lists
+LAST_NOTES_COUNT = 10
+PAGE_SIZE = 50
+
+# the user is being moved to another shard (see sharding.move_user)
+@notesapp.errorhandler(UserMovedException)
+def user_moved(e):
+    return flask.render_template("message.html", message="Заметки переносятся, повторите действие через несколько секунд"), 503
+
+# too many unfinished background jobs of the user
+@notesapp.errorhandler(jobs.JobLimitException)
+def job_limit(e):
+    return flask.render_template("message.html", message="Слишком много незавершённых задач, дождитесь их окончания"), 429
+
 # main page: recent notes
 @notesapp.route("/")
 def index_page():
     with common.get_con() as con:
         try:
             userid = flask_utils.get_logined_user_id(con)
-            ns = NoteService(con)
-            notes = ns.get_last_notes(userid)
-            all_tags = ns.find_all_tags(userid)
-            return flask.render_template("index.html", notes=notes)
+            ns = flask_utils.get_note_service(con, userid)
+            version = ns.get_data_version(userid)
+            resp = flask_utils.not_modified(userid, version)
+            if resp is not None:
+                return resp
+            notes = ns.list_notes(userid, LAST_NOTES_COUNT)
+            return flask_utils.set_validators(flask.render_template("index.html", notes=notes), userid, version)
         except flask_utils.NotAuthorized:
             return flask_utils.unlogin_user(con)
 
@@ -28,11 +49,19 @@ def all_page():
     with common.get_con() as con:
         try:
             userid = flask_utils.get_logined_user_id(con)
-            ns = NoteService(con)
-            notes = ns.get_all_notes(userid)
-            return flask.render_template("all_notes.html", notes=notes)
+            ns = flask_utils.get_note_service(con, userid)
+            version = ns.get_data_version(userid)
+            resp = flask_utils.not_modified(userid, version)
+            if resp is not None:
+                return resp
+            after = flask.request.args.get("after")
+            before = flask.request.args.get("before")
+            notes = ns.list_notes(userid, PAGE_SIZE, after, before)
+            return flask_utils.set_validators(flask.render_template("all_notes.html", notes=notes), userid, version)
         except flask_utils.NotAuthorized:
             return flask_utils.unlogin_user(con)
+        except NoteSearchException:
+            return flask.render_template("message.html", message="Неправильные параметры поиска")
 
 # search results page
 @notesapp.route("/search/results")
@@ -40,11 +69,17 @@ def search_results_page():
     with common.get_con() as con:
         try:
             userid = flask_utils.get_logined_user_id(con)
-            ns = NoteService(con)
+            ns = flask_utils.get_note_service(con, userid)
+            version = ns.get_data_version(userid)
+            resp = flask_utils.not_modified(userid, version)
+            if resp is not None:
+                return resp
             keywords = flask.request.args.get("keywords", "").strip().split()
             tags = flask.request.args.get("tags", "").strip().split()
-            notes = ns.search_notes(userid, keywords, tags)
-            return flask.render_template("search_results.html", keywords=keywords, tags=tags, notes=notes)
+            after = flask.request.args.get("after")
+            before = flask.request.args.get("before")
+            notes = ns.search_notes(userid, keywords, tags, after=after, before=before)
+            return flask_utils.set_validators(flask.render_template("search_results.html", keywords=keywords, tags=tags, notes=notes), userid, version)
         except flask_utils.NotAuthorized:
             return flask_utils.unlogin_user(con)
         except NoteSearchException:
@@ -56,9 +91,10 @@ def delete_noteid_page(noteid):
     with common.get_con() as con:
         try:
             userid = flask_utils.get_logined_user_id(con)
-            ns = NoteService(con)
+            ns = flask_utils.get_note_service(con, userid)
             if flask.request.method != "POST":
                 return flask.render_template("delete_noteid.html", noteid=noteid)
+            drafts.writer.discard(userid, noteid)
             if ns.delete_note(userid, noteid):
                 return flask.render_template("message.html", message="Удалено")
         except NoteSearchException:
@@ -70,22 +106,109 @@ def note_noteid_page(noteid):
     with common.get_con() as con:
         try:
             userid = flask_utils.get_logined_user_id(con)
-            ns = NoteService(con)
+            ns = flask_utils.get_note_service(con, userid)
+            version = ns.get_data_version(userid)
+            resp = flask_utils.not_modified(userid, version)
+            if resp is not None:
+                return resp
+            note = ns.get_note(userid, noteid)
+            related_notes = related.get_index(ns, userid, version[0]).related(noteid)
+            return flask_utils.set_validators(flask.render_template("note_noteid.html", note=note, related_notes=related_notes), userid, version)
+        except flask_utils.NotAuthorized:
+            return flask_utils.unlogin_user(con)
+        except NoteSearchException:
+            return flask.render_template("message.html", message="Заметка не существует")
+
+# notes sharing tags with the note (see related.py)
+@notesapp.route("/api/note/<int:noteid>/related")
+def note_related_api(noteid):
+    with common.get_con() as con:
+        try:
+            userid = flask_utils.get_logined_user_id(con)
+        except flask_utils.NotAuthorized:
+            return flask.jsonify(error="not authorized"), 403
+        ns = flask_utils.get_note_service(con, userid)
+        index = related.get_index(ns, userid, ns.get_data_version(userid)[0])
+        return flask.jsonify(related=index.related(noteid))
+
+# revision history of a note
+@notesapp.route("/note/<int:noteid>/revisions")
+def note_revisions_page(noteid):
+    with common.get_con() as con:
+        try:
+            userid = flask_utils.get_logined_user_id(con)
+            ns = flask_utils.get_note_service(con, userid)
+            version = ns.get_data_version(userid)
+            resp = flask_utils.not_modified(userid, version)
+            if resp is not None:
+                return resp
             note = ns.get_note(userid, noteid)
-            return flask.render_template("note_noteid.html", note=note)
+            revisions = ns.list_revisions(userid, noteid)
+            return flask_utils.set_validators(flask.render_template("note_revisions.html", note=note, revisions=revisions), userid, version)
         except flask_utils.NotAuthorized:
             return flask_utils.unlogin_user(con)
         except NoteSearchException:
             return flask.render_template("message.html", message="Заметка не существует")
 
+# one revision of a note; POST restores it
+@notesapp.route("/note/<int:noteid>/revisions/<int:revno>", methods=["GET", "POST"])
+def note_revision_page(noteid, revno):
+    with common.get_con() as con:
+        try:
+            userid = flask_utils.get_logined_user_id(con)
+            ns = flask_utils.get_note_service(con, userid)
+            if flask.request.method == "POST":
+                drafts.writer.discard(userid, noteid)
+                ns.restore_revision(userid, noteid, revno)
+                return flask.redirect(flask.url_for(".note_noteid_page", noteid=noteid))
+            version = ns.get_data_version(userid)
+            resp = flask_utils.not_modified(userid, version)
+            if resp is not None:
+                return resp
+            revision = ns.get_revision(userid, noteid, revno)
+            return flask_utils.set_validators(flask.render_template("note_revision.html", noteid=noteid, revision=revision), userid, version)
+        except flask_utils.NotAuthorized:
+            return flask_utils.unlogin_user(con)
+        except NoteSearchException:
+            return flask.render_template("message.html", message="Версия не существует")
+
+# the same in JSON
+@notesapp.route("/api/note/<int:noteid>/revisions")
+def note_revisions_api(noteid):
+    with common.get_con() as con:
+        try:
+            userid = flask_utils.get_logined_user_id(con)
+        except flask_utils.NotAuthorized:
+            return flask.jsonify(error="not authorized"), 403
+        ns = flask_utils.get_note_service(con, userid)
+        return flask.jsonify(revisions=ns.list_revisions(userid, noteid))
+
+@notesapp.route("/api/note/<int:noteid>/revisions/<int:revno>", methods=["GET", "POST"])
+def note_revision_api(noteid, revno):
+    with common.get_con() as con:
+        try:
+            userid = flask_utils.get_logined_user_id(con)
+        except flask_utils.NotAuthorized:
+            return flask.jsonify(error="not authorized"), 403
+        ns = flask_utils.get_note_service(con, userid)
+        try:
+            if flask.request.method == "POST":
+                drafts.writer.discard(userid, noteid)
+                ns.restore_revision(userid, noteid, revno)
+                return flask.jsonify(restored=True)
+            return flask.jsonify(ns.get_revision(userid, noteid, revno))
+        except NoteSearchException:
+            return flask.jsonify(error="no such revision"), 404
+
 # new note page: add new note
 @notesapp.route("/new", methods=["GET", "POST"])
 def new_page():
     with common.get_con() as con:
         try:
             userid = flask_utils.get_logined_user_id(con)
+            ns = flask_utils.get_note_service(con, userid)
             if flask.request.method != "POST":
-                return flask.render_template("new.html")
+                return flask.render_template("new.html", draft=ns.get_draft(userid, 0))
             if not common.contains_all(flask.request.form, ("title", "contents", "tags")):
                 return flask.render_template("message.html", message="Неправильный запрос")
             title = flask.request.form.get("title", "")
@@ -93,7 +216,7 @@ def new_page():
             tags = flask.request.form.get("tags", "").strip().split()
             if not all(map(common.validate_tag, tags)):
                 return flask.render_template("message.html", message="Ошибка: метка может содержать только буквы, цифры, нижнее подчёркивание (_) или дефис(-)")
-            ns = NoteService(con)
+            drafts.writer.discard(userid, 0)
             noteid = ns.create_note(userid, title, contents, tags)
             return flask.redirect(flask.url_for(".note_noteid_page", noteid=noteid))
         except flask_utils.NotAuthorized:
@@ -105,10 +228,14 @@ def edit_noteid_page(noteid):
     with common.get_con() as con:
         try:
             userid = flask_utils.get_logined_user_id(con)
-            ns = NoteService(con)
+            ns = flask_utils.get_note_service(con, userid)
             if flask.request.method != "POST":
                 note = ns.get_note(userid, noteid)
-                return flask.render_template("edit_noteid.html", note=note)
+                draft = ns.get_draft(userid, noteid)
+                # the note may have been saved from another device after the draft
+                if draft is not None and draft["saved_ts"] < note["modified_ts"]:
+                    draft = None
+                return flask.render_template("edit_noteid.html", note=note, draft=draft)
             if not common.contains_all(flask.request.form, ("title", "contents", "tags")):
                 return flask.render_template("message.html", message="Неправильный запрос")
             title = flask.request.form.get("title", "")
@@ -116,6 +243,7 @@ def edit_noteid_page(noteid):
             tags = flask.request.form.get("tags", "").strip().split()
             if not all(map(common.validate_tag, tags)):
                 return flask.render_template("message.html", message="Ошибка: метка может содержать только буквы, цифры, нижнее подчёркивание (_) или дефис(-)")
+            drafts.writer.discard(userid, noteid)
             ns.update_note(userid, noteid, title, contents, tags)
             return flask.redirect(flask.url_for(".note_noteid_page", noteid=noteid))
         except flask_utils.NotAuthorized:
@@ -123,15 +251,51 @@ def edit_noteid_page(noteid):
         except NoteSearchException:
             return flask.render_template("message.html", message="Заметка не существует")
 
+# autosave of the editor (see static/autosave.js), noteid is 0 for a new note
+@notesapp.route("/draft", methods=["POST"])
+def save_draft():
+    with common.get_con() as con:
+        try:
+            userid = flask_utils.get_logined_user_id(con)
+        except flask_utils.NotAuthorized:
+            return flask.jsonify(saved=False), 403
+    noteid = flask.request.form.get("noteid", "")
+    if not noteid.isdigit() or not common.contains_all(flask.request.form, ("title", "contents", "tags")):
+        return flask.jsonify(saved=False), 400
+    try:
+        drafts.writer.save(userid, int(noteid), flask.request.form["title"], flask.request.form["contents"], flask.request.form["tags"])
+    except drafts.DraftSaveException:
+        return flask.jsonify(saved=False), 503
+    return flask.jsonify(saved=True, durability=drafts.writer.durability)
+
+# suggestions of tags and titles starting with "q" (see static/autocomplete.js)
+@notesapp.route("/autocomplete")
+def autocomplete_suggestions():
+    with common.get_con() as con:
+        try:
+            userid = flask_utils.get_logined_user_id(con)
+        except flask_utils.NotAuthorized:
+            return flask.jsonify(error="not authorized"), 403
+        prefix = flask.request.args.get("q", "").strip()
+        if not prefix:
+            return flask.jsonify(tags=[], titles=[])
+        ns = flask_utils.get_note_service(con, userid)
+        index = autocomplete.get_index(ns, userid, ns.get_data_version(userid)[0])
+        return flask.jsonify(index.suggest(prefix))
+
 # page with all tags
 @notesapp.route("/all_tags")
 def all_tags():
     with common.get_con() as con:
         try:
             userid = flask_utils.get_logined_user_id(con)
-            ns = NoteService(con)
-            all_tags = ns.find_all_tags(userid)
-            return flask.render_template("all_tags.html", all_tags=all_tags)
+            ns = flask_utils.get_note_service(con, userid)
+            version = ns.get_data_version(userid)
+            resp = flask_utils.not_modified(userid, version)
+            if resp is not None:
+                return resp
+            tag_counts = ns.find_tag_counts(userid)
+            return flask_utils.set_validators(flask.render_template("all_tags.html", tag_counts=tag_counts), userid, version)
         except flask_utils.NotAuthorized:
             return flask_utils.unlogin_user(con)
 
@@ -141,35 +305,140 @@ def export():
     with common.get_con() as con:
         try:
             userid = flask_utils.get_logined_user_id(con)
-            ns = NoteService(con)
-            all_tags = ns.find_all_tags(userid)
-            return flask.render_template("export.html", all_tags=all_tags)
+            ns = flask_utils.get_note_service(con, userid)
+            version = ns.get_data_version(userid)
+            resp = flask_utils.not_modified(userid, version)
+            if resp is not None:
+                return resp
+            tag_counts = ns.find_tag_counts(userid)
+            return flask_utils.set_validators(flask.render_template("export.html", tag_counts=tag_counts), userid, version)
         except flask_utils.NotAuthorized:
             return flask_utils.unlogin_user(con)
 
+# notes are streamed to the client while they are read from database
+# the response is gzipped if the client supports it, and then has an ETag of its own
 @notesapp.route("/export/download")
 def export_download():
+    gzipped = flask.request.accept_encodings["gzip"] > 0
+    variant = "gzip" if gzipped else None
     with common.get_con() as con:
         try:
             userid = flask_utils.get_logined_user_id(con)
-            ns = NoteService(con)
-            notes = ns.get_all_notes(userid)
-            return flask.jsonify(notes)
+            ns = flask_utils.get_note_service(con, userid)
+            version = ns.get_data_version(userid)
+            resp = flask_utils.not_modified(userid, version, variant)
+            if resp is not None:
+                return resp
         except flask_utils.NotAuthorized:
             return flask_utils.unlogin_user(con)
+    fmt = flask.request.args.get("format", "json")
+    if fmt not in backup.FORMATS:
+        return flask.render_template("message.html", message="Неправильный запрос")
+    body = backup.export_notes(userid, fmt)
+    mimetype = "application/json" if fmt == "json" else "application/x-ndjson"
+    headers = {
+        "Content-Disposition": "attachment; filename=notes." + fmt,
+        "Vary": "Accept-Encoding",
+    }
+    if gzipped:
+        body = backup.gzip_chunks(body)
+        headers["Content-Encoding"] = "gzip"
+    return flask_utils.set_validators(flask.Response(body, mimetype=mimetype, headers=headers), userid, version, variant)
 
+# the file is saved and imported by a background job (see jobs.py)
 @notesapp.route("/export/upload", methods=["POST"])
 def export_upload():
-     with common.get_con() as con:
+    with common.get_con() as con:
+        try:
+            userid = flask_utils.get_logined_user_id(con)
+            f = flask.request.files.get("file")
+            if f is None:
+                return flask.render_template("message.html", message="Неправильный запрос")
+            try:
+                jobid = jobs.runner.submit(userid, "import", prepare=jobs.save_upload(f.stream))
+            finally:
+                f.close()
+            return flask.redirect(flask.url_for(".job_page", jobid=jobid))
+        except flask_utils.NotAuthorized:
+            return flask_utils.unlogin_user(con)
+
+# export of all notes into a file by a background job, the file is downloaded from the job page
+@notesapp.route("/export/file", methods=["POST"])
+def export_file():
+    with common.get_con() as con:
         try:
-            f = flask.request.files["file"]
-            bs = f.read()
-            f.close()
-            notes = json.loads(bs)
             userid = flask_utils.get_logined_user_id(con)
-            ns = NoteService(con)
-            ns.upload(userid, notes)
-            return flask.render_template("message.html", message="Экспорт завершён.")
+            fmt = flask.request.form.get("format", "json")
+            if fmt not in jobs.EXPORT_FORMATS:
+                return flask.render_template("message.html", message="Неправильный запрос")
+            jobid = jobs.runner.submit(userid, "export", {"format": fmt})
+            return flask.redirect(flask.url_for(".job_page", jobid=jobid))
         except flask_utils.NotAuthorized:
             return flask_utils.unlogin_user(con)
 
+# maintenance of the user's notes by a background job
+@notesapp.route("/jobs/maintenance", methods=["POST"])
+def maintenance_job():
+    with common.get_con() as con:
+        try:
+            userid = flask_utils.get_logined_user_id(con)
+            kind = flask.request.form.get("kind", "")
+            if kind not in jobs.MAINTENANCE_KINDS:
+                return flask.render_template("message.html", message="Неправильный запрос")
+            jobid = jobs.runner.submit(userid, kind)
+            return flask.redirect(flask.url_for(".job_page", jobid=jobid))
+        except flask_utils.NotAuthorized:
+            return flask_utils.unlogin_user(con)
+
+# background jobs of the user
+@notesapp.route("/jobs")
+def jobs_page():
+    with common.get_con() as con:
+        try:
+            userid = flask_utils.get_logined_user_id(con)
+            return flask.render_template("jobs.html", jobs=jobs.list_jobs(con, userid))
+        except flask_utils.NotAuthorized:
+            return flask_utils.unlogin_user(con)
+
+# status of a job, the page reloads itself until the job is finished
+@notesapp.route("/jobs/<int:jobid>")
+def job_page(jobid):
+    with common.get_con() as con:
+        try:
+            userid = flask_utils.get_logined_user_id(con)
+            job = jobs.get_job(con, userid, jobid)
+            if job is None:
+                return flask.render_template("message.html", message="Задача не существует")
+            return flask.render_template("job.html", job=job, downloadable=jobs.result_path(job) is not None)
+        except flask_utils.NotAuthorized:
+            return flask_utils.unlogin_user(con)
+
+# the same in JSON
+@notesapp.route("/api/jobs/<int:jobid>")
+def job_api(jobid):
+    with common.get_con() as con:
+        try:
+            userid = flask_utils.get_logined_user_id(con)
+        except flask_utils.NotAuthorized:
+            return flask.jsonify(error="not authorized"), 403
+        job = jobs.get_job(con, userid, jobid)
+    if job is None:
+        return flask.jsonify(error="no such job"), 404
+    job["download_url"] = flask.url_for(".job_download", jobid=jobid) if jobs.result_path(job) is not None else None
+    del job["result_file"]
+    return flask.jsonify(job)
+
+# result file of a finished job
+@notesapp.route("/jobs/<int:jobid>/download")
+def job_download(jobid):
+    with common.get_con() as con:
+        try:
+            userid = flask_utils.get_logined_user_id(con)
+            job = jobs.get_job(con, userid, jobid)
+        except flask_utils.NotAuthorized:
+            return flask_utils.unlogin_user(con)
+    path = jobs.result_path(job) if job is not None else None
+    if path is None:
+        return flask.render_template("message.html", message="Файл не существует"), 404
+    return flask.send_file(path, mimetype="application/gzip", as_attachment=True,
+        download_name="notes." + job["params"].get("format", "json") + ".gz")
@@ -0,0 +1,68 @@
+# Compact row objects returned by services instead of dicts.
+# Independent from flask.
+#
+# A record keeps its columns in __slots__ (no per-row dict and key list)
+# and still supports record["column"], so templates don't change.
+
+from . import compression
+
+class Record:
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    # makes records from rows of a cursor with columns "colnames"
+    @classmethod
+    def from_rows(cls, colnames, rows):
+        new = cls.__new__
+        records = []
+        for row in rows:
+            record = new(cls)
+            for name, value in zip(colnames, row):
+                setattr(record, name, value)
+            records.append(record)
+        return records
+
+class UserRecord(Record):
+
+    __slots__ = ("id", "username", "passhash")
+
+# "contents" is decompressed on first access (see compression.py);
+# if it was not selected, it's loaded from database then, through "loader" (a NoteService)
+class NoteRecord(Record):
+
+    __slots__ = ("id", "title", "tags", "date_created", "date_modified", "created_ts", "modified_ts",
+        "contents_html", "html_date_modified", "tag_list", "loader", "_contents", "_unpacked")
+
+    @property
+    def contents(self):
+        try:
+            if self._unpacked:
+                return self._contents
+        except AttributeError:
+            loader = getattr(self, "loader", None)
+            if loader is None:
+                raise
+            self._contents = loader.load_contents(self.id)
+        self._contents = compression.unpack(self._contents)
+        self._unpacked = True
+        return self._contents
+
+    @contents.setter
+    def contents(self, value):
+        self._contents = value
+        self._unpacked = False
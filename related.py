@@ -0,0 +1,210 @@
+# Related notes: notes sharing tags with a note, rarer shared tags counting more.
+# Independent from flask.
+#
+# Every user gets an in-memory note-tag incidence matrix in sparse form. Notes with the same
+# set of tags score the same, so the matrix is kept per group of such notes: the tags of every
+# group and, for every tag, the set of its groups (postings); there are usually many times
+# fewer groups than notes. Scoring a note is one pass over the postings of its tags:
+# the score of a group is the sum of IDF weights of the tags it shares with the note.
+# With numpy this is a single bincount over the concatenated postings; without it, a loop over them.
+#
+# Like autocomplete.py, the index is built on the first request, kept in an LRU cache
+# and remembers the user's data version: writes of this process update it in place
+# (apply_changes), a write made elsewhere changes the version and the index is built again.
+
+import heapq
+import math
+import os
+import threading
+from collections import defaultdict
+
+from .cache import LRUCache
+
+# numpy is optional: without it notes are scored in pure Python
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# number of users whose indexes are kept in memory
+CACHE_SIZE = int(os.environ.get("TAGGED_RELATED_USERS", "200"))
+
+RELATED_COUNT = 5
+
+# groups left without notes are reclaimed when there are more of them than this share of all groups
+MAX_FREE_SHARE = 0.5
+
+class RelatedIndex:
+
+    # "rows" are (noteid, title, tag) of all tags of the user's notes
+    def __init__(self, version, rows):
+        self.version = version
+        self.lock = threading.Lock()
+        self._clear()
+        titles = {}
+        tags = defaultdict(list)
+        for noteid, title, tag in rows:
+            titles[noteid] = title
+            tags[noteid].append(tag)
+        for noteid, note_tags in tags.items():
+            self.set_note(noteid, titles[noteid], note_tags)
+
+    def _clear(self):
+        # noteid -> title, group
+        self.titles = {}
+        self.note_groups = {}
+        # set of tags -> group
+        self.groups = {}
+        # group -> tuple of tags, set of noteids (empty for a free group)
+        self.group_tags = []
+        self.group_notes = []
+        # tag -> set of groups, number of notes
+        self.postings = {}
+        self.tag_counts = {}
+        # tag -> numpy array of its postings, made when it's needed
+        self._arrays = {}
+        self.free = 0
+
+    # adds, changes or (with "tags" empty) removes a note
+    def set_note(self, noteid, title, tags):
+        tags = tuple(dict.fromkeys(tags))
+        group = self.note_groups.pop(noteid, None)
+        self.titles.pop(noteid, None)
+        if group is not None:
+            for tag in self.group_tags[group]:
+                self.tag_counts[tag] -= 1
+                if not self.tag_counts[tag]:
+                    del self.tag_counts[tag]
+            self._leave(group, noteid)
+        if not tags:
+            return
+        key = frozenset(tags)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = len(self.group_tags)
+            self.group_tags.append(tags)
+            self.group_notes.append(set())
+            for tag in tags:
+                self.postings.setdefault(tag, set()).add(group)
+                self._arrays.pop(tag, None)
+        self.group_notes[group].add(noteid)
+        self.note_groups[noteid] = group
+        for tag in tags:
+            self.tag_counts[tag] = self.tag_counts.get(tag, 0) + 1
+        self.titles[noteid] = title
+
+    def _leave(self, group, noteid):
+        notes = self.group_notes[group]
+        notes.discard(noteid)
+        if notes:
+            return
+        tags = self.group_tags[group]
+        del self.groups[frozenset(tags)]
+        for tag in tags:
+            posting = self.postings[tag]
+            posting.discard(group)
+            if not posting:
+                del self.postings[tag]
+            self._arrays.pop(tag, None)
+        self.group_tags[group] = ()
+        self.free += 1
+        if self.free > len(self.group_tags) * MAX_FREE_SHARE:
+            self._compact()
+
+    def _compact(self):
+        notes = [(noteid, self.titles[noteid], self.group_tags[group]) for noteid, group in self.note_groups.items()]
+        self._clear()
+        for noteid, title, tags in notes:
+            self.set_note(noteid, title, tags)
+
+    # inverse document frequency: a tag of every note weighs little, a rare tag weighs much
+    def _weight(self, tag):
+        return math.log(1 + len(self.note_groups) / self.tag_counts[tag])
+
+    def _array(self, tag):
+        array = self._arrays.get(tag)
+        if array is None:
+            posting = self.postings[tag]
+            array = self._arrays[tag] = numpy.fromiter(posting, dtype=numpy.intp, count=len(posting))
+        return array
+
+    def _scores_numpy(self, tags):
+        arrays = [self._array(tag) for tag in tags]
+        weights = numpy.repeat([self._weight(tag) for tag in tags], [len(array) for array in arrays])
+        scores = numpy.bincount(numpy.concatenate(arrays), weights=weights, minlength=len(self.group_tags))
+        groups = numpy.flatnonzero(scores)
+        return zip(groups.tolist(), scores[groups].tolist())
+
+    def _scores_python(self, tags):
+        scores = defaultdict(float)
+        for tag in tags:
+            weight = self._weight(tag)
+            for group in self.postings[tag]:
+                scores[group] += weight
+        return scores.items()
+
+    # up to "limit" notes related to the note, best first (newer first among equal ones):
+    # list of dicts with id, title and score
+    def related(self, noteid, limit=RELATED_COUNT):
+        with self.lock:
+            group = self.note_groups.get(noteid)
+            if group is None:
+                return []
+            tags = self.group_tags[group]
+            if numpy is not None:
+                scores = self._scores_numpy(tags)
+            else:
+                scores = self._scores_python(tags)
+            # notes of the best groups, until there are enough and the score goes down
+            candidates = []
+            last = None
+            for group, score in sorted(scores, key=lambda item: -item[1]):
+                if len(candidates) >= limit and score < last:
+                    break
+                # only the newest notes of a group can make it
+                newest = heapq.nlargest(limit + 1, self.group_notes[group])
+                candidates.extend((score, other) for other in newest if other != noteid)
+                last = score
+            best = heapq.nlargest(limit, candidates)
+            return [{"id": other, "title": self.titles[other], "score": round(score, 3)} for score, other in best]
+
+indexes = LRUCache(CACHE_SIZE)
+
+# index of the user, up to date with "version" (the user's data version read by the request) or newer
+# "ns" is a NoteService connected to the user's shard
+# like in autocomplete.py, a new index gets the version read in the same transaction as its rows
+def get_index(ns, userid, version):
+    index = indexes.get(userid)
+    if index is None or index.version < version:
+        with ns.snapshot():
+            version = ns.get_data_version(userid)[0]
+            index = RelatedIndex(version, ns.find_note_tags(userid))
+        indexes.set(userid, index)
+    return index
+
+# called after a write of the user's notes is committed
+# "version" is the data version after the write, "notes" maps noteid -> (title, tags), or None if it was deleted
+def apply_changes(userid, version, notes):
+    index = indexes.get(userid)
+    if index is None:
+        return
+    with index.lock:
+        # already built after the write
+        if index.version >= version:
+            return
+        # the index has missed another write, it will be built again
+        if index.version != version - 1:
+            indexes.pop(userid)
+            return
+        for noteid, note in notes.items():
+            if note is None:
+                index.set_note(noteid, None, ())
+            else:
+                index.set_note(noteid, *note)
+        index.version = version
+
+def invalidate(userid=None):
+    if userid is None:
+        indexes.clear()
+    else:
+        indexes.pop(userid)
@@ -0,0 +1,65 @@
+# Rendering of note contents to HTML on the server.
+# Independent from flask.
+
+import html
+import re
+import urllib.parse
+
+# markdown-it-py is optional: without it notes are shown as plain text
+try:
+    from markdown_it import MarkdownIt
+    from markdown_it.token import Token
+except ImportError:
+    MarkdownIt = None
+
+# replaces "<" -> "&lt;"; "\n" -> "<br>", etc
+def plain_to_html(s):
+    s = html.escape(s)
+    s = s.replace("\n", "<br>")
+    return s
+
+# Python port of static/markdown-it-headinganchor.js used before:
+# every heading gets an id and an anchor made of its text without spaces
+HEADING_ANCHOR_CLASS = "markdown-it-headinganchor"
+
+def _slugify(s):
+    return urllib.parse.quote(re.sub(r"\s", "", s), safe="-_.!~*'()")
+
+def _heading_anchors(state):
+    tokens = state.tokens
+    i = 0
+    while i < len(tokens) - 1:
+        if tokens[i].type != "heading_open" or tokens[i + 1].type != "inline" or not tokens[i + 1].content:
+            i += 1
+            continue
+        inline = tokens[i + 1]
+        anchor_name = _slugify(inline.content)
+        tokens[i].attrSet("id", anchor_name)
+        anchor = Token("html_inline", "", 0)
+        anchor.content = '<a name="{}" class="{}" href="#"></a>'.format(anchor_name, HEADING_ANCHOR_CLASS)
+        inline.children.insert(0, anchor)
+        i += 3
+
+def _make_markdown():
+    if MarkdownIt is None:
+        return None
+    # "js-default" matches markdown-it defaults used in browser:
+    # raw HTML is escaped, unsafe links (javascript: etc) are not rendered
+    md = MarkdownIt("js-default")
+    try:
+        md.enable("linkify")
+        md.options["linkify"] = True
+        # linkify-it-py is needed for this, check it is installed
+        md.render("http://example.com")
+    except Exception:
+        md = MarkdownIt("js-default")
+    md.core.ruler.push("heading_anchors", _heading_anchors)
+    return md
+
+_md = _make_markdown()
+
+# renders note contents (Markdown) to sanitized HTML
+def render_note(contents):
+    if _md is None:
+        return plain_to_html(contents)
+    return _md.render(contents)
@@ -0,0 +1,48 @@
+# Delta encoding of note revisions.
+# Independent from flask.
+#
+# A revision of a note is stored either as a full text ("full") or as a delta against
+# the previous revision ("delta"), so an edit costs about as much space as the changed lines.
+# Every SNAPSHOT_EVERY revisions a full text is stored again, so rebuilding any revision
+# takes at most SNAPSHOT_EVERY - 1 deltas.
+#
+# A delta is a JSON list of line operations applied to the previous text:
+#     [i, j]  - copy lines i..j-1 of the previous text
+#     "text"  - insert this text
+# e.g. [[0, 10], "changed line\n", [11, 40]]
+
+import difflib
+import json
+import os
+
+FULL = "full"
+DELTA = "delta"
+
+SNAPSHOT_EVERY = int(os.environ.get("TAGGED_REVISIONS_SNAPSHOT_EVERY", "10"))
+
+# retention: number of revisions kept for a note, and max age in days (0 - revisions don't expire)
+# the current version of a note is always kept
+KEEP = int(os.environ.get("TAGGED_REVISIONS_KEEP", "50"))
+MAX_AGE_DAYS = float(os.environ.get("TAGGED_REVISIONS_MAX_AGE_DAYS", "0"))
+
+def make_delta(old, new):
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+    ops = []
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            ops.append([i1, i2])
+        elif tag in ("replace", "insert"):
+            ops.append("".join(new_lines[j1:j2]))
+    return json.dumps(ops, ensure_ascii=False, separators=(",", ":"))
+
+def apply_delta(old, delta):
+    old_lines = old.splitlines(keepends=True)
+    parts = []
+    for op in json.loads(delta):
+        if isinstance(op, str):
+            parts.append(op)
+        else:
+            parts.extend(old_lines[op[0]:op[1]])
+    return "".join(parts)
@@ -0,0 +1,340 @@
+# Production server: several worker processes sharing one listening socket.
+#
+#     python -m tagged.serve [--bind HOST:PORT] [--workers N] [--threads N] [--max-requests N]
+#
+# The master process opens the socket and starts the workers; every worker is a new
+# Python process (so a reload picks up changed code), which imports the app, compiles
+# all templates and opens database connections before it starts accepting requests,
+# then serves them with a fixed pool of threads.
+#
+# Signals of the master:
+#     SIGHUP          - graceful reload: new workers are started, the old ones are stopped
+#                       when the new ones are ready
+#     SIGTERM, SIGINT - graceful shutdown: workers finish requests in progress and exit
+# A worker exits after MAX_REQUESTS requests (a few more for some workers, so that they
+# don't all restart at once) and the master starts another one.
+
+import argparse
+import concurrent.futures
+import logging
+import os
+import random
+import select
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+from . import common
+
+logger = logging.getLogger(__name__)
+
+BIND = os.environ.get("TAGGED_BIND", "127.0.0.1:8000")
+WORKERS = int(os.environ.get("TAGGED_WORKERS", str(os.cpu_count() or 1)))
+# a thread holds a database connection while it works, so there is no point in more threads than connections
+THREADS = int(os.environ.get("TAGGED_THREADS", str(common.POOL_SIZE)))
+# 0 - workers are not restarted
+MAX_REQUESTS = int(os.environ.get("TAGGED_MAX_REQUESTS", "0"))
+# a stopped worker is killed if it doesn't exit in this many seconds
+GRACEFUL_TIMEOUT = float(os.environ.get("TAGGED_GRACEFUL_TIMEOUT", "30"))
+
+BACKLOG = 2048
+
+# a new worker has this many seconds to become ready
+READY_TIMEOUT = 60
+
+# a worker which exits before it's ready is started again after this many seconds
+RESPAWN_DELAY = 1.0
+
+# share of MAX_REQUESTS randomly added to the limit of each worker
+MAX_REQUESTS_JITTER = 0.1
+
+def parse_bind(bind):
+    host, sep, port = bind.rpartition(":")
+    if not sep or not port.isdigit():
+        raise ValueError("address must be HOST:PORT: " + bind)
+    return host.strip("[]") or "0.0.0.0", int(port)
+
+# --- worker ---
+
+# no keep-alive: an idle connection would hold a thread of the pool
+# (put a reverse proxy in front of the server for keep-alive)
+class RequestHandler(WSGIRequestHandler):
+
+    protocol_version = "HTTP/1.0"
+
+# requests of the shared socket are handled by a fixed pool of threads;
+# the accept loop waits while all threads are busy, so other workers take the connections
+class PooledWSGIServer(BaseWSGIServer):
+
+    multithread = True
+
+    def __init__(self, host, port, app, fd, threads, max_requests=0):
+        super().__init__(host, port, app, handler=RequestHandler, fd=fd)
+        self.threads = threads
+        self.max_requests = max_requests
+        self.requests = 0
+        self._free = threading.BoundedSemaphore(threads)
+        self._executor = concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix="request")
+        self._counter_lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def process_request(self, request, client_address):
+        self._free.acquire()
+        try:
+            self._executor.submit(self._process, request, client_address)
+        except RuntimeError:
+            # the pool is shut down
+            self._free.release()
+            self.shutdown_request(request)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._free.release()
+            with self._counter_lock:
+                self.requests += 1
+                recycle = self.max_requests and self.requests >= self.max_requests
+            if recycle:
+                self.stop()
+
+    # stops accepting connections; can be called from any thread, serve_forever() returns
+    def stop(self):
+        if not self._stopping.is_set():
+            self._stopping.set()
+            threading.Thread(target=self.shutdown, name="server-shutdown").start()
+
+    # waits for requests in progress
+    def drain(self):
+        self._executor.shutdown(wait=True)
+
+# compiles all templates, reads the assets manifest,
+# opens "n" connections (at most the pool size) to every shard and loads the schema
+def warm_up(app, n):
+    from . import assets
+    from . import sharding
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    assets.get_manifest()
+    with common.get_con() as con:
+        shards = sharding.all_shards(con)
+    for shard in shards:
+        sharding.prepare_shard(shard)
+        pool = common.get_pool(sharding.shard_path(shard))
+        cons = [pool.acquire() for i in range(min(n, pool.size))]
+        for con in cons:
+            con.execute("SELECT count(*) FROM sqlite_master").fetchone()
+        for con in cons:
+            pool.release(con)
+
+def run_worker(args):
+    # the master handles Ctrl+C and stops workers with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    master = os.getppid()
+    from . import app
+    from . import services
+    from . import jobs
+    warm_up(app, args.threads)
+    services.session_sweeper.ensure_started()
+    jobs.runner.ensure_started()
+    host, port = parse_bind(args.bind)
+    max_requests = args.max_requests
+    if max_requests:
+        max_requests += random.randint(0, int(max_requests * MAX_REQUESTS_JITTER))
+    server = PooledWSGIServer(host, port, app, args.fd, args.threads, max_requests)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+
+    # the master was killed: stop too
+    def watch_master():
+        while not server._stopping.wait(1):
+            if os.getppid() != master:
+                logger.warning("master process is gone, stopping")
+                server.stop()
+
+    threading.Thread(target=watch_master, name="master-watch", daemon=True).start()
+    os.write(args.ready_fd, b"1")
+    os.close(args.ready_fd)
+    server.serve_forever()
+    server.drain()
+    # running jobs are interrupted and queued again for the other workers
+    jobs.runner.stop()
+    server.server_close()
+
+# --- master ---
+
+class Worker:
+
+    def __init__(self, proc, generation, ready_pipe):
+        self.proc = proc
+        self.generation = generation
+        self.ready_pipe = ready_pipe
+        self.ready = False
+        self.started = time.monotonic()
+        self.stop_deadline = None
+
+    def stop(self):
+        if self.stop_deadline is None:
+            self.stop_deadline = time.monotonic() + GRACEFUL_TIMEOUT
+            self.proc.terminate()
+
+    def close_pipe(self):
+        if self.ready_pipe is not None:
+            os.close(self.ready_pipe)
+            self.ready_pipe = None
+
+class Master:
+
+    def __init__(self, sock, args):
+        self.sock = sock
+        self.args = args
+        self.workers = []
+        self.generation = 0
+        self.signal = None
+        self.respawn_after = 0
+
+    def spawn(self):
+        ready_read, ready_write = os.pipe()
+        cmd = [sys.executable, "-m", __spec__.name, "worker",
+            "--bind", self.args.bind, "--threads", str(self.args.threads), "--max-requests", str(self.args.max_requests),
+            "--fd", str(self.sock.fileno()), "--ready-fd", str(ready_write)]
+        try:
+            proc = subprocess.Popen(cmd, pass_fds=(self.sock.fileno(), ready_write))
+        finally:
+            os.close(ready_write)
+        self.workers.append(Worker(proc, self.generation, ready_read))
+        logger.info("started worker %s", proc.pid)
+
+    def _on_signal(self, signum, frame):
+        self.signal = signum
+
+    def run(self):
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._on_signal)
+        while True:
+            signum, self.signal = self.signal, None
+            if signum == signal.SIGHUP:
+                logger.info("reloading")
+                self.generation += 1
+            elif signum in (signal.SIGTERM, signal.SIGINT):
+                self.shutdown()
+                return
+            self._reap()
+            self._spawn_missing()
+            self._wait_ready(0.5)
+            self._retire_old()
+            self._kill_stuck()
+
+    def _current(self):
+        return [w for w in self.workers if w.generation == self.generation and w.stop_deadline is None]
+
+    def _reap(self):
+        for w in list(self.workers):
+            code = w.proc.poll()
+            if code is None:
+                continue
+            self.workers.remove(w)
+            w.close_pipe()
+            if w.stop_deadline is None:
+                logger.info("worker %s exited with code %s", w.proc.pid, code)
+                if not w.ready:
+                    self.respawn_after = time.monotonic() + RESPAWN_DELAY
+
+    def _spawn_missing(self):
+        if time.monotonic() < self.respawn_after:
+            return
+        for i in range(self.args.workers - len(self._current())):
+            self.spawn()
+
+    def _wait_ready(self, timeout):
+        pipes = {w.ready_pipe: w for w in self.workers if w.ready_pipe is not None}
+        if not pipes:
+            time.sleep(timeout)
+            return
+        readable, _, _ = select.select(list(pipes), [], [], timeout)
+        for fd in readable:
+            w = pipes[fd]
+            w.ready = os.read(fd, 1) == b"1"
+            w.close_pipe()
+        now = time.monotonic()
+        for w in self.workers:
+            if not w.ready and w.ready_pipe is not None and now - w.started > READY_TIMEOUT:
+                logger.error("worker %s didn't become ready in %s seconds", w.proc.pid, READY_TIMEOUT)
+                w.close_pipe()
+                w.stop()
+
+    # workers of previous generations are stopped when all new ones are ready
+    def _retire_old(self):
+        old = [w for w in self.workers if w.generation != self.generation and w.stop_deadline is None]
+        if not old:
+            return
+        current = self._current()
+        if len(current) >= self.args.workers and all(w.ready for w in current):
+            for w in old:
+                w.stop()
+
+    def _kill_stuck(self):
+        now = time.monotonic()
+        for w in self.workers:
+            if w.stop_deadline is not None and now > w.stop_deadline and w.proc.poll() is None:
+                logger.warning("worker %s didn't stop in %s seconds, killing it", w.proc.pid, GRACEFUL_TIMEOUT)
+                w.proc.kill()
+
+    def shutdown(self):
+        logger.info("shutting down")
+        for w in self.workers:
+            w.stop()
+        while self.workers:
+            self._reap()
+            self._kill_stuck()
+            time.sleep(0.1)
+        self.sock.close()
+
+def run_master(args):
+    from . import assets
+    # once here, not by every worker at the same time
+    assets.get_manifest()
+    host, port = parse_bind(args.bind)
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.create_server((host, port), family=family, backlog=BACKLOG)
+    # logouts must reach the session caches of all workers
+    if args.workers > 1 and not os.environ.get("TAGGED_SESSION_INVALIDATION_FILE"):
+        os.environ["TAGGED_SESSION_INVALIDATION_FILE"] = os.path.abspath(common.DB_PATH) + "-sessions"
+    logger.info("listening on %s:%s, %s workers with %s threads", host, port, args.workers, args.threads)
+    Master(sock, args).run()
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-process server of tagged")
+    parser.add_argument("--bind", default=BIND, help="HOST:PORT to listen on (default: TAGGED_BIND or 127.0.0.1:8000)")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="number of worker processes (default: TAGGED_WORKERS or number of CPUs)")
+    parser.add_argument("--threads", type=int, default=THREADS, help="request threads of a worker (default: TAGGED_THREADS or TAGGED_POOL_SIZE)")
+    parser.add_argument("--max-requests", type=int, default=MAX_REQUESTS, help="restart a worker after this many requests, 0 - never (default: TAGGED_MAX_REQUESTS or 0)")
+    parser.add_argument("--db", help="database file (default: TAGGED_DB or tagged.db)")
+    commands = parser.add_subparsers(dest="command")
+    # started by the master
+    p = commands.add_parser("worker")
+    p.add_argument("--bind", default=BIND)
+    p.add_argument("--threads", type=int, default=THREADS)
+    p.add_argument("--max-requests", type=int, default=MAX_REQUESTS)
+    p.add_argument("--fd", type=int, required=True)
+    p.add_argument("--ready-fd", type=int, required=True)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(process)d] %(levelname)s %(name)s: %(message)s")
+    if args.db:
+        # workers are new processes, they get the path from the environment
+        os.environ["TAGGED_DB"] = args.db
+        common.configure(path=args.db)
+    if args.command == "worker":
+        run_worker(args)
+    else:
+        run_master(args)
+
+if __name__ == "__main__":
+    main()
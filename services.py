@@ -5,8 +5,24 @@
 import datetime
 import base64
 import hashlib
+import os
+import sqlite3
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
 
 from . import common
+from . import render
+from . import compression
+from . import revisions
+from . import autocomplete
+from . import related
+from .cache import LRUCache, FileInvalidationChannel
+from .records import NoteRecord, UserRecord
+
+logger = logging.getLogger(__name__)
 
 class UserSearchException(Exception):
     def __init__(self, *args, **kwargs):
@@ -21,7 +37,7 @@ class UserService:
         query = """SELECT id, username, passhash FROM users WHERE id = ?"""
         cur = self.con.cursor()
         cur.execute(query, (userid,))
-        userdata = common.fetchall_as_dict(cur) 
+        userdata = common.fetchall_as(cur, UserRecord)
         cur.close()
         if not userdata:
             raise UserSearchException()
@@ -31,7 +47,7 @@ class UserService:
         query = """SELECT id, username, passhash FROM users WHERE username = ?"""
         cur = self.con.cursor()
         cur.execute(query, (username,))
-        userdata = common.fetchall_as_dict(cur) 
+        userdata = common.fetchall_as(cur, UserRecord)
         cur.close()
         if not userdata:
             return None
@@ -42,24 +58,73 @@ class UserService:
         query = """INSERT INTO users (username, passhash) VALUES (?, ?)"""
         cur = self.con.cursor()
         cur.execute(query, (username, passhash))
+        userid = cur.lastrowid
+        cur.close()
         self.con.commit()
+        return userid
+
+# sessions expire after SESSION_IDLE_TIMEOUT seconds without requests,
+# and SESSION_MAX_AGE seconds after login anyway
+SESSION_IDLE_TIMEOUT = int(os.environ.get("TAGGED_SESSION_IDLE_TIMEOUT", str(30 * 24 * 60 * 60)))
+SESSION_MAX_AGE = int(os.environ.get("TAGGED_SESSION_MAX_AGE", str(365 * 24 * 60 * 60)))
+
+# last_seen_ts of a session is updated at most once in this many seconds,
+# so that most requests don't write to the database
+SESSION_TOUCH_INTERVAL = int(os.environ.get("TAGGED_SESSION_TOUCH_INTERVAL", "300"))
+
+# token -> (userid, created_ts, last_seen_ts) cache in front of SessionService.get_userid
+SESSION_CACHE_SIZE = int(os.environ.get("TAGGED_SESSION_CACHE_SIZE", "10000"))
+SESSION_CACHE_TTL = float(os.environ.get("TAGGED_SESSION_CACHE_TTL", "60"))
+session_cache = LRUCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+
+# with several worker processes, deactivated tokens are announced through this file
+# so that other processes drop them from their caches too
+# without it, a deactivated token may stay valid in other processes for SESSION_CACHE_TTL seconds
+SESSION_INVALIDATION_FILE = os.environ.get("TAGGED_SESSION_INVALIDATION_FILE")
+session_invalidations = None
+if SESSION_INVALIDATION_FILE:
+    session_invalidations = FileInvalidationChannel(SESSION_INVALIDATION_FILE)
 
 class SessionService:
 
     def __init__(self, con):
         self.con = con
 
+    # a logout of another request may happen between reading the session and caching it:
+    # then it's not cached (see LRUCache.set_unless_invalidated)
     def get_userid(self, token):
-        query = """SELECT userid FROM sessions, users WHERE sessions.active = TRUE AND sessions.userid = users.id AND sessions.id = ?"""
+        self._sync_cache()
+        generation = session_cache.generation
+        now = int(time.time())
+        session = session_cache.get(token)
+        if session is None:
+            query = """SELECT sessions.userid, sessions.created_ts, sessions.last_seen_ts FROM sessions, users
+                WHERE sessions.active = TRUE AND sessions.userid = users.id AND sessions.id = ?"""
+            cur = self.con.cursor()
+            cur.execute(query, (token,))
+            sessions = cur.fetchall()
+            cur.close()
+            # if token was wrong, no rows are returned
+            if not sessions:
+                return None
+            # otherwise, a single row is returned
+            session = sessions[0]
+        userid, created_ts, last_seen_ts = session
+        if now - last_seen_ts > SESSION_IDLE_TIMEOUT or now - created_ts > SESSION_MAX_AGE:
+            # the row is deleted by the sweeper
+            session_cache.pop(token)
+            return None
+        if now - last_seen_ts >= SESSION_TOUCH_INTERVAL:
+            self._touch(token, now)
+            session = (userid, created_ts, now)
+        session_cache.set_unless_invalidated(token, session, generation)
+        return userid
+
+    def _touch(self, token, now):
         cur = self.con.cursor()
-        cur.execute(query, (token,))
-        userids = cur.fetchall()
+        cur.execute("""UPDATE sessions SET last_seen_ts = ? WHERE id = ? AND last_seen_ts < ?""", (now, token, now))
         cur.close()
-        # if token was wrong, no rows are returned
-        if not userids:
-            return None
-        # otherwise, a single row is returned
-        return userids[0][0]
+        self.con.commit()
 
     def session_exists(self, token):
         query = """SELECT * FROM sessions WHERE id = ?"""
@@ -70,130 +135,741 @@ class SessionService:
         return False
 
     def create_session(self, userid, token):
-        query = """INSERT INTO sessions (id, userid, active) VALUES (?, ?, TRUE)"""
+        query = """INSERT INTO sessions (id, userid, active, created_ts, last_seen_ts) VALUES (?, ?, TRUE, ?, ?)"""
+        now = int(time.time())
         cur = self.con.cursor()
-        cur.execute(query, (token, userid))
+        cur.execute(query, (token, userid, now, now))
         cur.close()
 
+    # the change is committed right away:
+    # other processes must not see the session as active after it was dropped from caches
     def deactivate_session(self, token):
-        query = """UPDATE sessions SET active = FALSE where id = ?"""
+        query = """DELETE FROM sessions WHERE id = ?"""
         cur = self.con.cursor()
         cur.execute(query, (token,))
         cur.close()
+        self.con.commit()
+        session_cache.pop(token)
+        if session_invalidations is not None:
+            session_invalidations.publish(token)
+
+    # deletes up to "limit" expired sessions, returns the number of deleted ones
+    def delete_expired(self, limit):
+        now = int(time.time())
+        cur = self.con.cursor()
+        cur.execute("""DELETE FROM sessions WHERE id IN (SELECT id FROM sessions
+            WHERE last_seen_ts < ? OR created_ts < ? LIMIT ?)""", (now - SESSION_IDLE_TIMEOUT, now - SESSION_MAX_AGE, limit))
+        n = cur.rowcount
+        cur.close()
+        self.con.commit()
+        return n
+
+    # drop tokens deactivated by other processes
+    def _sync_cache(self):
+        if session_invalidations is None:
+            return
+        tokens = session_invalidations.poll()
+        if tokens is None:
+            session_cache.clear()
+            return
+        for token in tokens:
+            session_cache.pop(token)
+
+# deletes expired sessions in background: every SESSION_SWEEP_INTERVAL seconds,
+# in batches of SESSION_SWEEP_BATCH rows with a pause between them,
+# so that the write lock is never held for long
+SESSION_SWEEP_INTERVAL = float(os.environ.get("TAGGED_SESSION_SWEEP_INTERVAL", "600"))
+SESSION_SWEEP_BATCH = int(os.environ.get("TAGGED_SESSION_SWEEP_BATCH", "500"))
+SESSION_SWEEP_PAUSE = 0.05
+
+class SessionSweeper:
+
+    def __init__(self, interval=SESSION_SWEEP_INTERVAL, batch_size=SESSION_SWEEP_BATCH):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.deleted = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    # starts the thread if it's not running in this process (e.g. in a child after fork)
+    def ensure_started(self):
+        if self._pid == os.getpid() or self.interval <= 0:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="session-sweeper", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("session sweep failed")
+
+    # returns the number of deleted sessions
+    def sweep(self):
+        total = 0
+        while True:
+            with common.get_con() as con:
+                n = SessionService(con).delete_expired(self.batch_size)
+            total += n
+            self.deleted += n
+            if n < self.batch_size:
+                return total
+            time.sleep(SESSION_SWEEP_PAUSE)
+
+session_sweeper = SessionSweeper()
 
 class NoteSearchException(Exception):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+# the user's notes were moved to another shard after the connection to this one was chosen
+# (see sharding.move_user), the request should be repeated
+class UserMovedException(Exception):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+# max number of note ids in a single "IN (...)" query
+TAGS_BATCH_SIZE = 500
+
+# columns needed to show a note in lists
+LIST_COLUMNS = "notes.id,notes.title,notes.tags,notes.date_modified,notes.modified_ts"
+
+# pagination cursor is a string "<modified_ts>_<id>" of the last note on a page
+def make_cursor(note):
+    return "{}_{}".format(note["modified_ts"], note["id"])
+
+def parse_cursor(cursor):
+    modified_ts, _, noteid = cursor.partition("_")
+    if not modified_ts.isdigit() or not noteid.isdigit():
+        raise NoteSearchException()
+    return [int(modified_ts), int(noteid)]
+
+# a page of notes
+# next_cursor points to older notes, prev_cursor points to newer ones (None if there are no such notes)
+class NotePage:
+
+    def __init__(self, notes, next_cursor=None, prev_cursor=None):
+        self.notes = notes
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.notes)
+
+    def __len__(self):
+        return len(self.notes)
+
 class NoteService:
 
     def __init__(self, con):
         self.con = con
 
-    def get_last_notes(self, userid, n=10):
-        query =  """SELECT id,title,contents,date_created,tags,date_modified FROM notes WHERE userid=? ORDER BY date_modified DESC LIMIT ?"""
+    # "contents" of returned notes is loaded when it's accessed
+    def _fetch_notes(self, cur):
+        notes = common.fetchall_as(cur, NoteRecord)
+        for note in notes:
+            note.loader = self
+        return notes
+
+    def count_notes(self, userid):
         cur = self.con.cursor()
-        cur.execute(query, (userid, n))
-        notes = common.fetchall_as_dict(cur)
+        cur.execute("""SELECT count(*) FROM notes WHERE userid=?""", (userid,))
+        count = cur.fetchone()[0]
         cur.close()
-        return notes
+        return count
 
-    def get_all_notes(self, userid):
-        query =  """SELECT id,title,contents,date_created,tags,date_modified FROM notes WHERE userid=? ORDER BY date_modified DESC"""
+    # contents of a note as stored (possibly compressed), for NoteRecord
+    def load_contents(self, noteid):
         cur = self.con.cursor()
-        cur.execute(query, (userid,))
-        notes = common.fetchall_as_dict(cur)
+        cur.execute("""SELECT contents FROM notes WHERE id=?""", (noteid,))
+        row = cur.fetchone()
         cur.close()
-        return notes
+        if row is None:
+            raise NoteSearchException()
+        return row[0]
+
+    # yields all notes of the user (with contents) one by one,
+    # fetching them from database in chunks, so they never are all in memory
+    def iter_notes(self, userid, chunk_size=500):
+        query =  """SELECT id,title,contents,date_created,tags,date_modified FROM notes WHERE userid=? ORDER BY modified_ts DESC, id DESC"""
+        cur = self.con.cursor()
+        try:
+            cur.execute(query, (userid,))
+            colnames = [descr[0] for descr in cur.description]
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    note = dict(zip(colnames, row))
+                    note["contents"] = compression.unpack(note["contents"])
+                    yield note
+        finally:
+            cur.close()
 
+    # "contents_html" of the note is its rendered contents
+    # "contents" is loaded when it's accessed: the note page needs only contents_html
     def get_note(self, userid, noteid):
-        query = """SELECT id,title,tags,contents,date_created,date_modified FROM notes WHERE id=? AND userid=?"""
+        query = """SELECT id,title,tags,date_created,date_modified,modified_ts,contents_html,html_date_modified FROM notes WHERE id=? AND userid=?"""
         cur = self.con.cursor()
         cur.execute(query, (noteid, userid))
-        result = common.fetchall_as_dict(cur)
+        result = self._fetch_notes(cur)
         cur.close()
         if not result:
             raise NoteSearchException()
-        return result[0]
+        self._attach_tags(result)
+        note = result[0]
+        note["contents_html"] = compression.unpack(note["contents_html"])
+        # render notes saved before rendering on the server was added
+        if note["html_date_modified"] != note["date_modified"]:
+            note["contents_html"] = render.render_note(note["contents"])
+            cur = self.con.cursor()
+            cur.execute("""UPDATE notes SET contents_html=?, html_date_modified=? WHERE id=? AND date_modified=?""",
+                (compression.pack(note["contents_html"]), note["date_modified"], noteid, note["date_modified"]))
+            cur.close()
+            self.con.commit()
+        return note
+
+    # a page of notes ordered by (modified_ts, id), newest first
+    # only the columns needed by note lists are fetched
+    def list_notes(self, userid, limit=50, after=None, before=None):
+        return self._get_page("notes.userid=?", [userid], limit, after, before)
 
-    def search_notes(self, userid, keywords, tags):
+    # keywords are matched as prefixes against title and contents,
+    # results are ranked by relevance (bm25), only "limit" best results are returned;
+    # search by tags only is paginated like list_notes
+    def search_notes(self, userid, keywords, tags, limit=100, after=None, before=None):
         if not keywords and not tags:
             raise NoteSearchException()
         if not all(map(common.validate_tag, tags)):
             raise NoteSearchException()
         if not all(map(common.validate_tag, keywords)):
             raise NoteSearchException()
-        keywordsLike = list(map(lambda k: ["%" + k + "%"]*2, keywords))
-        keywordsLike = sum(keywordsLike, [])
-        tagsLike = list(map(lambda t: "%" + t + "%", tags))
-        queryParts = ["""SELECT id,title,contents,date_created,tags,date_modified FROM notes WHERE userid=? """]
         if keywords:
-            queryParts.append(" AND ")
-            queryParts.append("(" + "OR".join(["(title LIKE ? OR contents LIKE ?)"] * len(keywords)) + ")")
+            try:
+                return self._search_notes_fts(userid, keywords, tags, limit)
+            except sqlite3.OperationalError:
+                # no FTS5 in this sqlite build (or no index yet)
+                pass
+        return self._search_notes_like(userid, keywords, tags, limit, after, before)
+
+    def _search_notes_fts(self, userid, keywords, tags, limit):
+        match = " OR ".join('"' + k + '"*' for k in keywords)
+        queryParts = ["SELECT " + LIST_COLUMNS + """
+            FROM notes_fts JOIN notes ON notes.id = notes_fts.rowid
+            WHERE notes_fts MATCH ? AND notes.userid=? """]
+        params = [match, userid]
         if tags:
             queryParts.append(" AND ")
-            queryParts.append("(" + "OR".join(["(tags LIKE ?)"] * len(tags)) + ")")
+            queryParts.append(self._tags_condition(tags))
+            params += [userid] + tags
+        queryParts.append(" ORDER BY bm25(notes_fts) LIMIT ?")
         query = "".join(queryParts)
 
         cur = self.con.cursor()
-        cur.execute(query, [userid] + keywordsLike + tagsLike)
-        notes = common.fetchall_as_dict(cur)
+        cur.execute(query, params + [limit])
+        notes = self._fetch_notes(cur)
         cur.close()
-        return notes
+        self._attach_tags(notes)
+        return NotePage(notes)
+
+    def _search_notes_like(self, userid, keywords, tags, limit, after, before):
+        keywordsLike = list(map(lambda k: ["%" + k + "%"]*2, keywords))
+        keywordsLike = sum(keywordsLike, [])
+        whereParts = ["notes.userid=?"]
+        params = [userid] + keywordsLike
+        if keywords:
+            whereParts.append(" AND ")
+            whereParts.append("(" + "OR".join(["(notes.title LIKE ? OR contents_text(notes.contents) LIKE ?)"] * len(keywords)) + ")")
+        if tags:
+            whereParts.append(" AND ")
+            whereParts.append(self._tags_condition(tags))
+            params += [userid] + tags
+        return self._get_page("".join(whereParts), params, limit, after, before)
+
+    # keyset pagination by (modified_ts, id):
+    # "after" gives notes older than the cursor, "before" gives notes newer than it
+    def _get_page(self, where, params, limit, after=None, before=None):
+        order = "DESC"
+        if after is not None:
+            where += " AND (notes.modified_ts, notes.id) < (?, ?)"
+            params = params + parse_cursor(after)
+        elif before is not None:
+            where += " AND (notes.modified_ts, notes.id) > (?, ?)"
+            params = params + parse_cursor(before)
+            order = "ASC"
+        query = "SELECT " + LIST_COLUMNS + " FROM notes WHERE " + where + \
+            " ORDER BY notes.modified_ts {0}, notes.id {0} LIMIT ?".format(order)
+
+        cur = self.con.cursor()
+        # one extra row tells if there are more notes
+        cur.execute(query, params + [limit + 1])
+        notes = self._fetch_notes(cur)
+        cur.close()
+        has_more = len(notes) > limit
+        notes = notes[:limit]
+        if before is not None:
+            notes.reverse()
+        self._attach_tags(notes)
+
+        next_cursor = None
+        prev_cursor = None
+        if notes:
+            if has_more or before is not None:
+                next_cursor = make_cursor(notes[-1])
+            if (has_more and before is not None) or after is not None:
+                prev_cursor = make_cursor(notes[0])
+        return NotePage(notes, next_cursor, prev_cursor)
+
+    # condition for notes having any of given tags
+    # expects userid and tags as parameters
+    def _tags_condition(self, tags):
+        return "notes.id IN (SELECT noteid FROM note_tags WHERE userid=? AND tag IN (" + ",".join(["?"] * len(tags)) + "))"
+
+    # keep full-text index in sync with notes table
+    # does nothing if sqlite was built without FTS5
+    def _index_note(self, cur, noteid, title, contents):
+        try:
+            cur.execute("""INSERT INTO notes_fts(rowid, title, contents) VALUES (?, ?, ?)""", (noteid, title, contents))
+        except sqlite3.OperationalError:
+            pass
+
+    # "title" and "contents" are the ones the note was indexed with:
+    # a contentless index without contentless_delete (see migrations.create_fts) needs them to delete it
+    def _unindex_note(self, cur, noteid, title, contents):
+        try:
+            cur.execute("""DELETE FROM notes_fts WHERE rowid=?""", (noteid,))
+        except sqlite3.OperationalError:
+            try:
+                cur.execute("""INSERT INTO notes_fts(notes_fts, rowid, title, contents) VALUES ('delete', ?, ?, ?)""",
+                    (noteid, title, contents))
+            except sqlite3.OperationalError:
+                pass
+
+    # keep note_tags and tag_counts in sync with notes.tags
+    def _set_tags(self, cur, userid, noteid, tags):
+        cur.execute("""SELECT tag FROM note_tags WHERE noteid=?""", (noteid,))
+        old_tags = set(row[0] for row in cur.fetchall())
+        new_tags = set(tags)
+        cur.execute("""DELETE FROM note_tags WHERE noteid=?""", (noteid,))
+        rows = [(noteid, userid, tag, pos) for pos, tag in enumerate(tags)]
+        cur.executemany("""INSERT OR IGNORE INTO note_tags (noteid, userid, tag, pos) VALUES (?, ?, ?, ?)""", rows)
+        changes = Counter()
+        for tag in old_tags - new_tags:
+            changes[tag] -= 1
+        for tag in new_tags - old_tags:
+            changes[tag] += 1
+        self._update_tag_counts(cur, userid, changes)
+        return changes
+
+    # changes is a mapping tag -> difference of the number of notes with this tag
+    def _update_tag_counts(self, cur, userid, changes):
+        if not changes:
+            return
+        cur.executemany("""INSERT INTO tag_counts (userid, tag, count) VALUES (?, ?, ?)
+            ON CONFLICT (userid, tag) DO UPDATE SET count = count + excluded.count""",
+            [(userid, tag, n) for tag, n in changes.items() if n != 0])
+        cur.executemany("""DELETE FROM tag_counts WHERE userid=? AND tag=? AND count <= 0""",
+            [(userid, tag) for tag, n in changes.items() if n < 0])
+
+    # sets "tag_list" of every note to the list of its tags from note_tags
+    def _attach_tags(self, notes):
+        tag_lists = {}
+        for note in notes:
+            note["tag_list"] = tag_lists[note["id"]] = []
+        noteids = list(tag_lists)
+        cur = self.con.cursor()
+        for i in range(0, len(noteids), TAGS_BATCH_SIZE):
+            batch = noteids[i:i + TAGS_BATCH_SIZE]
+            query = "SELECT noteid, tag FROM note_tags WHERE noteid IN (" + ",".join(["?"] * len(batch)) + ") ORDER BY noteid, pos"
+            cur.execute(query, batch)
+            for noteid, tag in cur.fetchall():
+                tag_lists[noteid].append(tag)
+        cur.close()
+
+    # every change of notes starts with this: takes the write lock
+    # and makes sure the user's notes are still in this database
+    def _begin_write(self, cur, userid):
+        if not self.con.in_transaction:
+            cur.execute("BEGIN IMMEDIATE")
+        cur.execute("""SELECT 1 FROM moved_users WHERE userid=?""", (userid,))
+        if cur.fetchone() is not None:
+            self.con.rollback()
+            raise UserMovedException()
 
     def delete_note(self, userid, noteid):
         query = """DELETE FROM notes WHERE id=? and userid=?"""
         cur = self.con.cursor()
+        self._begin_write(cur, userid)
+        cur.execute("""SELECT title, contents FROM notes WHERE id=? AND userid=?""", (noteid, userid))
+        titles = cur.fetchall()
         cur.execute(query, (noteid, userid))
         n = cur.rowcount
+        if n == 1:
+            self._unindex_note(cur, noteid, titles[0][0], compression.unpack(titles[0][1]))
+            tag_changes = self._set_tags(cur, userid, noteid, [])
+            version = self._bump_version(cur, userid)
+            cur.execute("""DELETE FROM note_revisions WHERE noteid=?""", (noteid,))
+        self._delete_draft(cur, userid, noteid)
         self.con.commit()
         cur.close()
+        if n == 1:
+            autocomplete.apply_changes(userid, version, tag_changes, Counter({titles[0][0]: -1}))
+            related.apply_changes(userid, version, {noteid: None})
         return n == 1
 
+    # last note id allocated in this database
+    # ids are allocated from the range of the shard (see sharding.SHARD_ID_RANGE) by its counter in sqlite_sequence;
+    # notes moved here from other shards keep ids of their ranges, so max(id) is not used
+    def _last_note_id(self, cur):
+        cur.execute("""SELECT seq FROM sqlite_sequence WHERE name='notes'""")
+        row = cur.fetchone()
+        return row[0] if row is not None else 0
+
     def create_note(self, userid, title, contents, tags):
-        query = """INSERT INTO notes(title,contents,date_created,tags,date_modified,userid)VALUES(?,?,?,?,?,?)"""
-        tags = " ".join(tags)
-        curdt = datetime.datetime.strftime(datetime.datetime.now(), "%Y-%m-%d %H:%M:%S")
+        query = """INSERT INTO notes(id,title,contents,date_created,tags,date_modified,userid,contents_html,html_date_modified,created_ts,modified_ts)VALUES(?,?,?,?,?,?,?,?,?,?,?)"""
+        curdt = datetime.datetime.strftime(datetime.datetime.now(), common.DATE_FORMAT)
+        curts = common.date_to_ts(curdt)
+        contents_html = render.render_note(contents)
         cur = self.con.cursor()
-        cur.execute(query, (title, contents, curdt, tags, curdt, userid))
-        noteid = cur.lastrowid
+        self._begin_write(cur, userid)
+        noteid = self._last_note_id(cur) + 1
+        cur.execute(query, (noteid, title, compression.pack(contents), curdt, " ".join(tags), curdt, userid, compression.pack(contents_html), curdt, curts, curts))
+        self._index_note(cur, noteid, title, contents)
+        tag_changes = self._set_tags(cur, userid, noteid, tags)
+        version = self._bump_version(cur, userid)
+        self._delete_draft(cur, userid, 0)
         cur.close()
         self.con.commit()
+        autocomplete.apply_changes(userid, version, tag_changes, Counter({title: 1}))
+        related.apply_changes(userid, version, {noteid: (title, tags)})
         return noteid
 
     def update_note(self, userid, noteid, title, contents, tags):
-        query = "UPDATE notes SET title=?,contents=?,tags=?,date_modified=? WHERE id=?"
-        tags = " ".join(tags)
-        curdt = datetime.datetime.strftime(datetime.datetime.now(), "%Y-%m-%d %H:%M:%S")
+        query = "UPDATE notes SET title=?,contents=?,tags=?,date_modified=?,contents_html=?,html_date_modified=?,modified_ts=? WHERE id=? AND userid=?"
+        curdt = datetime.datetime.strftime(datetime.datetime.now(), common.DATE_FORMAT)
+        contents_html = render.render_note(contents)
+        curts = common.date_to_ts(curdt)
+        cur = self.con.cursor()
+        self._begin_write(cur, userid)
+        cur.execute("""SELECT title, contents, tags, date_modified, modified_ts FROM notes WHERE id=? AND userid=?""", (noteid, userid))
+        old = common.fetchall_as_dict(cur)
+        cur.execute(query, (title, compression.pack(contents), " ".join(tags), curdt, compression.pack(contents_html), curdt, curts, noteid, userid))
+        updated = cur.rowcount == 1
+        if updated:
+            old = old[0]
+            old["contents"] = compression.unpack(old["contents"])
+            self._unindex_note(cur, noteid, old["title"], old["contents"])
+            self._index_note(cur, noteid, title, contents)
+            tag_changes = self._set_tags(cur, userid, noteid, tags)
+            version = self._bump_version(cur, userid)
+            new = {"title": title, "contents": contents, "tags": " ".join(tags), "date_modified": curdt, "modified_ts": curts}
+            self._record_revision(cur, userid, noteid, old, new)
+        self._delete_draft(cur, userid, noteid)
+        cur.close()
+        self.con.commit()
+        if updated:
+            title_changes = Counter({title: 1})
+            title_changes[old["title"]] -= 1
+            autocomplete.apply_changes(userid, version, tag_changes, title_changes)
+            related.apply_changes(userid, version, {noteid: (title, tags)})
+
+    # revision history (see revisions.py)
+    # the history of a note starts at its first edit: then the version before the edit
+    # becomes revision 1 and the new version revision 2
+    def _record_revision(self, cur, userid, noteid, old, new):
+        if all(old[key] == new[key] for key in ("title", "contents", "tags")):
+            return
+        cur.execute("""SELECT max(revno), max(CASE WHEN kind=? THEN revno END) FROM note_revisions WHERE noteid=?""",
+            (revisions.FULL, noteid))
+        last, last_full = cur.fetchone()
+        if last is None:
+            self._insert_revision(cur, userid, noteid, 1, revisions.FULL, old["contents"], old)
+            last = last_full = 1
+        revno = last + 1
+        if revno - last_full >= revisions.SNAPSHOT_EVERY:
+            self._insert_revision(cur, userid, noteid, revno, revisions.FULL, new["contents"], new)
+        else:
+            self._insert_revision(cur, userid, noteid, revno, revisions.DELTA, revisions.make_delta(old["contents"], new["contents"]), new)
+        self._prune_revisions(cur, noteid, revno)
+
+    def _insert_revision(self, cur, userid, noteid, revno, kind, data, note):
+        cur.execute("""INSERT INTO note_revisions (noteid, revno, userid, kind, data, title, tags, date_modified, modified_ts, size)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (noteid, revno, userid, kind, compression.pack(data), note["title"], note["tags"],
+                note["date_modified"], note["modified_ts"], len(note["contents"])))
+
+    # text of the revision: the nearest full text before it with the following deltas applied
+    def _revision_text(self, cur, noteid, revno):
+        cur.execute("""SELECT kind, data FROM note_revisions WHERE noteid=? AND revno<=?
+            AND revno >= (SELECT max(revno) FROM note_revisions WHERE noteid=? AND revno<=? AND kind=?)
+            ORDER BY revno""", (noteid, revno, noteid, revno, revisions.FULL))
+        text = None
+        for kind, data in cur.fetchall():
+            data = compression.unpack(data)
+            text = data if kind == revisions.FULL else revisions.apply_delta(text, data)
+        return text
+
+    # retention: removes revisions older than revisions.KEEP latest ones
+    # and the ones older than revisions.MAX_AGE_DAYS
+    # the oldest kept revision becomes a full text if it's a delta
+    def _prune_revisions(self, cur, noteid, latest):
+        keep_from = latest - revisions.KEEP + 1
+        if revisions.MAX_AGE_DAYS > 0:
+            now = common.date_to_ts(datetime.datetime.strftime(datetime.datetime.now(), common.DATE_FORMAT))
+            cur.execute("""SELECT min(revno) FROM note_revisions WHERE noteid=? AND modified_ts>=?""",
+                (noteid, now - revisions.MAX_AGE_DAYS * 24 * 60 * 60))
+            keep_from = max(keep_from, cur.fetchone()[0] or latest)
+        keep_from = min(keep_from, latest)
+        cur.execute("""SELECT min(revno) FROM note_revisions WHERE noteid=?""", (noteid,))
+        first = cur.fetchone()[0]
+        if first is None or first >= keep_from:
+            return
+        cur.execute("""SELECT kind FROM note_revisions WHERE noteid=? AND revno=?""", (noteid, keep_from))
+        if cur.fetchone()[0] == revisions.DELTA:
+            text = self._revision_text(cur, noteid, keep_from)
+            cur.execute("""UPDATE note_revisions SET kind=?, data=? WHERE noteid=? AND revno=?""",
+                (revisions.FULL, compression.pack(text), noteid, keep_from))
+        cur.execute("""DELETE FROM note_revisions WHERE noteid=? AND revno<?""", (noteid, keep_from))
+
+    # applies the retention policy to all notes, e.g. after it was changed
+    # returns the number of notes which had revisions removed
+    def prune_all_revisions(self):
         cur = self.con.cursor()
-        cur.execute(query, (title, contents, tags, curdt, noteid))
+        cur.execute("""SELECT noteid, max(revno) FROM note_revisions GROUP BY noteid""")
+        latest = cur.fetchall()
+        pruned = 0
+        for noteid, revno in latest:
+            cur.execute("""SELECT count(*) FROM note_revisions WHERE noteid=?""", (noteid,))
+            before = cur.fetchone()[0]
+            self._prune_revisions(cur, noteid, revno)
+            cur.execute("""SELECT count(*) FROM note_revisions WHERE noteid=?""", (noteid,))
+            if cur.fetchone()[0] != before:
+                pruned += 1
         cur.close()
         self.con.commit()
+        return pruned
 
-    def find_all_tags(self, userid):
-        query = "SELECT tags FROM notes where userid=?"
+    # revisions of the note, newest first, without texts
+    def list_revisions(self, userid, noteid):
+        query = """SELECT revno, kind, title, tags, date_modified, size FROM note_revisions WHERE noteid=? AND userid=? ORDER BY revno DESC"""
+        cur = self.con.cursor()
+        cur.execute(query, (noteid, userid))
+        result = common.fetchall_as_dict(cur)
+        cur.close()
+        return result
+
+    # the revision with its text in "contents"
+    def get_revision(self, userid, noteid, revno):
+        query = """SELECT revno, kind, title, tags, date_modified, size FROM note_revisions WHERE noteid=? AND userid=? AND revno=?"""
+        cur = self.con.cursor()
+        cur.execute(query, (noteid, userid, revno))
+        result = common.fetchall_as_dict(cur)
+        if not result:
+            cur.close()
+            raise NoteSearchException()
+        revision = result[0]
+        revision["contents"] = self._revision_text(cur, noteid, revno)
+        cur.close()
+        return revision
+
+    # makes the revision the current version of the note (as a new revision)
+    def restore_revision(self, userid, noteid, revno):
+        revision = self.get_revision(userid, noteid, revno)
+        self.update_note(userid, noteid, revision["title"], revision["contents"], revision["tags"].split())
+
+    # autosaved draft of the note (noteid 0 is a new note): dict with title, contents, tags, saved_ts or None
+    def get_draft(self, userid, noteid):
+        query = "SELECT title, contents, tags, saved_ts FROM drafts WHERE userid=? AND noteid=?"
+        cur = self.con.cursor()
+        cur.execute(query, (userid, noteid))
+        drafts = common.fetchall_as_dict(cur)
+        cur.close()
+        if not drafts:
+            return None
+        return drafts[0]
+
+    # writes drafts (tuples of userid, noteid, title, contents, tags, saved_ts) in one transaction
+    # drafts of users moved to another shard are skipped, returns the number of written drafts
+    def save_drafts(self, drafts):
+        cur = self.con.cursor()
+        try:
+            if not self.con.in_transaction:
+                cur.execute("BEGIN IMMEDIATE")
+            cur.execute("""SELECT userid FROM moved_users""")
+            moved = set(row[0] for row in cur.fetchall())
+            if moved:
+                drafts = [draft for draft in drafts if draft[0] not in moved]
+            cur.executemany("""INSERT INTO drafts (userid, noteid, title, contents, tags, saved_ts) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (userid, noteid) DO UPDATE SET title = excluded.title, contents = excluded.contents,
+                tags = excluded.tags, saved_ts = excluded.saved_ts
+                WHERE excluded.saved_ts >= drafts.saved_ts""", drafts)
+            self.con.commit()
+            return len(drafts)
+        except:
+            self.con.rollback()
+            raise
+        finally:
+            cur.close()
+
+    # the draft is not needed after the note is saved
+    def _delete_draft(self, cur, userid, noteid):
+        cur.execute("""DELETE FROM drafts WHERE userid=? AND noteid=?""", (userid, noteid))
+
+    # a context manager (with-block) for reads which must see the same state of the database,
+    # e.g. the data version and the rows it describes (one read transaction)
+    @contextmanager
+    def snapshot(self):
+        if self.con.in_transaction:
+            yield
+            return
+        self.con.execute("BEGIN")
+        try:
+            yield
+        finally:
+            self.con.rollback()
+
+    # user's data version: (version, time of last change as unix timestamp)
+    # version is incremented by every change of user's notes, it's 0 if there were no changes
+    def get_data_version(self, userid):
+        query = "SELECT version, modified_ts FROM user_versions WHERE userid=?"
         cur = self.con.cursor()
         cur.execute(query, (userid,))
-        tags = common.fetchall_as_dict(cur)
+        row = cur.fetchone()
+        cur.close()
+        if row is None:
+            return (0, None)
+        return row
+
+    # called in the same transaction as the change
+    # returns the new version
+    def _bump_version(self, cur, userid):
+        cur.execute("""INSERT INTO user_versions (userid, version, modified_ts) VALUES (?, 1, ?)
+            ON CONFLICT (userid) DO UPDATE SET version = version + 1, modified_ts = excluded.modified_ts""", (userid, int(time.time())))
+        cur.execute("""SELECT version FROM user_versions WHERE userid=?""", (userid,))
+        return cur.fetchone()[0]
+
+    # list of (tag, number of user's notes with this tag), ordered by tag
+    def find_tag_counts(self, userid):
+        query = "SELECT tag, count FROM tag_counts WHERE userid=? ORDER BY tag"
+        cur = self.con.cursor()
+        cur.execute(query, (userid,))
+        tags = cur.fetchall()
         cur.close()
-        tags = [tag["tags"] for tag in tags]
-        tags = " ".join(tags).split(" ")
-        tags = list(set(tags))
-        tags.sort()
         return tags
 
-    def upload(self, userid, notes):
-        query = """INSERT INTO notes(title,contents,date_created,tags,date_modified,userid)VALUES(?,?,?,?,?,?)"""
+    # list of (noteid, title, tag) for every tag of every note of the user
+    def find_note_tags(self, userid):
+        query = """SELECT note_tags.noteid, notes.title, note_tags.tag FROM note_tags
+            JOIN notes ON notes.id = note_tags.noteid WHERE note_tags.userid=?"""
         cur = self.con.cursor()
-        for note in notes:
-            cur.execute(query, (
-                note["title"],
-                note["contents"],
-                note["date_created"],
-                note["tags"],
-                note["date_modified"],
-                userid,
-            ))
+        cur.execute(query, (userid,))
+        rows = cur.fetchall()
+        cur.close()
+        return rows
+
+    # list of (title, number of user's notes with this title)
+    def find_title_counts(self, userid):
+        query = "SELECT title, count(*) FROM notes WHERE userid=? GROUP BY title"
+        cur = self.con.cursor()
+        cur.execute(query, (userid,))
+        titles = cur.fetchall()
+        cur.close()
+        return titles
+
+    # recalculates tag_counts from note_tags
+    # for one user, or for all users if userid is None
+    # data versions of the users are changed, so that pages cached by browsers get the new counts
+    def rebuild_tag_counts(self, userid=None):
+        cur = self.con.cursor()
+        if not self.con.in_transaction:
+            cur.execute("BEGIN IMMEDIATE")
+        if userid is None:
+            cur.execute("""SELECT userid FROM tag_counts UNION SELECT userid FROM note_tags""")
+            users = [row[0] for row in cur.fetchall()]
+            cur.execute("""DELETE FROM tag_counts""")
+            cur.execute("""INSERT INTO tag_counts (userid, tag, count)
+                SELECT userid, tag, count(*) FROM note_tags GROUP BY userid, tag""")
+        else:
+            users = [userid]
+            cur.execute("""DELETE FROM tag_counts WHERE userid=?""", (userid,))
+            cur.execute("""INSERT INTO tag_counts (userid, tag, count)
+                SELECT userid, tag, count(*) FROM note_tags WHERE userid=? GROUP BY userid, tag""", (userid,))
+        for user in users:
+            self._bump_version(cur, user)
         cur.close()
         self.con.commit()
+        autocomplete.invalidate(userid)
+
+    # inserts notes (dicts like the ones returned by iter_notes) in a single transaction
+    # using executemany() for every "batch_size" notes
+    # if "notes" raises, nothing is inserted
+    # returns the number of inserted notes
+    def upload(self, userid, notes, batch_size=1000):
+        cur = self.con.cursor()
+        try:
+            # take the write lock first, so nobody else allocates note ids until commit
+            self._begin_write(cur, userid)
+            count = 0
+            fts = True
+            batch = []
+            for note in notes:
+                batch.append(note)
+                if len(batch) >= batch_size:
+                    fts = self._upload_batch(cur, userid, batch, fts)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                self._upload_batch(cur, userid, batch, fts)
+                count += len(batch)
+            if count:
+                self._bump_version(cur, userid)
+            self.con.commit()
+        except:
+            self.con.rollback()
+            raise
+        finally:
+            cur.close()
+        autocomplete.invalidate(userid)
+        related.invalidate(userid)
+        return count
+
+    # ids are assigned here, so that the same batch can fill notes_fts and note_tags
+    # returns False if notes_fts is not available
+    def _upload_batch(self, cur, userid, notes, fts):
+        return self._insert_batch(cur, userid, list(enumerate(notes, self._last_note_id(cur) + 1)), fts)
 
+    # returns False if notes_fts is not available
+    def _insert_batch(self, cur, userid, batch, fts):
+        cur.executemany("""INSERT INTO notes(id,title,contents,date_created,tags,date_modified,userid,contents_html,html_date_modified,created_ts,modified_ts)VALUES(?,?,?,?,?,?,?,?,?,?,?)""", [
+            (noteid, note["title"], compression.pack(note["contents"]), note["date_created"], note["tags"], note["date_modified"], userid,
+                compression.pack(render.render_note(note["contents"])), note["date_modified"],
+                common.date_to_ts(note["date_created"]), common.date_to_ts(note["date_modified"]))
+            for noteid, note in batch
+        ])
+        cur.executemany("""INSERT OR IGNORE INTO note_tags (noteid, userid, tag, pos) VALUES (?, ?, ?, ?)""", [
+            (noteid, userid, tag, pos)
+            for noteid, note in batch
+            for pos, tag in enumerate(note["tags"].split())
+        ])
+        self._update_tag_counts(cur, userid, Counter(
+            tag
+            for noteid, note in batch
+            for tag in set(note["tags"].split())
+        ))
+        if fts:
+            try:
+                cur.executemany("""INSERT INTO notes_fts(rowid, title, contents) VALUES (?, ?, ?)""", [
+                    (noteid, note["title"], note["contents"])
+                    for noteid, note in batch
+                ])
+            except sqlite3.OperationalError:
+                return False
+        return True
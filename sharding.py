@@ -0,0 +1,225 @@
+# Sharding: notes of different users are kept in different database files,
+# so that writes of users on different shards don't wait for each other.
+#
+# Shard 0 is the main database (common.DB_PATH), it also keeps users, sessions
+# and the directory (table user_shards: userid -> shard).
+# Shard N > 0 is a file next to the main database: "tagged-shard<N>.db".
+# Shard files have the same schema and are created when they are used for the first time.
+#
+#     python -m tagged.sharding move USERID SHARD
+#     python -m tagged.sharding stats
+
+import argparse
+import os
+import threading
+from contextlib import contextmanager
+
+from . import common
+from . import migrations
+
+# number of shards new users are distributed over
+SHARDS = int(os.environ.get("TAGGED_SHARDS", "1"))
+
+# note ids of shard N start from N * SHARD_ID_RANGE,
+# so a user can be moved to another shard keeping ids of their notes
+SHARD_ID_RANGE = 2 ** 40
+
+# tables with user's notes data, each one has "userid" column
+USER_TABLES = ("notes", "note_tags", "tag_counts", "user_versions", "drafts", "note_revisions")
+
+# how many rows are copied at once when moving a user
+MOVE_CHUNK_SIZE = 1000
+
+class ShardException(Exception):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+def shard_path(shard):
+    if shard == 0:
+        return common.DB_PATH
+    root, ext = os.path.splitext(common.DB_PATH)
+    return "{}-shard{}{}".format(root, shard, ext)
+
+# shard of the user, "con" is a connection to the main database
+def get_shard(con, userid):
+    cur = con.cursor()
+    cur.execute("""SELECT shard FROM user_shards WHERE userid=?""", (userid,))
+    row = cur.fetchone()
+    cur.close()
+    if row is None:
+        return 0
+    return row[0]
+
+# chooses a shard for a new user
+def assign_shard(con, userid):
+    shard = userid % SHARDS
+    cur = con.cursor()
+    cur.execute("""INSERT OR IGNORE INTO user_shards (userid, shard) VALUES (?, ?)""", (userid, shard))
+    cur.close()
+    con.commit()
+    return shard
+
+_prepared = set()
+_prepared_lock = threading.Lock()
+
+# creates/upgrades the shard file once per process
+def prepare_shard(shard):
+    path = shard_path(shard)
+    if shard == 0 or path in _prepared:
+        return
+    with _prepared_lock:
+        if path in _prepared:
+            return
+        with common.get_con(path) as con:
+            migrations.upgrade(con)
+            cur = con.cursor()
+            # start note ids of this shard from its own range
+            cur.execute("""INSERT INTO sqlite_sequence (name, seq)
+                SELECT 'notes', ? WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'notes')""",
+                (shard * SHARD_ID_RANGE,))
+            cur.close()
+            con.commit()
+        _prepared.add(path)
+
+# a context manager (with-block) for connection to the user's shard
+# "con" is a connection to the main database, it's used as is for shard 0
+@contextmanager
+def get_user_con(con, userid):
+    shard = get_shard(con, userid)
+    if shard == 0:
+        yield con
+        return
+    prepare_shard(shard)
+    with common.get_con(shard_path(shard)) as ucon:
+        yield ucon
+
+# numbers of all shards which may contain data
+def all_shards(con):
+    cur = con.cursor()
+    cur.execute("""SELECT DISTINCT shard FROM user_shards""")
+    shards = set(row[0] for row in cur.fetchall())
+    cur.close()
+    return sorted(shards | set(range(SHARDS)))
+
+# moves notes of the user to another shard while the site is running
+#
+# the source shard is locked for writing during the copy (readers are not blocked);
+# then the directory is switched and the data is deleted from the source,
+# and the user is marked as moved there, so that a write which has chosen the old shard
+# before the switch fails (NoteService raises UserMovedException) instead of being lost
+def move_user(userid, target):
+    with common.get_con() as con:
+        source = get_shard(con, userid)
+        if source == target:
+            return False
+        prepare_shard(source)
+        prepare_shard(target)
+        with common.get_con(shard_path(source)) as src, common.get_con(shard_path(target)) as dst:
+            if src.in_transaction:
+                src.commit()
+            src.execute("BEGIN IMMEDIATE")
+            try:
+                if src.execute("""SELECT 1 FROM moved_users WHERE userid=?""", (userid,)).fetchone():
+                    raise ShardException("user {} is marked as moved from shard {}".format(userid, source))
+                if dst.in_transaction:
+                    dst.commit()
+                dst.execute("BEGIN IMMEDIATE")
+                try:
+                    # leftovers of a failed move
+                    _delete_user_data(dst, userid)
+                    dst.execute("""DELETE FROM moved_users WHERE userid=?""", (userid,))
+                    _copy_user_data(src, dst, userid)
+                    dst.commit()
+                except:
+                    dst.rollback()
+                    raise
+                # the directory is in the main database: if it's the source, use the locked connection
+                dircon = src if source == 0 else con
+                dircon.execute("""INSERT OR REPLACE INTO user_shards (userid, shard) VALUES (?, ?)""", (userid, target))
+                if dircon is not src:
+                    dircon.commit()
+                _delete_user_data(src, userid)
+                src.execute("""INSERT OR IGNORE INTO moved_users (userid) VALUES (?)""", (userid,))
+                src.commit()
+            except:
+                src.rollback()
+                raise
+    return True
+
+def _copy_user_data(src, dst, userid):
+    # the notes keep their ids from the range of another shard,
+    # the counter of note ids of the target must stay in its own range
+    seq = dst.execute("""SELECT seq FROM sqlite_sequence WHERE name='notes'""").fetchone()
+    for table in USER_TABLES:
+        cur = src.execute("""SELECT * FROM {} WHERE userid=?""".format(table), (userid,))
+        columns = [descr[0] for descr in cur.description]
+        query = "INSERT INTO {} ({}) VALUES ({})".format(table, ",".join(columns), ",".join(["?"] * len(columns)))
+        while True:
+            rows = cur.fetchmany(MOVE_CHUNK_SIZE)
+            if not rows:
+                break
+            dst.executemany(query, rows)
+        cur.close()
+    if seq is None:
+        dst.execute("""DELETE FROM sqlite_sequence WHERE name='notes'""")
+    else:
+        dst.execute("""UPDATE sqlite_sequence SET seq=? WHERE name='notes'""", seq)
+    # the full-text index has no copy of the notes (see migrations.create_fts), it's filled from the copied ones
+    try:
+        dst.execute("""INSERT INTO notes_fts (rowid, title, contents)
+            SELECT id, title, contents_text(contents) FROM notes WHERE userid=?""", (userid,))
+    except common.sqlite3.OperationalError:
+        # no FTS5
+        pass
+
+def _delete_user_data(con, userid):
+    try:
+        con.execute("""DELETE FROM notes_fts WHERE rowid IN (SELECT id FROM notes WHERE userid=?)""", (userid,))
+    except common.sqlite3.OperationalError:
+        try:
+            # a contentless index without contentless_delete deletes rows by the values they were indexed with
+            con.execute("""INSERT INTO notes_fts (notes_fts, rowid, title, contents)
+                SELECT 'delete', id, title, contents_text(contents) FROM notes WHERE userid=?""", (userid,))
+        except common.sqlite3.OperationalError:
+            # no FTS5
+            pass
+    for table in USER_TABLES:
+        con.execute("""DELETE FROM {} WHERE userid=?""".format(table), (userid,))
+
+# number of users and notes on every shard
+def stats():
+    result = []
+    with common.get_con() as con:
+        shards = all_shards(con)
+        users = dict(con.execute("""SELECT shard, count(*) FROM user_shards GROUP BY shard""").fetchall())
+        for shard in shards:
+            if shard != 0 and not os.path.exists(shard_path(shard)):
+                result.append((shard, users.get(shard, 0), 0))
+                continue
+            prepare_shard(shard)
+            with common.get_con(shard_path(shard)) as scon:
+                notes = scon.execute("""SELECT count(*) FROM notes""").fetchone()[0]
+            result.append((shard, users.get(shard, 0), notes))
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage database shards")
+    parser.add_argument("--db", help="main database file (default: TAGGED_DB or tagged.db)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    p = commands.add_parser("move", help="move notes of a user to another shard")
+    p.add_argument("userid", type=int)
+    p.add_argument("shard", type=int)
+    commands.add_parser("stats", help="show number of users and notes on every shard")
+    args = parser.parse_args()
+    if args.db:
+        common.configure(path=args.db)
+    if args.command == "move":
+        if not move_user(args.userid, args.shard):
+            print("user is already on shard", args.shard)
+    else:
+        print("shard  users  notes   (users of shard 0 without directory entry are not counted)")
+        for shard, users, notes in stats():
+            print("{:<6} {:<6} {}".format(shard, users, notes))
+
+if __name__ == "__main__":
+    main()
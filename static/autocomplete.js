@@ -0,0 +1,59 @@
+// Suggestions for inputs with "data-autocomplete" attribute ("tags" or "titles"):
+// the last word of the input is completed from /autocomplete through a <datalist>
+var AUTOCOMPLETE_URL = "/autocomplete";
+var AUTOCOMPLETE_DELAY = 100;
+
+function attachAutocomplete(input, n) {
+    var kind = input.dataset.autocomplete;
+    var list = document.createElement("datalist");
+    list.id = "autocomplete-" + n;
+    input.parentNode.insertBefore(list, input.nextSibling);
+    input.setAttribute("list", list.id);
+    var timer = null;
+    var lastPrefix = null;
+
+    function update() {
+        timer = null;
+        var value = input.value;
+        var words = value.split(" ");
+        var prefix = words.pop();
+        if (prefix === lastPrefix) {
+            return;
+        }
+        lastPrefix = prefix;
+        if (!prefix) {
+            list.innerHTML = "";
+            return;
+        }
+        var head = words.length ? words.join(" ") + " " : "";
+        fetch(AUTOCOMPLETE_URL + "?q=" + encodeURIComponent(prefix), { credentials: "same-origin" })
+            .then(function (resp) { return resp.ok ? resp.json() : null; })
+            .then(function (data) {
+                if (data === null || input.value !== value) {
+                    return;
+                }
+                list.innerHTML = "";
+                data[kind].forEach(function (suggestion) {
+                    var option = document.createElement("option");
+                    // titles are matched as a whole, tags word by word
+                    option.value = kind === "tags" ? head + suggestion : suggestion;
+                    list.appendChild(option);
+                });
+            })
+            .catch(function () {});
+    }
+
+    input.addEventListener("input", function () {
+        if (timer !== null) {
+            clearTimeout(timer);
+        }
+        timer = setTimeout(update, AUTOCOMPLETE_DELAY);
+    });
+}
+
+document.addEventListener("DOMContentLoaded", function () {
+    var inputs = document.querySelectorAll("input[data-autocomplete]");
+    for (var i = 0; i < inputs.length; i++) {
+        attachAutocomplete(inputs[i], i);
+    }
+});
@@ -0,0 +1,54 @@
+// Autosave of a note being edited: the form is sent to the draft URL
+// a few seconds after the last change (see drafts.py)
+var AUTOSAVE_DELAY = 3000;
+
+function autosave(form, simplemde) {
+    var timer = null;
+    var saving = false;
+    var changed = false;
+    var status = form.querySelector(".draftstatus");
+
+    function save() {
+        timer = null;
+        if (saving) {
+            changed = true;
+            return;
+        }
+        saving = true;
+        changed = false;
+        var data = new FormData();
+        data.append("noteid", form.dataset.noteid);
+        data.append("title", form.elements["title"].value);
+        data.append("tags", form.elements["tags"].value);
+        data.append("contents", simplemde.value());
+        fetch(form.dataset.draftUrl, { method: "POST", body: data, credentials: "same-origin" })
+            .then(function (resp) {
+                status.textContent = resp.ok ? "Черновик сохранён" : "Черновик не сохранён";
+            })
+            .catch(function () {
+                status.textContent = "Черновик не сохранён";
+            })
+            .then(function () {
+                saving = false;
+                if (changed) {
+                    schedule();
+                }
+            });
+    }
+
+    function schedule() {
+        if (timer !== null) {
+            clearTimeout(timer);
+        }
+        timer = setTimeout(save, AUTOSAVE_DELAY);
+    }
+
+    simplemde.codemirror.on("change", schedule);
+    form.elements["title"].addEventListener("input", schedule);
+    form.elements["tags"].addEventListener("input", schedule);
+    form.addEventListener("submit", function () {
+        if (timer !== null) {
+            clearTimeout(timer);
+        }
+    });
+}
@@ -0,0 +1,81 @@
+# Fixtures of the tests: every test gets a new database in its own temporary directory.
+#
+#     python -m pytest -q
+#
+# The project directory is imported as the "tagged" package, whatever the checkout is named.
+
+import importlib.util
+import os
+import sys
+import tempfile
+from contextlib import ExitStack
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# settings are read when modules are imported
+os.environ["TAGGED_DB"] = os.path.join(tempfile.mkdtemp(), "tagged.db")
+os.environ["TAGGED_TEMPLATE_CACHE_DIR"] = "none"
+os.environ["TAGGED_SESSION_SWEEP_INTERVAL"] = "0"
+
+if "tagged" not in sys.modules:
+    spec = importlib.util.spec_from_file_location("tagged", os.path.join(ROOT, "__init__.py"),
+        submodule_search_locations=[ROOT])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["tagged"] = module
+    spec.loader.exec_module(module)
+
+from tagged import app as flask_app
+from tagged import autocomplete
+from tagged import common
+from tagged import drafts
+from tagged import jobs
+from tagged import migrations
+from tagged import related
+from tagged import services
+from tagged import sharding
+
+# path of an empty database of the latest version, with in-process caches cleared
+@pytest.fixture
+def db(tmp_path):
+    path = str(tmp_path / "tagged.db")
+    common.configure(path=path)
+    with common.get_con() as con:
+        migrations.upgrade(con)
+    services.session_cache.clear()
+    autocomplete.invalidate()
+    related.invalidate()
+    sharding._prepared.clear()
+    yield path
+    jobs.runner.stop()
+    drafts.writer.flush()
+    common.close_pools()
+
+# creates a user, returns its id
+@pytest.fixture
+def make_user(db):
+    def make_user(username="user"):
+        with common.get_con() as con:
+            userid = services.UserService(con).create_user(username, "password")
+            sharding.assign_shard(con, userid)
+        return userid
+    return make_user
+
+# test client of the site, logged in as "user"
+@pytest.fixture
+def client(db):
+    client = flask_app.test_client()
+    client.post("/signup", data={"username": "user", "password1": "password", "password2": "password"})
+    resp = client.post("/login", data={"username": "user", "password": "password"})
+    assert resp.status_code == 302
+    return client
+
+# a NoteService connected to the user's shard, the connections are returned after the test
+@pytest.fixture
+def note_service(db):
+    with ExitStack() as stack:
+        def note_service(userid):
+            con = stack.enter_context(common.get_con())
+            return services.NoteService(stack.enter_context(sharding.get_user_con(con, userid)))
+        yield note_service
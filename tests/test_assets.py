@@ -0,0 +1,81 @@
+import os
+import subprocess
+import sys
+import threading
+
+from werkzeug.datastructures import Accept
+
+from tagged import assets
+
+def _gzipped_bundle():
+    for filename in assets.get_manifest().values():
+        if assets.resolve(filename, Accept([("gzip", 1)]))[1] == "gzip":
+            return filename
+    raise AssertionError("no bundle has a .gz copy")
+
+def test_resolve_honors_q_values():
+    filename = _gzipped_bundle()
+    assert assets.resolve(filename, Accept([("gzip", 1)]))[1] == "gzip"
+    assert assets.resolve(filename, Accept([("*", 1)]))[1] is not None
+    assert assets.resolve(filename, Accept([("gzip", 0)]))[1] is None
+    assert assets.resolve(filename, Accept([("gzip", 0), ("br", 0)]))[1] is None
+    assert assets.resolve(filename, Accept())[1] is None
+
+def test_resolve_only_serves_built_files():
+    assert assets.resolve("manifest.json", Accept()) is None
+    assert assets.resolve("../../__init__.py", Accept()) is None
+
+def test_asset_route(client):
+    filename = _gzipped_bundle()
+    resp = client.get(assets.URL_PREFIX + filename, headers={"Accept-Encoding": "gzip;q=0"})
+    assert resp.status_code == 200
+    assert "Content-Encoding" not in resp.headers
+    assert "immutable" in resp.headers["Cache-Control"]
+    resp = client.get(assets.URL_PREFIX + filename, headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["Content-Encoding"] == "gzip"
+
+# a read-only installation gets a build in FALLBACK_DIR
+def test_unwritable_dist_dir_falls_back(tmp_path, monkeypatch):
+    blocker = tmp_path / "file"
+    blocker.write_text("")
+    monkeypatch.setattr(assets, "DIST_DIR", str(blocker / "dist"))
+    monkeypatch.setattr(assets, "FALLBACK_DIR", str(tmp_path / "fallback"))
+    monkeypatch.setattr(assets, "_manifest", None)
+    monkeypatch.setattr(assets, "_dist_dir", None)
+    manifest = assets.get_manifest()
+    assert sorted(manifest) == sorted(assets.BUNDLES)
+    path = assets.resolve(manifest["site.css"], Accept())[0]
+    assert path == str(tmp_path / "fallback" / manifest["site.css"])
+
+def test_concurrent_builds(tmp_path):
+    errors = []
+    def build():
+        try:
+            assets.build(str(tmp_path))
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=build) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+    assert sorted(assets._read_manifest(str(tmp_path))) == sorted(assets.BUNDLES)
+
+# the editor doesn't load anything from CDNs
+def test_editor_is_self_contained(client):
+    client.post("/new", data={"title": "note", "contents": "text", "tags": ""})
+    for url in ("/new", "/edit/1"):
+        page = client.get(url).get_data(as_text=True)
+        assert "autoDownloadFontAwesome: false" in page
+        assert "spellChecker: false" in page
+
+# importing the site doesn't read the manifest or build assets, it's done for the first page
+def test_import_doesnt_build(tmp_path):
+    os.symlink(os.path.dirname(assets.__file__), tmp_path / "tagged")
+    script = "import tagged; from tagged import assets; print(assets._manifest is None)"
+    env = dict(os.environ, TAGGED_DB=str(tmp_path / "tagged.db"))
+    out = subprocess.run([sys.executable, "-c", script], cwd=tmp_path, env=env, capture_output=True, text=True,
+        check=True).stdout
+    assert out.strip() == "True"
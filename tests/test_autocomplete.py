@@ -0,0 +1,49 @@
+from collections import Counter
+
+from tagged import autocomplete
+
+def test_suggest_most_frequent_first():
+    index = autocomplete.PrefixIndex({"python": 3, "pytest": 5, "Pyramid": 1, "rust": 9})
+    assert index.suggest("py") == ["pytest", "python", "Pyramid"]
+    assert index.suggest("PY", limit=1) == ["pytest"]
+    assert index.suggest("x") == []
+
+# the most frequent match comes after MAX_SCAN less frequent ones in alphabetical order
+def test_suggest_ranks_all_matches(monkeypatch):
+    monkeypatch.setattr(autocomplete, "MAX_SCAN", 100)
+    counts = {"tag{:04}".format(i): 1 for i in range(500)}
+    counts["tag_frequent"] = 7
+    index = autocomplete.PrefixIndex(counts)
+    assert index.suggest("t")[:2] == ["tag_frequent", "tag0000"]
+    index.add("tag0499", 10)
+    assert index.suggest("t")[:3] == ["tag0499", "tag_frequent", "tag0000"]
+    index.add("tag0499", -11)
+    index.add("tag_frequent", -7)
+    assert index.suggest("ta")[:2] == ["tag0000", "tag0001"]
+    assert index.suggest("t") == ["tag{:04}".format(i) for i in range(autocomplete.SUGGESTIONS)]
+
+def test_index_follows_writes(make_user, note_service):
+    userid = make_user()
+    ns = note_service(userid)
+    ns.create_note(userid, "Python tips", "", ["python"])
+    index = autocomplete.get_index(ns, userid, ns.get_data_version(userid)[0])
+    assert index.suggest("py") == {"tags": ["python"], "titles": ["Python tips"]}
+    noteid = ns.create_note(userid, "Pytest", "", ["pytest", "python"])
+    assert autocomplete.get_index(ns, userid, ns.get_data_version(userid)[0]) is index
+    assert index.suggest("py") == {"tags": ["python", "pytest"], "titles": ["Pytest", "Python tips"]}
+    ns.delete_note(userid, noteid)
+    assert index.suggest("py") == {"tags": ["python"], "titles": ["Python tips"]}
+
+# the request read the version before a write, the index is built after it:
+# the write is in the index and must not be applied again
+def test_index_built_after_a_write_skips_it(make_user, note_service):
+    userid = make_user()
+    ns = note_service(userid)
+    ns.create_note(userid, "first", "", ["tag"])
+    stale = ns.get_data_version(userid)[0]
+    ns.create_note(userid, "second", "", ["tag"])
+    index = autocomplete.get_index(ns, userid, stale)
+    assert index.version == ns.get_data_version(userid)[0]
+    autocomplete.apply_changes(userid, index.version, Counter({"tag": 1}), Counter({"second": 1}))
+    assert index.tags.counts == {"tag": 2}
+    assert index.titles.counts == {"first": 1, "second": 1}
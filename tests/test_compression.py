@@ -0,0 +1,57 @@
+import sqlite3
+
+from tagged import common
+from tagged import compression
+from tagged import migrations
+
+LONG_TEXT = "Long note about compression. " * 400
+
+def test_pack_round_trip():
+    packed = compression.pack(LONG_TEXT)
+    assert compression.is_packed(packed)
+    assert len(packed) < len(LONG_TEXT) // 10
+    assert compression.unpack(packed) == LONG_TEXT
+
+def test_short_text_is_stored_as_is():
+    assert compression.pack("short") == "short"
+    assert compression.unpack("short") == "short"
+
+def test_notes_are_stored_compressed(make_user, note_service):
+    userid = make_user()
+    ns = note_service(userid)
+    noteid = ns.create_note(userid, "title", LONG_TEXT, ["tag"])
+    stored = ns.con.execute("""SELECT contents FROM notes WHERE id=?""", (noteid,)).fetchone()[0]
+    assert compression.is_packed(stored)
+    assert ns.get_note(userid, noteid)["contents"] == LONG_TEXT
+    assert [note["id"] for note in ns.search_notes(userid, ["compression"], [])] == [noteid]
+
+def test_compress_notes_and_stats(make_user, note_service):
+    userid = make_user()
+    ns = note_service(userid)
+    noteid = ns.create_note(userid, "title", "x", [])
+    # a note saved before compression
+    ns.con.execute("""UPDATE notes SET contents=? WHERE id=?""", (LONG_TEXT, noteid))
+    ns.con.commit()
+    assert compression.compress_notes(ns.con) == 1
+    ns.con.commit()
+    stats = compression.compression_stats(ns.con)
+    assert stats["notes"] == 1 and stats["compressed"] == 1
+    assert stats["uncompressed_bytes"] - stats["stored_bytes"] > len(LONG_TEXT) // 2
+    assert stats["database_bytes"] > 0
+    assert stats["fts_bytes"] is None or stats["fts_bytes"] > 0
+
+# the full-text index of version 10 kept a copy of every note
+def test_fts_becomes_contentless(tmp_path):
+    con = sqlite3.connect(str(tmp_path / "old.db"))
+    migrations.upgrade(con, target=10)
+    con.execute("""INSERT INTO users (username, passhash) VALUES ('user', '')""")
+    con.execute("""INSERT INTO notes (title, contents, date_created, tags, date_modified, userid)
+        VALUES ('first', ?, '', '', '', 1)""", (compression.pack(LONG_TEXT),))
+    con.execute("""INSERT INTO notes_fts (rowid, title, contents) VALUES (1, 'first', ?)""", (LONG_TEXT,))
+    con.commit()
+    assert migrations.upgrade(con, target=11) == [11]
+    sql = con.execute("""SELECT sql FROM sqlite_master WHERE name='notes_fts'""").fetchone()[0]
+    assert "content=''" in sql
+    assert con.execute("""SELECT count(*) FROM sqlite_master WHERE name='notes_fts_content'""").fetchone()[0] == 0
+    assert con.execute("""SELECT rowid FROM notes_fts WHERE notes_fts MATCH 'compression'""").fetchall() == [(1,)]
+    con.close()
@@ -0,0 +1,29 @@
+def _new(client, title):
+    client.post("/new", data={"title": title, "contents": "text", "tags": "t"})
+
+def test_unchanged_page_is_not_sent_again(client):
+    _new(client, "first")
+    resp = client.get("/")
+    assert resp.status_code == 200
+    etag = resp.headers["ETag"]
+    resp = client.get("/", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    assert resp.headers["ETag"] == etag
+
+# two writes within the same second: only the ETag tells them apart
+def test_change_within_a_second(client):
+    _new(client, "first")
+    resp = client.get("/")
+    _new(client, "second")
+    headers = {"If-None-Match": resp.headers["ETag"], "If-Modified-Since": resp.headers["Last-Modified"]}
+    resp = client.get("/", headers=headers)
+    assert resp.status_code == 200
+    assert b"second" in resp.data
+    resp = client.get("/", headers={"If-Modified-Since": resp.headers["Last-Modified"]})
+    assert resp.status_code == 200
+
+# a proxy may weaken the ETag of a response it compresses
+def test_weak_etag_matches(client):
+    resp = client.get("/")
+    resp = client.get("/", headers={"If-None-Match": "W/" + resp.headers["ETag"]})
+    assert resp.status_code == 304
@@ -0,0 +1,60 @@
+from tagged import common
+from tagged import drafts
+from tagged.services import NoteService
+
+def _get_draft(userid, noteid):
+    with common.get_con() as con:
+        return NoteService(con).get_draft(userid, noteid)
+
+# repeated saves of a draft replace each other in the queue: one row is written once
+def test_saves_are_coalesced(make_user):
+    userid = make_user()
+    writer = drafts.DraftWriter(interval=60, durability="async")
+    for i in range(3):
+        writer.save(userid, 0, "title", "text {}".format(i), "t")
+    assert _get_draft(userid, 0) is None
+    writer.stop()
+    assert _get_draft(userid, 0)["contents"] == "text 2"
+    assert writer.stats()["written"] == 1 and writer.stats()["flushes"] == 1
+
+def test_commit_durability_waits_for_the_flush(make_user):
+    userid = make_user()
+    writer = drafts.DraftWriter(interval=0.01, durability="commit")
+    try:
+        writer.save(userid, 0, "title", "text", "t")
+        assert _get_draft(userid, 0)["contents"] == "text"
+    finally:
+        writer.stop()
+
+def test_discarded_draft_is_not_written(make_user):
+    userid = make_user()
+    writer = drafts.DraftWriter(interval=60, durability="async")
+    writer.save(userid, 0, "title", "text", "t")
+    writer.discard(userid, 0)
+    writer.stop()
+    assert _get_draft(userid, 0) is None
+
+# a draft written late doesn't replace a newer one
+def test_older_draft_doesnt_replace_newer(make_user):
+    userid = make_user()
+    with common.get_con() as con:
+        ns = NoteService(con)
+        ns.save_drafts([(userid, 0, "title", "new", "", 200)])
+        ns.save_drafts([(userid, 0, "title", "old", "", 100)])
+        assert ns.get_draft(userid, 0)["contents"] == "new"
+
+def test_saving_note_deletes_its_draft(make_user):
+    userid = make_user()
+    with common.get_con() as con:
+        ns = NoteService(con)
+        noteid = ns.create_note(userid, "title", "text", [])
+        ns.save_drafts([(userid, noteid, "title", "draft", "", 100)])
+        ns.update_note(userid, noteid, "title", "saved", [])
+        assert ns.get_draft(userid, noteid) is None
+
+def test_draft_route(client):
+    resp = client.post("/draft", data={"noteid": "0", "title": "title", "contents": "unsaved draft text", "tags": ""})
+    assert resp.get_json()["saved"]
+    drafts.writer.flush()
+    assert b"unsaved draft text" in client.get("/new").data
+    assert client.post("/draft", data={"noteid": "x", "title": "", "contents": "", "tags": ""}).status_code == 400
@@ -0,0 +1,79 @@
+import gzip
+import io
+import json
+
+import pytest
+
+from tagged import backup
+from tagged import common
+from tagged.services import NoteService
+
+def _create(client, n):
+    for i in range(n):
+        client.post("/new", data={"title": "note {}".format(i), "contents": "text {}".format(i), "tags": "t all"})
+
+def test_download(client):
+    _create(client, 3)
+    resp = client.get("/export/download?format=json", headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in resp.headers
+    assert sorted(note["title"] for note in json.loads(resp.data)) == ["note 0", "note 1", "note 2"]
+    resp = client.get("/export/download?format=ndjson", headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert len(gzip.decompress(resp.data).splitlines()) == 3
+
+# a gzipped body is a different body: a copy of one is not valid for the other
+def test_gzipped_download_has_own_etag(client):
+    _create(client, 1)
+    plain = client.get("/export/download", headers={"Accept-Encoding": "identity"})
+    gzipped = client.get("/export/download", headers={"Accept-Encoding": "gzip"})
+    assert plain.headers["ETag"] != gzipped.headers["ETag"]
+    resp = client.get("/export/download", headers={"Accept-Encoding": "gzip", "If-None-Match": plain.headers["ETag"]})
+    assert resp.status_code == 200
+    resp = client.get("/export/download", headers={"Accept-Encoding": "gzip", "If-None-Match": gzipped.headers["ETag"]})
+    assert resp.status_code == 304
+
+# a download in progress doesn't keep a connection of the pool
+def test_stream_uses_own_connection(make_user, monkeypatch):
+    monkeypatch.setattr(common, "POOL_SIZE", 1)
+    common.close_pools()
+    userid = make_user()
+    with common.get_con() as con:
+        NoteService(con).upload(userid, [{"title": "note {}".format(i), "contents": "text", "tags": "",
+            "date_created": "2024-01-01 00:00:00", "date_modified": "2024-01-01 00:00:00"} for i in range(20)])
+    stream = backup.export_notes(userid, "ndjson", chunk_size=5)
+    first = next(stream)
+    pool = common.get_pool()
+    pool.release(pool.acquire(timeout=0.1))
+    assert len(first.splitlines()) + sum(len(chunk.splitlines()) for chunk in stream) == 20
+
+class _CountingStream(io.BytesIO):
+    def __init__(self, data):
+        super().__init__(data)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
+
+# a stream which returns one byte at a time
+class _SlowStream(io.BytesIO):
+    def read(self, size=-1):
+        return super().read(1)
+
+# a record split at any place between two reads is parsed
+def test_records_split_between_reads():
+    records = [{"title": "né \"1\"", "contents": "😀 \\u", "tags": "a b", "n": 1.5e-3},
+        12345.5e-3, -7, True, False, None, [], {}]
+    for ensure_ascii in (True, False):
+        data = json.dumps(records, ensure_ascii=ensure_ascii).encode("UTF-8")
+        assert list(backup.iter_records(_SlowStream(data))) == records
+
+# a syntax error is reported without reading the rest of the file
+def test_invalid_json_fails_early():
+    record = json.dumps({"title": "note", "contents": "x" * 100, "tags": ""})
+    data = ("[" + record + ", {\"title\": nope}, " + ",".join([record] * 100000) + "]").encode("UTF-8")
+    stream = _CountingStream(data)
+    with pytest.raises(backup.BackupFormatException):
+        list(backup.iter_records(stream))
+    assert stream.bytes_read <= 2 * backup.READ_SIZE
@@ -0,0 +1,85 @@
+import os
+import subprocess
+import sys
+
+from tagged import fragments
+
+def _key(note):
+    return ("short_note", note["id"], note["modified_ts"], note["title"], note["tags"])
+
+def _render(note):
+    return "<p>{}: {}</p>".format(note["title"], note["tags"])
+
+def _note(title, tags="a", modified_ts=1):
+    return {"id": 1, "modified_ts": modified_ts, "title": title, "tags": tags}
+
+# a changed note gets a new key: its old fragment isn't used
+def test_changed_note_is_rendered_again():
+    cache = fragments.FragmentCache(lambda: "stamp")
+    assert cache.render_all([_note("first")], _key, _render) == ["<p>first: a</p>"]
+    assert cache.render_all([_note("first")], _key, _render) == ["<p>first: a</p>"]
+    assert cache.rendered == 1
+    assert cache.render_all([_note("second")], _key, _render) == ["<p>second: a</p>"]
+    assert cache.render_all([_note("second", "a b")], _key, _render) == ["<p>second: a b</p>"]
+    assert cache.render_all([_note("second", "a b", 2)], _key, _render) == ["<p>second: a b</p>"]
+    assert cache.rendered == 4
+
+# the disk tier is used by a new process, but not after templates were changed
+def test_disk_tier(tmp_path):
+    path = str(tmp_path / "fragments.db")
+    notes = [_note("first")]
+    cache = fragments.FragmentCache(lambda: "stamp", disk_path=path)
+    cache.render_all(notes, _key, _render)
+    # a new process: nothing in memory
+    cache = fragments.FragmentCache(lambda: "stamp", disk_path=path)
+    assert cache.render_all(notes, _key, lambda note: "new") == ["<p>first: a</p>"]
+    assert (cache.disk_hits, cache.rendered) == (1, 0)
+    # changed templates
+    cache = fragments.FragmentCache(lambda: "changed", disk_path=path)
+    assert cache.render_all(notes, _key, lambda note: "new") == ["new"]
+    assert (cache.disk_hits, cache.rendered) == (0, 1)
+
+# lists show notes as they are after an edit, a change of tags and a deletion
+def test_lists_follow_changes(client):
+    client.post("/new", data={"title": "first title", "contents": "text", "tags": "oldtag"})
+    page = client.get("/").get_data(as_text=True)
+    assert "first title" in page and "oldtag" in page
+    client.post("/edit/1", data={"title": "second title", "contents": "text", "tags": "oldtag"})
+    page = client.get("/").get_data(as_text=True)
+    assert "second title" in page and "first title" not in page
+    client.post("/edit/1", data={"title": "second title", "contents": "text", "tags": "newtag"})
+    page = client.get("/").get_data(as_text=True)
+    assert "newtag" in page and "oldtag" not in page
+    client.post("/delete/1")
+    assert "second title" not in client.get("/").get_data(as_text=True)
+
+RENDER = """
+import sys
+import jinja2
+import tagged
+tagged.app.jinja_env.loader = jinja2.FileSystemLoader(sys.argv[1])
+print(tagged.app.jinja_env.get_template("page.html").render())
+"""
+
+# compiled templates are kept in TAGGED_TEMPLATE_CACHE_DIR, a changed template is compiled again
+def test_template_bytecode_cache(tmp_path):
+    os.symlink(os.path.dirname(fragments.__file__), tmp_path / "tagged")
+    templates = tmp_path / "templates"
+    templates.mkdir()
+    cache_dir = tmp_path / "bytecode"
+    env = dict(os.environ, TAGGED_DB=str(tmp_path / "tagged.db"), TAGGED_TEMPLATE_CACHE_DIR=str(cache_dir))
+
+    def render():
+        return subprocess.run([sys.executable, "-c", RENDER, str(templates)], cwd=tmp_path, env=env,
+            capture_output=True, text=True, check=True).stdout.strip()
+    (templates / "page.html").write_text("{{ 1 + 1 }} first")
+    assert render() == "2 first"
+    [name] = os.listdir(cache_dir)
+    compiled = (cache_dir / name).read_bytes()
+    # the second process loads the compiled template and doesn't write it again
+    os.utime(cache_dir / name, ns=(0, 0))
+    assert render() == "2 first"
+    assert os.stat(cache_dir / name).st_mtime_ns == 0
+    (templates / "page.html").write_text("{{ 2 + 2 }} second")
+    assert render() == "4 second"
+    assert (cache_dir / name).read_bytes() != compiled
@@ -0,0 +1,198 @@
+import gzip
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from tagged import backup
+from tagged import common
+from tagged import jobs
+
+def _backup(n, start=0):
+    notes = [{"title": "note {}".format(i), "contents": "text of note {}".format(i), "tags": "t{} all".format(i % 7),
+        "date_created": "2024-01-01 00:00:00", "date_modified": "2024-01-02 00:00:00"} for i in range(start, start + n)]
+    return "".join(json.dumps(note) + "\n" for note in notes).encode("UTF-8")
+
+def _get_job(userid, jobid):
+    with common.get_con() as con:
+        return jobs.get_job(con, userid, jobid)
+
+def _wait(userid, jobid, statuses=(jobs.DONE, jobs.FAILED)):
+    for i in range(400):
+        job = _get_job(userid, jobid)
+        if job["status"] in statuses:
+            return job
+        time.sleep(0.025)
+    raise AssertionError("job {} is {}".format(jobid, job["status"]))
+
+def _run(userid, kind, params=None, data=None):
+    prepare = jobs.save_upload(io.BytesIO(data)) if data is not None else None
+    return _wait(userid, jobs.runner.submit(userid, kind, params, prepare=prepare))
+
+def _insert_job(userid, status, pid=None, kind="rebuild-tag-counts", attempts=0):
+    with common.get_con() as con:
+        jobid = con.execute("""INSERT INTO jobs (userid, kind, status, params, pid, attempts, created_ts)
+            VALUES (?, ?, ?, '{}', ?, ?, 0)""", (userid, kind, status, pid, attempts)).lastrowid
+        con.commit()
+    return jobid
+
+def _dead_pid():
+    proc = subprocess.Popen([sys.executable, "-c", ""])
+    proc.wait()
+    return proc.pid
+
+# progress is saved on every read of the file while notes of shard 0 are being written:
+# the import must not wait for its own write lock
+def test_import_saves_progress(make_user, note_service, monkeypatch):
+    monkeypatch.setattr(jobs, "PROGRESS_INTERVAL", 0)
+    monkeypatch.setattr(backup, "READ_SIZE", 4096)
+    userid = make_user()
+    data = _backup(backup.IMPORT_BATCH_SIZE * 2 + 10)
+    job = _run(userid, "import", data=data)
+    assert job["status"] == jobs.DONE
+    assert job["result"] == {"imported": backup.IMPORT_BATCH_SIZE * 2 + 10, "rejected": 0}
+    assert job["progress"] == job["total"] == len(data)
+    assert note_service(userid).count_notes(userid) == backup.IMPORT_BATCH_SIZE * 2 + 10
+    assert not any(name.endswith(".progress") for name in os.listdir(jobs.job_dir()))
+
+# an import is one transaction: a file broken after several batches imports nothing,
+# so it can be fixed and uploaded again without duplicates
+def test_failed_import_imports_nothing(make_user, note_service):
+    userid = make_user()
+    data = _backup(backup.IMPORT_BATCH_SIZE + 5)
+    data = b"[" + b",".join(data.splitlines()) + b",{broken"
+    job = _run(userid, "import", data=data)
+    assert job["status"] == jobs.FAILED
+    assert job["error"] == jobs.ERROR_FORMAT
+    assert job["result"] is None
+    assert note_service(userid).count_notes(userid) == 0
+
+# progress of a running job is read from its file
+def test_progress_of_running_job(make_user, monkeypatch):
+    monkeypatch.setattr(jobs, "PROGRESS_INTERVAL", 0)
+    userid = make_user()
+    jobid = _insert_job(userid, jobs.RUNNING, os.getpid())
+    os.makedirs(jobs.job_dir(), exist_ok=True)
+    jobs.Job(jobid, userid, "export", {}).progress(5, 20)
+    job = _get_job(userid, jobid)
+    assert (job["progress"], job["total"]) == (5, 20)
+
+def test_import_rejects_invalid_records(make_user):
+    userid = make_user()
+    data = _backup(3) + b"not json\n" + json.dumps({"title": "no fields"}).encode("UTF-8") + b"\n"
+    job = _run(userid, "import", data=data)
+    assert job["result"] == {"imported": 3, "rejected": 2}
+    # the input is deleted after the job is marked as finished
+    for i in range(100):
+        if not any(name.endswith(".upload") for name in os.listdir(jobs.job_dir())):
+            break
+        time.sleep(0.01)
+    assert not any(name.endswith(".upload") for name in os.listdir(jobs.job_dir()))
+
+def test_export_job_writes_gzipped_backup(make_user):
+    userid = make_user()
+    _run(userid, "import", data=_backup(20))
+    job = _run(userid, "export", {"format": "ndjson"})
+    assert job["status"] == jobs.DONE
+    assert job["result"] == {"notes": 20}
+    path = jobs.result_path(job)
+    with open(path, "rb") as f:
+        records = list(backup.iter_records(gzip.GzipFile(fileobj=f)))
+    assert sorted(record["title"] for record in records) == sorted("note {}".format(i) for i in range(20))
+
+def test_active_jobs_per_user_are_limited(make_user, monkeypatch):
+    userid = make_user()
+    monkeypatch.setattr(jobs, "MAX_ACTIVE_PER_USER", 0)
+    with pytest.raises(jobs.JobLimitException):
+        jobs.runner.submit(userid, "rebuild-tag-counts")
+
+# the limit of running jobs is shared by all processes
+def test_job_waits_for_jobs_of_other_processes(make_user, monkeypatch):
+    monkeypatch.setattr(jobs, "CLAIM_INTERVAL", 0.05)
+    userid = make_user()
+    # jobs running in another (alive) process
+    others = [_insert_job(userid, jobs.RUNNING, os.getppid()) for i in range(jobs.runner.workers)]
+    jobid = jobs.runner.submit(userid, "rebuild-tag-counts")
+    time.sleep(0.3)
+    assert _get_job(userid, jobid)["status"] == jobs.QUEUED
+    with common.get_con() as con:
+        con.execute("""UPDATE jobs SET status=? WHERE id=?""", (jobs.DONE, others[0]))
+        con.commit()
+    assert _wait(userid, jobid)["status"] == jobs.DONE
+
+# a job queued by another process is run by this one
+def test_queued_job_of_other_process(make_user, monkeypatch):
+    monkeypatch.setattr(jobs, "CLAIM_INTERVAL", 0.05)
+    userid = make_user()
+    jobs.runner.ensure_started()
+    jobid = _insert_job(userid, jobs.QUEUED)
+    assert _wait(userid, jobid)["status"] == jobs.DONE
+
+# a job of a process which died is run again, until it has been started MAX_ATTEMPTS times
+def test_orphaned_job_is_run_again(make_user, monkeypatch):
+    monkeypatch.setattr(jobs, "CLAIM_INTERVAL", 0.05)
+    userid = make_user()
+    pid = _dead_pid()
+    again = _insert_job(userid, jobs.RUNNING, pid, attempts=1)
+    failed = _insert_job(userid, jobs.RUNNING, pid, attempts=jobs.MAX_ATTEMPTS)
+    jobs.runner.ensure_started()
+    assert _wait(userid, again)["status"] == jobs.DONE
+    job = _wait(userid, failed)
+    assert (job["status"], job["error"]) == (jobs.FAILED, jobs.ERROR_INTERRUPTED)
+
+# a stopping process doesn't wait for its jobs: they are interrupted and queued again
+def test_stop_requeues_running_jobs(make_user, monkeypatch):
+    monkeypatch.setattr(jobs, "CLAIM_INTERVAL", 0.05)
+    started = threading.Event()
+
+    def slow(job):
+        started.set()
+        while True:
+            job.progress(0, 1)
+            time.sleep(0.01)
+
+    monkeypatch.setitem(jobs.KINDS, "slow", slow)
+    userid = make_user()
+    jobid = jobs.runner.submit(userid, "slow")
+    assert started.wait(5)
+    t = time.monotonic()
+    jobs.runner.stop()
+    assert time.monotonic() - t < 1
+    job = _get_job(userid, jobid)
+    assert job["status"] == jobs.QUEUED
+    with common.get_con() as con:
+        assert con.execute("""SELECT pid, attempts FROM jobs WHERE id=?""", (jobid,)).fetchone() == (None, 0)
+    # another process (here: this one started again) finishes it
+    monkeypatch.setitem(jobs.KINDS, "slow", lambda job: ({}, None))
+    jobs.runner.ensure_started()
+    assert _wait(userid, jobid)["status"] == jobs.DONE
+
+# an interrupted import leaves no notes and keeps its file for the next attempt
+def test_interrupted_import_is_rolled_back(make_user, note_service, monkeypatch):
+    monkeypatch.setattr(jobs, "PROGRESS_INTERVAL", 0)
+    monkeypatch.setattr(backup, "READ_SIZE", 1024)
+    userid = make_user()
+    data = _backup(backup.IMPORT_BATCH_SIZE * 3)
+    read = threading.Event()
+    stream_read = jobs._ProgressReader.read
+
+    def read_slowly(self, n=-1):
+        read.set()
+        time.sleep(0.001)
+        return stream_read(self, n)
+
+    monkeypatch.setattr(jobs._ProgressReader, "read", read_slowly)
+    jobid = jobs.runner.submit(userid, "import", prepare=jobs.save_upload(io.BytesIO(data)))
+    assert read.wait(5)
+    jobs.runner.stop()
+    assert _get_job(userid, jobid)["status"] == jobs.QUEUED
+    assert note_service(userid).count_notes(userid) == 0
+    assert os.path.exists(os.path.join(jobs.job_dir(), "{}.upload".format(jobid)))
+    monkeypatch.setattr(jobs._ProgressReader, "read", stream_read)
+    jobs.runner.ensure_started()
+    assert _wait(userid, jobid)["result"] == {"imported": backup.IMPORT_BATCH_SIZE * 3, "rejected": 0}
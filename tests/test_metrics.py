@@ -0,0 +1,26 @@
+from tagged import metrics
+
+def test_metrics_are_not_public(client, monkeypatch):
+    monkeypatch.setattr(metrics, "ACCESS_TOKEN", "")
+    monkeypatch.setattr(metrics, "ALLOWED_ADDRESSES", frozenset())
+    assert client.get("/metrics").status_code == 404
+    assert client.get("/metrics", headers={"Authorization": "Bearer "}).status_code == 404
+
+def test_metrics_with_token(client, monkeypatch):
+    monkeypatch.setattr(metrics, "ACCESS_TOKEN", "secret")
+    assert client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 404
+    resp = client.get("/metrics", headers={"Authorization": "Bearer secret"})
+    assert resp.status_code == 200
+    assert b"tagged_request_duration_seconds" in resp.data
+
+def test_metrics_from_allowed_address(client, monkeypatch):
+    monkeypatch.setattr(metrics, "ALLOWED_ADDRESSES", frozenset(["10.0.0.1"]))
+    assert client.get("/metrics", environ_base={"REMOTE_ADDR": "10.0.0.2"}).status_code == 404
+    assert client.get("/metrics", environ_base={"REMOTE_ADDR": "10.0.0.1"}).status_code == 200
+
+def test_cache_stats_are_not_public(client, monkeypatch):
+    monkeypatch.setattr(metrics, "ACCESS_TOKEN", "secret")
+    monkeypatch.setattr(metrics, "ALLOWED_ADDRESSES", frozenset())
+    assert client.get("/stats/cache").status_code == 404
+    resp = client.get("/stats/cache", headers={"Authorization": "Bearer secret"})
+    assert sorted(resp.get_json()) == ["fragments", "sessions"]
@@ -0,0 +1,40 @@
+from tagged import common
+from tagged import compression
+from tagged import migrations
+from tagged.services import NoteService
+
+def test_upgrade_of_new_database(tmp_path):
+    con = common.get_connection(str(tmp_path / "new.db"))
+    try:
+        assert migrations.upgrade(con) == [version for version, migration in migrations.MIGRATIONS]
+        assert migrations.get_version(con) == migrations.LATEST_VERSION
+        # already upgraded
+        assert migrations.upgrade(con) == []
+    finally:
+        con.close()
+
+# notes written by the first version of the schema are readable and searchable after the upgrade
+def test_upgrade_keeps_notes(tmp_path):
+    con = common.get_connection(str(tmp_path / "old.db"))
+    try:
+        assert migrations.upgrade(con, target=1) == [1]
+        long_text = "long text " * 1000
+        con.execute("""INSERT INTO users (id, username, passhash) VALUES (1, 'user', '')""")
+        con.executemany("""INSERT INTO notes (title, contents, date_created, tags, date_modified, userid)
+            VALUES (?, ?, '2020-01-01 00:00:00', '', ?, 1)""", [
+            ("first", "short text", "2020-01-02 00:00:00"),
+            ("second", long_text, "2020-01-03 00:00:00"),
+        ])
+        con.commit()
+        assert migrations.upgrade(con) == list(range(2, migrations.LATEST_VERSION + 1))
+        ns = NoteService(con)
+        notes = ns.list_notes(1).notes
+        assert [note["title"] for note in notes] == ["second", "first"]
+        assert notes[0]["modified_ts"] == common.date_to_ts("2020-01-03 00:00:00")
+        # large texts are stored compressed
+        stored = con.execute("""SELECT contents FROM notes WHERE title='second'""").fetchone()[0]
+        assert isinstance(stored, bytes)
+        assert compression.unpack(stored) == long_text
+        assert [note["title"] for note in ns.search_notes(1, ["short"], []).notes] == ["first"]
+    finally:
+        con.close()
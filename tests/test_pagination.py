@@ -0,0 +1,53 @@
+import pytest
+
+from tagged import services
+
+def _upload(ns, userid, n):
+    # pairs of notes with the same time: the order among them is by id
+    ns.upload(userid, [{"title": "note {}".format(i), "contents": "text", "tags": "t{}".format(i % 2),
+        "date_created": "2024-01-01 00:00:00", "date_modified": "2024-01-{:02d} 00:00:00".format(i // 2 + 1)}
+        for i in range(n)])
+
+def _titles(page):
+    return [note["title"] for note in page.notes]
+
+def test_pages_forward_and_back(make_user, note_service):
+    userid = make_user()
+    ns = note_service(userid)
+    _upload(ns, userid, 11)
+    newest_first = ["note {}".format(i) for i in reversed(range(11))]
+    pages = [ns.list_notes(userid, limit=3)]
+    assert pages[0].prev_cursor is None
+    while pages[-1].next_cursor is not None:
+        pages.append(ns.list_notes(userid, limit=3, after=pages[-1].next_cursor))
+    assert [_titles(page) for page in pages] == [newest_first[i:i + 3] for i in range(0, 11, 3)]
+    # back from the last page
+    page = pages[-1]
+    for expected in reversed(pages[:-1]):
+        page = ns.list_notes(userid, limit=3, before=page.prev_cursor)
+        assert _titles(page) == _titles(expected)
+    assert page.prev_cursor is None
+
+def test_new_notes_dont_shift_pages(make_user, note_service):
+    userid = make_user()
+    ns = note_service(userid)
+    _upload(ns, userid, 6)
+    first = ns.list_notes(userid, limit=3)
+    ns.create_note(userid, "newest", "text", [])
+    second = ns.list_notes(userid, limit=3, after=first.next_cursor)
+    assert _titles(second) == ["note 2", "note 1", "note 0"]
+
+def test_pages_of_tag_search(make_user, note_service):
+    userid = make_user()
+    ns = note_service(userid)
+    _upload(ns, userid, 8)
+    first = ns.search_notes(userid, [], ["t0"], limit=2)
+    second = ns.search_notes(userid, [], ["t0"], limit=2, after=first.next_cursor)
+    assert _titles(first) + _titles(second) == ["note 6", "note 4", "note 2", "note 0"]
+    assert second.next_cursor is None
+
+@pytest.mark.parametrize("cursor", ["", "abc", "1_", "_1", "1-2"])
+def test_malformed_cursor(make_user, note_service, cursor):
+    userid = make_user()
+    with pytest.raises(services.NoteSearchException):
+        note_service(userid).list_notes(userid, after=cursor)
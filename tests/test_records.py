@@ -0,0 +1,42 @@
+from tagged import compression
+from tagged.services import NoteService
+
+def _counting(monkeypatch):
+    calls = {"load": 0, "unpack": 0}
+    load_contents = NoteService.load_contents
+    unpack = compression.unpack
+
+    def counted_load(self, noteid):
+        calls["load"] += 1
+        return load_contents(self, noteid)
+
+    def counted_unpack(value):
+        calls["unpack"] += 1
+        return unpack(value)
+    monkeypatch.setattr(NoteService, "load_contents", counted_load)
+    monkeypatch.setattr(compression, "unpack", counted_unpack)
+    return calls
+
+# note lists don't read or decompress contents of notes
+def test_lists_dont_load_contents(client, monkeypatch):
+    for i in range(3):
+        client.post("/new", data={"title": "note {}".format(i), "contents": "long text " * 1000, "tags": "tag"})
+    calls = _counting(monkeypatch)
+    for url in ("/", "/all", "/search/results?keywords=note", "/search/results?tags=tag"):
+        assert client.get(url).status_code == 200
+    assert calls == {"load": 0, "unpack": 0}
+
+# contents is loaded and decompressed on first access, once
+def test_contents_is_loaded_on_access(make_user, note_service, monkeypatch):
+    userid = make_user()
+    ns = note_service(userid)
+    ns.create_note(userid, "note", "long text " * 1000, [])
+    calls = _counting(monkeypatch)
+    [note] = ns.list_notes(userid).notes
+    [found] = ns.search_notes(userid, ["note"], [])
+    assert calls == {"load": 0, "unpack": 0}
+    assert note["contents"] == "long text " * 1000
+    assert note.contents == "long text " * 1000
+    assert calls == {"load": 1, "unpack": 1}
+    assert found["contents"] == "long text " * 1000
+    assert calls == {"load": 2, "unpack": 2}
@@ -0,0 +1,69 @@
+import random
+
+import pytest
+
+from tagged import related
+
+def _ids(index, noteid):
+    return [note["id"] for note in index.related(noteid)]
+
+def test_rarer_shared_tags_count_more():
+    rows = [(1, "a", "common"), (1, "a", "rare"),
+        (2, "b", "common"),
+        (3, "c", "common"), (3, "c", "rare"),
+        (4, "d", "other")]
+    index = related.RelatedIndex(1, rows)
+    assert _ids(index, 1) == [3, 2]
+    assert _ids(index, 4) == []
+    assert _ids(index, 5) == []
+    index.set_note(3, None, ())
+    assert _ids(index, 1) == [2]
+
+def test_index_follows_writes(make_user, note_service):
+    userid = make_user()
+    ns = note_service(userid)
+    first = ns.create_note(userid, "first", "", ["a", "b"])
+    index = related.get_index(ns, userid, ns.get_data_version(userid)[0])
+    assert _ids(index, first) == []
+    second = ns.create_note(userid, "second", "", ["b"])
+    assert related.get_index(ns, userid, ns.get_data_version(userid)[0]) is index
+    assert _ids(index, first) == [second]
+    ns.update_note(userid, second, "second", "", ["c"])
+    assert _ids(index, first) == []
+
+# an index built after a write the request didn't see gets the version of that write
+def test_index_built_after_a_write_has_its_version(make_user, note_service):
+    userid = make_user()
+    ns = note_service(userid)
+    ns.create_note(userid, "first", "", ["a"])
+    stale = ns.get_data_version(userid)[0]
+    second = ns.create_note(userid, "second", "", ["a"])
+    index = related.get_index(ns, userid, stale)
+    assert index.version == ns.get_data_version(userid)[0]
+    related.apply_changes(userid, index.version, {second: ("second", ["a"])})
+    assert related.indexes.get(userid) is index
+
+# both ways of scoring give the same scores and the same related notes
+def test_numpy_scores_match_python(monkeypatch):
+    pytest.importorskip("numpy")
+    rand = random.Random(1)
+    tags = ["tag{}".format(i) for i in range(30)]
+    rows = [(noteid, "note", tag) for noteid in range(1, 301) for tag in rand.sample(tags, rand.randint(1, 5))]
+    index = related.RelatedIndex(1, rows)
+    # changed and removed notes leave free groups and stale postings behind
+    for noteid in rand.sample(range(1, 301), 50):
+        index.set_note(noteid, "note", rand.sample(tags, rand.randint(0, 3)))
+    expected = {}
+    for group_tags in index.group_tags:
+        if not group_tags:
+            continue
+        numpy_scores = dict(index._scores_numpy(group_tags))
+        python_scores = dict(index._scores_python(group_tags))
+        assert numpy_scores.keys() == python_scores.keys()
+        for group, score in python_scores.items():
+            assert numpy_scores[group] == pytest.approx(score)
+    for noteid in range(1, 301):
+        expected[noteid] = index.related(noteid)
+    monkeypatch.setattr(related, "numpy", None)
+    for noteid in range(1, 301):
+        assert index.related(noteid) == expected[noteid]
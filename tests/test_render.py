@@ -0,0 +1,43 @@
+import pytest
+
+from tagged import compression
+from tagged import render
+
+pytest.importorskip("markdown_it")
+
+def test_markdown_is_rendered():
+    html = render.render_note("# My title\n\nsome **bold** text\n\n* item")
+    assert '<h1 id="Mytitle">' in html
+    assert "<strong>bold</strong>" in html
+    assert "<li>item</li>" in html
+
+def test_html_is_sanitized():
+    html = render.render_note('<script>alert(1)</script>\n\n[link](javascript:alert(1)) <img src=x onerror="alert(1)">')
+    assert "<script" not in html
+    assert "<img" not in html
+    assert "href=\"javascript" not in html
+
+def test_plain_text_without_markdown(monkeypatch):
+    monkeypatch.setattr(render, "_md", None)
+    assert render.render_note("<b>a</b>\nb") == "&lt;b&gt;a&lt;/b&gt;<br>b"
+
+def test_note_page_shows_rendered_html(client):
+    client.post("/new", data={"title": "note", "contents": "**bold** <script>x</script>", "tags": ""})
+    page = client.get("/note/1").get_data(as_text=True)
+    assert "<strong>bold</strong>" in page
+    assert "<script>x</script>" not in page
+
+# notes saved before rendering on the server was added are rendered when they are read, once
+@pytest.mark.parametrize("html_date_modified", [None, "2000-01-01 00:00:00"])
+def test_old_notes_are_rendered_on_read(make_user, note_service, html_date_modified):
+    userid = make_user()
+    ns = note_service(userid)
+    noteid = ns.create_note(userid, "note", "**bold**", [])
+    ns.con.execute("""UPDATE notes SET contents_html=NULL, html_date_modified=? WHERE id=?""", (html_date_modified, noteid))
+    ns.con.commit()
+    note = ns.get_note(userid, noteid)
+    assert "<strong>bold</strong>" in note["contents_html"]
+    contents_html, stored_date = ns.con.execute("""SELECT contents_html, html_date_modified FROM notes WHERE id=?""",
+        (noteid,)).fetchone()
+    assert compression.unpack(contents_html) == note["contents_html"]
+    assert stored_date == note["date_modified"]
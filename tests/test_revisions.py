@@ -0,0 +1,54 @@
+from tagged import revisions
+
+def test_delta_round_trip():
+    old = "first line\nsecond line\nthird line\n"
+    for new in ("first line\nchanged line\nthird line\n", "", "added\n" + old, old + "no newline at the end", old):
+        assert revisions.apply_delta(old, revisions.make_delta(old, new)) == new
+
+def _contents(i):
+    return "".join("line {}\n".format(j) for j in range(20)) + "edit {}\n".format(i)
+
+# every revision is rebuilt from the nearest full text and the deltas after it
+def test_every_revision_is_readable(make_user, note_service, monkeypatch):
+    monkeypatch.setattr(revisions, "SNAPSHOT_EVERY", 3)
+    userid = make_user()
+    ns = note_service(userid)
+    noteid = ns.create_note(userid, "title", _contents(0), ["t"])
+    for i in range(1, 8):
+        ns.update_note(userid, noteid, "title {}".format(i), _contents(i), ["t"])
+    listed = ns.list_revisions(userid, noteid)
+    assert [revision["revno"] for revision in listed] == list(range(8, 0, -1))
+    assert [revision["kind"] for revision in reversed(listed)] == \
+        ["full", "delta", "delta", "full", "delta", "delta", "full", "delta"]
+    for revno in range(1, 9):
+        assert ns.get_revision(userid, noteid, revno)["contents"] == _contents(revno - 1)
+
+def test_old_revisions_are_pruned(make_user, note_service, monkeypatch):
+    monkeypatch.setattr(revisions, "KEEP", 4)
+    userid = make_user()
+    ns = note_service(userid)
+    noteid = ns.create_note(userid, "title", _contents(0), [])
+    for i in range(1, 7):
+        ns.update_note(userid, noteid, "title", _contents(i), [])
+    listed = ns.list_revisions(userid, noteid)
+    assert [revision["revno"] for revision in listed] == [7, 6, 5, 4]
+    # the oldest kept revision doesn't depend on removed ones
+    assert listed[-1]["kind"] == "full"
+    assert ns.get_revision(userid, noteid, 4)["contents"] == _contents(3)
+
+def test_restore_revision(make_user, note_service):
+    userid = make_user()
+    ns = note_service(userid)
+    noteid = ns.create_note(userid, "first", _contents(0), ["a"])
+    ns.update_note(userid, noteid, "second", _contents(1), ["b"])
+    ns.restore_revision(userid, noteid, 1)
+    note = ns.get_note(userid, noteid)
+    assert (note["title"], note["contents"], note["tags"]) == ("first", _contents(0), "a")
+    assert ns.list_revisions(userid, noteid)[0]["revno"] == 3
+
+def test_revision_pages(client):
+    client.post("/new", data={"title": "note", "contents": "old text", "tags": ""})
+    client.post("/edit/1", data={"title": "note", "contents": "new text", "tags": ""})
+    resp = client.get("/api/note/1/revisions/1")
+    assert resp.get_json()["contents"] == "old text"
+    assert client.get("/note/1/revisions").status_code == 200
@@ -0,0 +1,30 @@
+def _search(ns, userid, keywords=(), tags=()):
+    return sorted(note["id"] for note in ns.search_notes(userid, list(keywords), list(tags)))
+
+def test_search_follows_changes(make_user, note_service):
+    userid = make_user()
+    ns = note_service(userid)
+    first = ns.create_note(userid, "Python notes", "generators and iterators", ["py"])
+    second = ns.create_note(userid, "Rust notes", "ownership", ["rust"])
+    assert _search(ns, userid, ["notes"]) == [first, second]
+    assert _search(ns, userid, ["iter"]) == [first]
+    ns.update_note(userid, first, "Python notes", "decorators", ["py"])
+    assert _search(ns, userid, ["iterators"]) == []
+    assert _search(ns, userid, ["decorators"]) == [first]
+    ns.delete_note(userid, second)
+    assert _search(ns, userid, ["ownership"]) == []
+    assert _search(ns, userid, ["notes"]) == [first]
+    assert _search(ns, userid, tags=["py"]) == [first]
+    # the old texts are removed from the index itself, not only hidden by the join with notes
+    def index(word):
+        return ns.con.execute("""SELECT rowid FROM notes_fts WHERE notes_fts MATCH ?""", (word,)).fetchall()
+    assert index("iterators") == [] and index("ownership") == []
+    assert index("decorators") == [(first,)]
+    ns.con.execute("""INSERT INTO notes_fts (notes_fts) VALUES ('integrity-check')""")
+
+def test_search_is_per_user(make_user, note_service):
+    userid = make_user("user")
+    other = make_user("other")
+    ns = note_service(userid)
+    ns.create_note(other, "secret", "secret text", [])
+    assert _search(ns, userid, ["secret"]) == []
@@ -0,0 +1,91 @@
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+import pytest
+
+from tagged import serve
+
+pytestmark = pytest.mark.skipif(not hasattr(signal, "SIGHUP"), reason="needs POSIX signals")
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _get(port, path="/login"):
+    with urllib.request.urlopen("http://127.0.0.1:{}{}".format(port, path), timeout=10) as resp:
+        return resp.status
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+# the master's log, read in a thread: pids of the started workers
+class _Log:
+
+    def __init__(self, stream):
+        self.lines = []
+        self._stream = stream
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        for line in self._stream:
+            self.lines.append(line)
+
+    def started_workers(self):
+        return [int(m.group(1)) for line in list(self.lines) for m in [re.search(r"started worker (\d+)", line)] if m]
+
+def _wait(condition, timeout=60):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.1)
+
+# a reload replaces the workers, the server keeps answering meanwhile
+def test_reload_replaces_workers(tmp_path):
+    os.symlink(os.path.dirname(serve.__file__), tmp_path / "tagged")
+    db = str(tmp_path / "tagged.db")
+    env = dict(os.environ, TAGGED_DB=db)
+    subprocess.run([sys.executable, "-m", "tagged.maintenance", "migrate"], cwd=tmp_path, env=env, check=True,
+        capture_output=True)
+    port = _free_port()
+    master = subprocess.Popen([sys.executable, "-m", "tagged.serve", "--bind", "127.0.0.1:{}".format(port), "--workers", "2"],
+        cwd=tmp_path, env=env, stderr=subprocess.PIPE, text=True)
+    try:
+        log = _Log(master.stderr)
+        _wait(lambda: any("listening on" in line for line in log.lines))
+        _wait(lambda: len(log.started_workers()) == 2)
+        old = log.started_workers()
+        for i in range(10):
+            assert _get(port) == 200
+        master.send_signal(signal.SIGHUP)
+        # requests are answered while the workers are replaced
+        deadline = time.monotonic() + 60
+        while len(log.started_workers()) < 4 or any(map(_alive, old)):
+            assert _get(port) == 200
+            assert master.poll() is None
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+        new = log.started_workers()[2:]
+        assert not set(new) & set(old)
+        assert all(map(_alive, new))
+        for i in range(10):
+            assert _get(port) == 200
+        master.terminate()
+        assert master.wait(timeout=60) == 0
+        assert not any(map(_alive, new))
+    finally:
+        if master.poll() is None:
+            master.kill()
+            master.wait()
@@ -0,0 +1,201 @@
+import os
+import subprocess
+import sys
+import time
+
+from tagged import cache
+from tagged import common
+from tagged import services
+from tagged.services import SessionService
+
+def _login(userid, token="token"):
+    with common.get_con() as con:
+        SessionService(con).create_session(userid, token)
+        con.commit()
+    return token
+
+def _get_userid(token):
+    with common.get_con() as con:
+        return SessionService(con).get_userid(token)
+
+def test_logout_drops_cached_session(make_user):
+    userid = make_user()
+    token = _login(userid)
+    assert _get_userid(token) == userid
+    assert services.session_cache.get(token) is not None
+    with common.get_con() as con:
+        SessionService(con).deactivate_session(token)
+    assert _get_userid(token) is None
+
+# a logout between reading the session and caching it: the session must not be cached
+def test_logout_during_lookup(make_user, monkeypatch):
+    monkeypatch.setattr(services, "SESSION_TOUCH_INTERVAL", 0)
+    userid = make_user()
+    token = _login(userid)
+    touch = SessionService._touch
+
+    def touch_and_logout(self, token, now):
+        touch(self, token, now)
+        with common.get_con() as con:
+            SessionService(con).deactivate_session(token)
+
+    monkeypatch.setattr(SessionService, "_touch", touch_and_logout)
+    assert _get_userid(token) == userid
+    monkeypatch.setattr(SessionService, "_touch", touch)
+    assert services.session_cache.get(token) is None
+    assert _get_userid(token) is None
+
+def test_set_unless_invalidated():
+    c = cache.LRUCache(10)
+    generation = c.generation
+    c.pop("other")
+    assert not c.set_unless_invalidated("key", 1, generation)
+    assert c.get("key") is None
+    assert c.set_unless_invalidated("key", 1, c.generation)
+    assert c.get("key") == 1
+
+# another process logs out: its message in the invalidation file drops the token from this process's cache
+def test_logout_in_other_process(make_user, tmp_path, monkeypatch):
+    path = str(tmp_path / "sessions")
+    monkeypatch.setattr(services, "session_invalidations", cache.FileInvalidationChannel(path))
+    userid = make_user()
+    token = _login(userid)
+    assert _get_userid(token) == userid
+    # the other process: its own connection and its own channel
+    other = cache.FileInvalidationChannel(path)
+    con = common.get_connection()
+    try:
+        con.execute("""DELETE FROM sessions WHERE id=?""", (token,))
+        con.commit()
+    finally:
+        con.close()
+    other.publish(token)
+    assert services.session_cache.get(token) is not None
+    assert _get_userid(token) is None
+
+PUBLISH = """
+import importlib.util, sys
+spec = importlib.util.spec_from_file_location("cache", sys.argv[1])
+cache = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(cache)
+channel = cache.FileInvalidationChannel(sys.argv[2])
+for key in sys.argv[3:]:
+    channel.publish(key)
+"""
+
+def _publish(path, *keys):
+    subprocess.run([sys.executable, "-c", PUBLISH, cache.__file__, path] + list(keys), check=True)
+
+def test_channel_between_processes(tmp_path):
+    path = str(tmp_path / "channel")
+    _publish(path, "before")
+    channel = cache.FileInvalidationChannel(path)
+    # messages published before the channel was made are not returned
+    assert channel.poll() == []
+    _publish(path, "a", "b")
+    assert channel.poll() == ["a", "b"]
+    assert channel.poll() == []
+
+def test_channel_without_file(tmp_path):
+    path = str(tmp_path / "channel")
+    channel = cache.FileInvalidationChannel(path)
+    assert channel.poll() == []
+    _publish(path, "a")
+    assert channel.poll() == ["a"]
+
+# a replaced file may have lost messages: everything is invalidated
+def test_channel_rotation(tmp_path, monkeypatch):
+    path = str(tmp_path / "channel")
+    channel = cache.FileInvalidationChannel(path)
+    _publish(path, "a")
+    assert channel.poll() == ["a"]
+    monkeypatch.setattr(cache.FileInvalidationChannel, "MAX_SIZE", 10)
+    publisher = cache.FileInvalidationChannel(path)
+    publisher.publish("x" * 20)
+    assert os.path.getsize(path) == 0
+    assert channel.poll() is None
+    publisher.publish("b")
+    assert channel.poll() == ["b"]
+
+def _set_times(token, created_ts, last_seen_ts):
+    with common.get_con() as con:
+        con.execute("""UPDATE sessions SET created_ts=?, last_seen_ts=? WHERE id=?""", (created_ts, last_seen_ts, token))
+        con.commit()
+    services.session_cache.clear()
+
+def _last_seen(token):
+    with common.get_con() as con:
+        return con.execute("""SELECT last_seen_ts FROM sessions WHERE id=?""", (token,)).fetchone()[0]
+
+def test_idle_session_expires(make_user):
+    userid = make_user()
+    token = _login(userid)
+    now = int(time.time())
+    _set_times(token, now - 100, now - services.SESSION_IDLE_TIMEOUT + 10)
+    assert _get_userid(token) == userid
+    _set_times(token, now - 100, now - services.SESSION_IDLE_TIMEOUT - 10)
+    assert _get_userid(token) is None
+
+# a session expires SESSION_MAX_AGE seconds after login even if it's used all the time
+def test_old_session_expires(make_user):
+    userid = make_user()
+    token = _login(userid)
+    now = int(time.time())
+    _set_times(token, now - services.SESSION_MAX_AGE - 10, now)
+    assert _get_userid(token) is None
+    # a cached session expires too
+    _set_times(token, now - services.SESSION_MAX_AGE + 10, now)
+    assert _get_userid(token) == userid
+    assert services.session_cache.get(token) is not None
+    services.session_cache.set(token, (userid, now - services.SESSION_MAX_AGE - 10, now))
+    assert _get_userid(token) is None
+
+# last_seen_ts is written at most once in SESSION_TOUCH_INTERVAL seconds
+def test_touch_is_throttled(make_user, monkeypatch):
+    touches = []
+    touch = SessionService._touch
+
+    def counted_touch(self, token, now):
+        touches.append(now)
+        touch(self, token, now)
+    monkeypatch.setattr(SessionService, "_touch", counted_touch)
+    userid = make_user()
+    token = _login(userid)
+    for _ in range(5):
+        assert _get_userid(token) == userid
+        # also when the session is read from the database
+        services.session_cache.clear()
+    assert touches == []
+    now = int(time.time())
+    _set_times(token, now - 1000, now - services.SESSION_TOUCH_INTERVAL - 10)
+    for _ in range(5):
+        assert _get_userid(token) == userid
+        services.session_cache.clear()
+    assert len(touches) == 1
+    assert _last_seen(token) >= now
+
+def test_sweeper_deletes_expired_in_batches(make_user, monkeypatch):
+    monkeypatch.setattr(services, "SESSION_SWEEP_PAUSE", 0)
+    userid = make_user()
+    now = int(time.time())
+    for i in range(7):
+        token = _login(userid, "expired{}".format(i))
+        if i % 2:
+            _set_times(token, now - 100, now - services.SESSION_IDLE_TIMEOUT - 10)
+        else:
+            _set_times(token, now - services.SESSION_MAX_AGE - 10, now)
+    live = [_login(userid, "live{}".format(i)) for i in range(2)]
+    batches = []
+    delete_expired = SessionService.delete_expired
+
+    def counted_delete_expired(self, limit):
+        n = delete_expired(self, limit)
+        batches.append(n)
+        return n
+    monkeypatch.setattr(SessionService, "delete_expired", counted_delete_expired)
+    assert services.SessionSweeper(interval=0, batch_size=3).sweep() == 7
+    assert batches == [3, 3, 1]
+    with common.get_con() as con:
+        assert sorted(row[0] for row in con.execute("""SELECT id FROM sessions""")) == live
+    for token in live:
+        assert _get_userid(token) == userid
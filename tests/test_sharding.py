@@ -0,0 +1,63 @@
+import pytest
+
+from tagged import common
+from tagged import services
+from tagged import sharding
+
+def _shard_of(userid):
+    with common.get_con() as con:
+        return sharding.get_shard(con, userid)
+
+def _create(userid):
+    with common.get_con() as con, sharding.get_user_con(con, userid) as ucon:
+        return services.NoteService(ucon).create_note(userid, "title", "", [])
+
+def _note_ids(userid):
+    with common.get_con() as con, sharding.get_user_con(con, userid) as ucon:
+        return sorted(note["id"] for note in services.NoteService(ucon).list_notes(userid, 1000))
+
+def test_move_keeps_notes(make_user, note_service):
+    userid = make_user()
+    ns = note_service(userid)
+    noteid = ns.create_note(userid, "title", "moved text", ["a", "b"])
+    ns.update_note(userid, noteid, "title", "moved text, edited", ["a", "b"])
+    assert sharding.move_user(userid, 1)
+    assert not sharding.move_user(userid, 1)
+    assert _shard_of(userid) == 1
+    ns = note_service(userid)
+    note = ns.get_note(userid, noteid)
+    assert note["contents"] == "moved text, edited"
+    assert note["tag_list"] == ["a", "b"]
+    assert [revision["revno"] for revision in ns.list_revisions(userid, noteid)] == [2, 1]
+    assert [n["id"] for n in ns.search_notes(userid, ["edited"], [])] == [noteid]
+    assert ns.find_tag_counts(userid) == [("a", 1), ("b", 1)]
+    # nothing is left on the old shard, which refuses writes of the moved user
+    with common.get_con() as con:
+        assert con.execute("""SELECT count(*) FROM notes WHERE userid=?""", (userid,)).fetchone()[0] == 0
+        with pytest.raises(services.UserMovedException):
+            services.NoteService(con).create_note(userid, "lost", "", [])
+
+# notes keep their ids on another shard; ids allocated afterwards must not collide with them
+def test_move_back_and_forth(make_user):
+    first = make_user("first")
+    second = make_user("second")
+    sharding.move_user(second, 1)
+    second_notes = [_create(second) for i in range(3)]
+    assert all(noteid > sharding.SHARD_ID_RANGE for noteid in second_notes)
+    first_notes = [_create(first) for i in range(3)]
+
+    sharding.move_user(second, 0)
+    first_notes.append(_create(first))
+    second_notes.append(_create(second))
+    assert all(noteid < sharding.SHARD_ID_RANGE for noteid in first_notes + second_notes[3:])
+
+    sharding.move_user(first, 1)
+    sharding.move_user(second, 1)
+    first_notes.append(_create(first))
+    second_notes.append(_create(second))
+    sharding.move_user(first, 0)
+    first_notes.append(_create(first))
+
+    assert len(set(first_notes + second_notes)) == len(first_notes + second_notes)
+    assert _note_ids(first) == sorted(first_notes)
+    assert _note_ids(second) == sorted(second_notes)
@@ -0,0 +1,65 @@
+import sqlite3
+
+import pytest
+
+from tagged import common
+from tagged.services import NoteService
+
+def _corrupt_counts():
+    with common.get_con() as con:
+        con.execute("""UPDATE tag_counts SET count=99""")
+        con.commit()
+
+# a rebuild changes the data version: browsers must not keep the wrong counts
+@pytest.mark.parametrize("all_users", [False, True])
+def test_rebuild_tag_counts_changes_etag(client, all_users):
+    client.post("/new", data={"title": "note", "contents": "text", "tags": "python"})
+    _corrupt_counts()
+    resp = client.get("/all_tags")
+    assert b"99" in resp.data
+    etag = resp.headers["ETag"]
+    with common.get_con() as con:
+        userid = con.execute("""SELECT id FROM users WHERE username='user'""").fetchone()[0]
+        NoteService(con).rebuild_tag_counts(None if all_users else userid)
+        assert NoteService(con).find_tag_counts(userid) == [("python", 1)]
+    resp = client.get("/all_tags", headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert b"99" not in resp.data
+
+def _note_tags(ns, userid):
+    return sorted(ns.con.execute("""SELECT noteid, tag FROM note_tags WHERE userid=?""", (userid,)).fetchall())
+
+def _search(ns, userid, keywords, tags):
+    return sorted(note["id"] for note in ns.search_notes(userid, keywords, tags))
+
+# a tag matches only notes with that very tag, not a tag it's a part of
+@pytest.mark.parametrize("fts", [True, False])
+def test_tag_search_is_exact(make_user, note_service, monkeypatch, fts):
+    userid = make_user()
+    ns = note_service(userid)
+    py = ns.create_note(userid, "first note", "text", ["py"])
+    ns.create_note(userid, "second note", "text", ["python"])
+    ns.create_note(userid, "third note", "text", ["my-py"])
+    if not fts:
+        def no_fts(*args):
+            raise sqlite3.OperationalError("no such module: fts5")
+        monkeypatch.setattr(NoteService, "_search_notes_fts", no_fts)
+    assert _search(ns, userid, ["note"], ["py"]) == [py]
+    assert _search(ns, userid, [], ["py"]) == [py]
+
+# note_tags follows the tags of notes
+def test_note_tags_follow_changes(make_user, note_service):
+    userid = make_user()
+    ns = note_service(userid)
+    first = ns.create_note(userid, "first", "text", ["a", "b"])
+    second = ns.create_note(userid, "second", "text", ["b"])
+    assert _note_tags(ns, userid) == [(first, "a"), (first, "b"), (second, "b")]
+    ns.update_note(userid, first, "first", "text", ["b", "c"])
+    assert _note_tags(ns, userid) == [(first, "b"), (first, "c"), (second, "b")]
+    ns.delete_note(userid, second)
+    assert _note_tags(ns, userid) == [(first, "b"), (first, "c")]
+    ns.upload(userid, [{"title": "uploaded", "contents": "text", "tags": "c d",
+        "date_created": "2024-01-01 00:00:00", "date_modified": "2024-01-01 00:00:00"}])
+    uploaded = max(row[0] for row in _note_tags(ns, userid))
+    assert _note_tags(ns, userid) == [(first, "b"), (first, "c"), (uploaded, "c"), (uploaded, "d")]
+    assert ns.find_tag_counts(userid) == [("b", 1), ("c", 2), ("d", 1)]